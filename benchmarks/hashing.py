@@ -0,0 +1,61 @@
+"""
+Hashes a temporary file with the previous hashing (one pass of 512 bytes reads for each digest) and with
+`ListDirectory.get_hashes` (one pass of large reads feeding every digest), then prints the throughputs in MB/s.
+
+Usage: python2 benchmarks/hashing.py [SIZE_IN_MB] [ALGORITHM...]
+"""
+import os
+import sys
+from hashlib import new as new_hash
+from tempfile import TemporaryFile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from directoryLister.directory_lister import ListDirectory  # noqa: E402
+
+
+def legacy_hashes(fd, algorithms):
+    """The hashing as it was: the file is read again for each digest, by blocks of 512 bytes."""
+    hashes = {}
+    for name in algorithms:
+        h = new_hash(name)
+        fd.seek(0)
+        while 1:
+            data = fd.read(2**9)
+            if not data:
+                break
+            h.update(data)
+        hashes[name] = h.hexdigest()
+    return hashes
+
+
+def measure(function, fd, algorithms, size):
+    start = default_timer()
+    hashes = function(fd, algorithms)
+    elapsed = default_timer() - start
+    return size / elapsed / 10**6, hashes
+
+
+def main(size_mb=200, *algorithms):
+    algorithms = algorithms or ('md5', 'sha1')
+    size = size_mb * 10**6
+    with TemporaryFile() as fd:
+        block = os.urandom(2**20)
+        remaining = size
+        while remaining > 0:
+            fd.write(block[:remaining])
+            remaining -= len(block)
+        fd.flush()
+
+        print('Hashing %dMB with %s (the file is in the page cache)' % (size_mb, ', '.join(algorithms)))
+        legacy, expected = measure(legacy_hashes, fd, algorithms, size)
+        print('  %-12s %8.1f MB/s' % ('legacy', legacy))
+        current, hashes = measure(ListDirectory.get_hashes, fd, algorithms, size)
+        print('  %-12s %8.1f MB/s' % ('single pass', current))
+        assert hashes == expected, 'the digests differ'
+        print('  speedup      %8.1fx' % (current / legacy))
+
+
+if __name__ == '__main__':
+    main(*([int(sys.argv[1])] + sys.argv[2:] if len(sys.argv) > 1 else []))
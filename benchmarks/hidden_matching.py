@@ -0,0 +1,59 @@
+"""
+Checks synthetic directory entries against a few dozen hidden patterns with the previous matcher (a `fnmatch` of
+each pattern for each entry) and with `HiddenMatcher` (the patterns compiled once), then prints the timings.
+
+Usage: python2 benchmarks/hidden_matching.py [ENTRIES] [ROUNDS]
+"""
+import os
+import sys
+from fnmatch import fnmatch
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from directoryLister.directory_lister import HiddenMatcher  # noqa: E402
+
+PATTERNS = (
+    ['.git/', '.svn/', '.hg/', '.config/', '__pycache__/', 'node_modules/', 'Thumbs.db', '.DS_Store', 'desktop.ini'] +
+    ['*.%s' % ext for ext in ('pyc', 'pyo', 'swp', 'tmp', 'bak', 'orig', 'rej', 'log', 'lock', 'part')] +
+    ['*~', '*hide_me*', '.#*', '#*#', '[0-9][0-9][0-9][0-9]-*.old', 'core.[0-9]*', '*.sw?', '~$*']
+)
+
+
+def legacy_matcher(patterns):
+    """The matcher as it was: each pattern is checked with `fnmatch` and the matches are collected into a list."""
+    return lambda file_name: True if filter(None, [fnmatch(file_name, pat) for pat in patterns]) else False
+
+
+def synthetic_names(entries):
+    extensions = ('txt', 'jpg', 'pyc', 'tar.gz', 'log', 'html', 'c', 'swp')
+    return [
+        'entry-%06d/' % i if not i % 10 else 'entry-%06d.%s' % (i, extensions[i % len(extensions)])
+        for i in range(entries)
+    ]
+
+
+def measure(is_hidden, names, rounds):
+    best = None
+    for _ in range(rounds):
+        start = default_timer()
+        hidden = sum(1 for name in names if is_hidden(name))
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, hidden
+
+
+def main(entries=100000, rounds=3):
+    names = synthetic_names(entries)
+    print('Checking %d entries against %d patterns (best of %d rounds)' % (entries, len(PATTERNS), rounds))
+    results = []
+    for label, is_hidden in (('legacy', legacy_matcher(PATTERNS)), ('compiled', HiddenMatcher(PATTERNS))):
+        elapsed, hidden = measure(is_hidden, names, rounds)
+        results.append((elapsed, hidden))
+        print('  %-10s %8.3fs  %7d hidden  %10.0f entries/s' % (label, elapsed, hidden, entries / elapsed))
+    assert results[0][1] == results[1][1], 'the matchers differ'
+    print('  speedup    %8.1fx' % (results[0][0] / results[1][0]))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,96 @@
+"""
+Builds the rows of a synthetic listing of 100k entries as they were (a dict of every formatted token for each entry)
+and as `Entry` records (the raw stats, formatted while rendered), then prints the memory they take and the timings of
+building and rendering them.
+
+Usage: python2 benchmarks/listing_memory.py [ENTRIES] [ROUNDS]
+"""
+import gc
+import os
+import re
+import sys
+from cgi import escape
+from time import strftime, gmtime
+from timeit import default_timer
+from urllib import quote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from directoryLister.directory_lister import ListDirectory, Listing  # noqa: E402
+
+
+def legacy_row(app, file_name, is_dir, stats, end_url=''):
+    """The rows as they were: every token formatted into a dict."""
+    r = dict(
+        FILE_NAME=escape(file_name),
+        FILE_LINK='%s%s' % (quote(file_name), is_dir and ('/' + end_url) or ''),
+        FILE_MODIFICATION=stats and strftime(app.date_format, gmtime(stats[8])) or '',
+        FILE_CREATION=stats and strftime(app.date_format, gmtime(stats[9])) or '',
+    )
+    if is_dir:
+        r['FILE_TYPE'], r['FILE_SIZE'], r['FILE_MIMETYPE'], r['DASHED_FILE_MIMETYPE'] = ('dir', '-', '-', '-')
+    else:
+        mime = app.mimetypes_list.get(os.path.splitext(file_name)[1]) or 'application/octet-stream'
+        r['FILE_TYPE'], r['FILE_SIZE'], r['FILE_MIMETYPE'], r['DASHED_FILE_MIMETYPE'] = (
+            'file %s' % filter(None, mime.split('/'))[0], stats and app.convert_size(stats[6]) or '',
+            mime, re.sub(app.css_invalid_chars, '-', mime))
+    return r
+
+
+def synthetic_entries(entries):
+    extensions = ('txt', 'jpg', 'py', 'tar.gz', 'log', 'html', 'c', 'pdf')
+    for i in range(entries):
+        is_dir = not i % 10
+        name = 'entry-%06d%s' % (i, '' if is_dir else '.' + extensions[i % len(extensions)])
+        mtime = 1431213903 + i * 7
+        yield name, is_dir, os.stat_result((0o100644, i, 1, 1, 0, 0, i * 37, mtime, mtime, mtime - 3600))
+
+
+def deep_size(obj, seen):
+    """The size of an object and of the objects it refers to, each object being counted once."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__') and not isinstance(obj, Listing):  # the listing is shared by the entries
+        size += sum(deep_size(getattr(obj, name), seen) for name in obj.__slots__ if name != 'listing')
+    return size
+
+
+def measure(build, app, entries, rounds):
+    best_build = best_render = None
+    for _ in range(rounds):
+        gc.collect()
+        start = default_timer()
+        rows = [row for row in build(synthetic_entries(entries))]
+        built = default_timer()
+        app.template.render_listing(dict(END_URL=''), [('dirs', rows[::10]), ('files', rows)])
+        rendered = default_timer()
+        best_build = min(best_build or built - start, built - start)
+        best_render = min(best_render or rendered - built, rendered - built)
+    return deep_size(rows, set()), best_build, best_render
+
+
+def main(entries=100000, rounds=3):
+    app = ListDirectory(path='/', keep_hashes_cache=False)
+    listing = Listing(app, '/', '')
+    builders = (
+        ('legacy', lambda it: (legacy_row(app, name, is_dir, stats) for name, is_dir, stats in it)),
+        ('entries', lambda it: (listing.entry(name, is_dir, stats) for name, is_dir, stats in it)),
+    )
+    print('Building and rendering %d entries (best of %d rounds)' % (entries, rounds))
+    results = []
+    for label, build in builders:
+        size, build_time, render_time = measure(build, app, entries, rounds)
+        results.append(size)
+        print('  %-8s %7.1f MiB per 100k entries  built in %.3fs  rendered in %.3fs' % (
+            label, size * 100000.0 / entries / 2**20, build_time, render_time))
+    print('  memory   %7.1fx smaller' % (float(results[0]) / results[1]))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,318 @@
+"""
+Builds synthetic trees in a temporary directory (flat directories of 1k, 10k and 100k entries, a deep tree and a large
+file), then measures `ListDirectory` called directly as a WSGI application and served by `make_multithread_server` to
+concurrent local clients: the requests per second, the p50 and p99 latencies, the time to first byte and the download
+and hashing throughputs in MB/s of each scenario, and the peak RSS of the whole run (the peak of the process, not of a
+scenario).
+
+The results are written as JSON (with the commit they were measured on), and are compared to the results of a
+previous run when given, e.g.:
+    git checkout master && python2 benchmarks/suite.py --output before.json
+    git checkout feature && python2 benchmarks/suite.py --output after.json --compare before.json
+
+Usage: python2 benchmarks/suite.py [--output FILE] [--compare FILE] [--quick] [--concurrency INT] [--keep-alive]
+"""
+import gc
+import httplib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+from time import strftime, gmtime
+from timeit import default_timer
+from wsgiref.util import setup_testing_defaults
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from directoryLister.directory_lister import (  # noqa: E402
+    ListDirectory, SendfileRequestHandler, KeepAliveRequestHandler, make_multithread_server)
+
+# the metrics of which a higher value is better, the others being better when lower
+HIGHER_IS_BETTER = ('requests_per_second', 'mb_per_second')
+EXTENSIONS = ('txt', 'jpg', 'py', 'tar.gz', 'log', 'html', 'c', 'pdf')
+
+
+class QuietRequestHandler(SendfileRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class QuietKeepAliveRequestHandler(KeepAliveRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def build_tree(root, flat_sizes, deep_levels, large_file_mb):
+    """
+    Creates the synthetic trees into `root`: a `flat-N` directory of N files for each size, a `deep` tree of
+    `deep_levels` levels of 4 sub-directories holding 8 files each and a `large.bin` file.
+    """
+    for size in flat_sizes:
+        path = os.path.join(root, 'flat-%d' % size)
+        os.mkdir(path)
+        for i in range(size):
+            if not i % 10:
+                os.mkdir(os.path.join(path, 'dir-%06d' % i))
+            else:
+                with open(os.path.join(path, flat_file_name(i)), 'wb') as f:
+                    f.write('x' * (i % 4096))
+
+    def deep(path, level):
+        os.mkdir(path)
+        for i in range(8):
+            with open(os.path.join(path, 'file-%d.txt' % i), 'wb') as f:
+                f.write('x' * 512)
+        if level < deep_levels:
+            for i in range(4):
+                deep(os.path.join(path, 'level-%d-%d' % (level, i)), level + 1)
+    deep(os.path.join(root, 'deep'), 1)
+
+    with open(os.path.join(root, 'large.bin'), 'wb') as f:
+        block = os.urandom(2**20)
+        for _ in range(large_file_mb):
+            f.write(block)
+
+
+def flat_file_name(i):
+    return 'file-%06d.%s' % (i, EXTENSIONS[i % len(EXTENSIONS)])
+
+
+def percentile(sorted_values, ratio):
+    """The nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(round(ratio * (len(sorted_values) - 1))))]
+
+
+def summarize(latencies, elapsed, size=0, first_bytes=None):
+    latencies = sorted(latencies)
+    result = dict(
+        requests=len(latencies),
+        requests_per_second=len(latencies) / elapsed,
+        p50_ms=percentile(latencies, .5) * 1000,
+        p99_ms=percentile(latencies, .99) * 1000,
+    )
+    if first_bytes:
+        first_bytes = sorted(first_bytes)
+        result.update(ttfb_p50_ms=percentile(first_bytes, .5) * 1000, ttfb_p99_ms=percentile(first_bytes, .99) * 1000)
+    if size:
+        result['mb_per_second'] = size / elapsed / 10**6
+    return result
+
+
+def call(app, path, query=''):
+    """Calls the application as a WSGI server would, returning the size of the body."""
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query, 'REQUEST_METHOD': 'GET'}
+    setup_testing_defaults(environ)
+    status = []
+    body = app(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        size = sum(len(data) for data in body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    assert status[0].startswith('200'), '%s %s?%s' % (status[0], path, query)
+    return size
+
+
+def bench_wsgi(app, path, query, requests):
+    call(app, path, query)  # the first request fills the caches
+    latencies, size = [], 0
+    start = default_timer()
+    for _ in range(requests):
+        request_start = default_timer()
+        size += call(app, path, query)
+        latencies.append(default_timer() - request_start)
+    return summarize(latencies, default_timer() - start, size)
+
+
+def bench_socket(address, path, requests, concurrency, keep_alive):
+    """
+    Sends `requests` GET requests by `concurrency` client threads, each one waiting for its previous response.
+    """
+    latencies, first_bytes, sizes, errors = [], [], [], []
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def client():
+        connection = None
+        while True:
+            with lock:
+                if not remaining[0]:
+                    break
+                remaining[0] -= 1
+            request_start = default_timer()
+            try:
+                if connection is None:
+                    connection = httplib.HTTPConnection(*address)
+                connection.request('GET', path)
+                response = connection.getresponse()  # returns once the status line and the headers are read
+                first_byte = default_timer()
+                size = 0
+                while True:
+                    data = response.read(2**18)
+                    if not data:
+                        break
+                    size += len(data)
+                if response.status != 200:
+                    raise httplib.HTTPException(response.status)
+            except (httplib.HTTPException, IOError) as e:
+                errors.append(e)
+                connection = None
+                continue
+            end = default_timer()
+            if not keep_alive:
+                connection.close()
+                connection = None
+            with lock:
+                latencies.append(end - request_start)
+                first_bytes.append(first_byte - request_start)
+                sizes.append(size)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = summarize(latencies, default_timer() - start, sum(sizes), first_bytes)
+    result['errors'] = len(errors)
+    return result
+
+
+def bench_hashing(path, algorithms):
+    app = ListDirectory(path='/', keep_hashes_cache=False)
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        start = default_timer()
+        app.get_hashes(f, algorithms)
+        elapsed = default_timer() - start
+    return dict(mb_per_second=size / elapsed / 10**6)
+
+
+def peak_rss_mb():
+    # in KiB on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2.0**20 if sys.platform == 'darwin' else rss / 2.0**10
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(root, flat_sizes, requests, concurrency, keep_alive):
+    results = {}
+
+    def record(name, result):
+        results[name] = result
+        print('  %-32s %s' % (name, '  '.join('%s=%.4g' % item for item in sorted(result.items()))))
+        gc.collect()
+
+    print('WSGI application called directly')
+    for size in flat_sizes:
+        # fewer requests on the large directories, each one listing all their entries
+        count = max(5, requests * 1000 / size)
+        uncached = ListDirectory(path=root, keep_hashes_cache=False, listing_cache_entries=0)
+        record('wsgi.listing.flat-%d' % size, bench_wsgi(uncached, '/flat-%d/' % size, '', count))
+        # large enough to keep the pages of the largest directories
+        cached = ListDirectory(path=root, keep_hashes_cache=False, listing_cache_size=2**30)
+        record('wsgi.listing_cached.flat-%d' % size, bench_wsgi(cached, '/flat-%d/' % size, '', requests))
+        record('wsgi.json.flat-%d' % size, bench_wsgi(uncached, '/flat-%d/' % size, 'format=json', count))
+    app = ListDirectory(path=root, keep_hashes_cache=False, listing_cache_entries=0)
+    record('wsgi.listing.deep', bench_wsgi(app, '/deep/level-1-0/level-2-0/', '', requests))
+    record('wsgi.download.large', bench_wsgi(app, '/large.bin', '', 3))
+
+    print('Served by make_multithread_server to %d clients%s' % (
+        concurrency, ' (keep-alive)' if keep_alive else ''))
+    app = ListDirectory(path=root, keep_hashes_cache=False)
+    server = make_multithread_server(
+        '127.0.0.1', 0, app, thread_count=max(concurrency, 4),
+        handler_class=QuietKeepAliveRequestHandler if keep_alive else QuietRequestHandler, keep_alive_timeout=5)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    address = server.server_address
+    try:
+        for size in flat_sizes:
+            record('http.listing.flat-%d' % size, bench_socket(
+                address, '/flat-%d/' % size, max(concurrency, requests * 1000 / size), concurrency, keep_alive))
+        record('http.listing.deep', bench_socket(
+            address, '/deep/level-1-0/level-2-0/', requests, concurrency, keep_alive))
+        record('http.small_file', bench_socket(
+            address, '/flat-%d/%s' % (flat_sizes[0], flat_file_name(999)), requests, concurrency, keep_alive))
+        record('http.download.large', bench_socket(address, '/large.bin', concurrency * 2, concurrency, keep_alive))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print('Hashing')
+    record('hashing.md5_sha1', bench_hashing(os.path.join(root, 'large.bin'), ('md5', 'sha1')))
+    return results
+
+
+def compare(output, previous):
+    results = output['results']
+    print('Compared to %s (%s)' % (previous.get('commit') or 'the previous run', previous.get('date')))
+    for name in sorted(results):
+        before = previous['results'].get(name)
+        if not before:
+            continue
+        changes = []
+        for metric in ('requests_per_second', 'p99_ms', 'ttfb_p99_ms', 'mb_per_second'):
+            if metric in results[name] and before.get(metric):
+                change = (results[name][metric] - before[metric]) * 100.0 / before[metric]
+                better = change > 0 if metric in HIGHER_IS_BETTER else change < 0
+                changes.append('%s %+.1f%%%s' % (metric, change, '' if better or abs(change) < 5 else ' (!)'))
+        print('  %-32s %s' % (name, '  '.join(changes)))
+    if previous.get('peak_rss_mb'):
+        change = (output['peak_rss_mb'] - previous['peak_rss_mb']) * 100.0 / previous['peak_rss_mb']
+        print('  %-32s %+.1f%%%s' % ('peak_rss_mb', change, ' (!)' if change >= 5 else ''))
+
+
+def main():
+    parser = ArgumentParser(description='Benchmarks DirectoryLister on synthetic trees.')
+    parser.add_argument('--output', metavar='FILE', help='Writes the results as JSON into FILE.')
+    parser.add_argument('--compare', metavar='FILE', type=open, help='Compares the results to a previous output.')
+    parser.add_argument('--quick', action='store_true', help='Smaller trees and fewer requests.')
+    parser.add_argument('--concurrency', metavar='INT', type=int, default=8, help='The number of clients.')
+    parser.add_argument('--keep-alive', action='store_true', help='Keeps the client connections open.')
+    args = parser.parse_args()
+
+    flat_sizes = (1000, 10000) if args.quick else (1000, 10000, 100000)
+    requests = 200 if args.quick else 1000
+    root = mkdtemp(prefix='directory-lister-bench-')
+    try:
+        start = default_timer()
+        build_tree(root, flat_sizes, 4 if args.quick else 6, 64 if args.quick else 256)
+        print('Trees built in %s in %.1fs' % (root, default_timer() - start))
+        results = run(root, flat_sizes, requests, args.concurrency, args.keep_alive)
+        print('Peak RSS: %.1f MiB' % peak_rss_mb())
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    output = dict(
+        commit=get_commit(), date=strftime('%Y-%m-%dT%H:%M:%SZ', gmtime()), python=platform.python_version(),
+        platform=platform.platform(), quick=args.quick, concurrency=args.concurrency, keep_alive=args.keep_alive,
+        peak_rss_mb=peak_rss_mb(), results=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('Results written into %s' % args.output)
+    if args.compare:
+        compare(output, json.load(args.compare))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Renders a synthetic listing of 50k entries with the compiled template and with the previous renderer (a `re.sub` of
+the blocs and a `string.Template` for each row), then prints the timings.
+
+Usage: python2 benchmarks/template_rendering.py [ENTRIES] [ROUNDS]
+"""
+import os
+import re
+import sys
+from operator import itemgetter
+from string import Template
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from directoryLister.directory_lister import CompiledTemplate, ListDirectory  # noqa: E402
+
+
+class LegacyListDirectory(ListDirectory):
+    """The renderer as it was before the template was compiled at startup."""
+    def rendering_no_error(self, directory_content, descending, end_url, **keys):
+        def get_content_match(match_obj):
+            return match_obj.group('CONTENT')
+
+        def r(obj):
+            def loop(l_obj):
+                content_template = l_obj.group('CONTENT')
+                if not self.hide_parent:
+                    _t = Template(content_template).safe_substitute(
+                        FILE_NAME='..', FILE_LINK='../' + end_url,
+                        FILE_MODIFICATION='', FILE_CREATION='', FILE_TYPE='parent', FILE_SIZE='', FILE_MIMETYPE='')
+                    _t = re.sub(CompiledTemplate.if_not_file, get_content_match, _t)
+                    _t = re.sub(CompiledTemplate.if_file, '', _t)
+                    formatted_content = _t
+                else:
+                    formatted_content = ''
+                for key in ('dirs', 'files'):
+                    for i in sorted(directory_content[key], key=itemgetter(0), reverse=descending):
+                        _t = Template(content_template).safe_substitute(**i[1])
+                        if key == 'dirs':
+                            _t = re.sub(CompiledTemplate.if_not_file, get_content_match, _t)
+                            _t = re.sub(CompiledTemplate.if_file, '', _t)
+                        else:
+                            _t = re.sub(CompiledTemplate.if_file, get_content_match, _t)
+                            _t = re.sub(CompiledTemplate.if_not_file, '', _t)
+                        formatted_content += _t
+                return formatted_content
+            return re.sub(CompiledTemplate.loop_regex, loop, obj.group('CONTENT'))
+        body = re.sub(CompiledTemplate.error_regex, '', re.sub(CompiledTemplate.no_error_regex, r, self.body))
+        # the page tokens were substituted on the whole rendered page
+        return Template(body).safe_substitute(**keys)
+
+
+def synthetic_content(entries):
+    content = {'dirs': [], 'files': []}
+    for i in range(entries):
+        is_dir = not i % 10
+        name = 'entry-%06d%s' % (i, '' if is_dir else '.txt')
+        content['dirs' if is_dir else 'files'].append((name, dict(
+            FILE_NAME=name,
+            FILE_LINK=name + ('/' if is_dir else ''),
+            FILE_MODIFICATION='2015-05-09 23:25:03',
+            FILE_CREATION='2015-05-09 23:25:03',
+            FILE_TYPE='dir' if is_dir else 'file text',
+            FILE_SIZE='-' if is_dir else '%.2fkB' % (i / 7.0),
+            FILE_MIMETYPE='-' if is_dir else 'text/plain',
+            DASHED_FILE_MIMETYPE='-' if is_dir else 'text-plain',
+        )))
+    return content
+
+
+def measure(app, content, rounds, keys):
+    best = None
+    for _ in range(rounds):
+        start = default_timer()
+        page = app.rendering_no_error(content, False, end_url='', **keys)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(page)
+
+
+def main(entries=50000, rounds=3):
+    content = synthetic_content(entries)
+    keys = dict(
+        CURRENT_DIRECTORY='/bench/', CSS='', JS='', END_URL='',
+        TOGGLE_SORTING_MODIFICATION='?sort=ST_MTIME.ASC', TOGGLE_SORTING_CREATION='?sort=ST_CTIME.ASC',
+        TOGGLE_SORTING_SIZE='?sort=ST_SIZE.ASC', TOGGLE_SORTING_NAME='?sort=NAME.ASC',
+    )
+    print('Rendering %d entries (best of %d rounds)' % (entries, rounds))
+    results = []
+    for label, cls in (('legacy', LegacyListDirectory), ('compiled', ListDirectory)):
+        elapsed, size = measure(cls(path='/', keep_hashes_cache=False), content, rounds, keys)
+        results.append(elapsed)
+        print('  %-10s %8.3fs  %9d bytes  %10.0f rows/s' % (label, elapsed, size, entries / elapsed))
+    print('  speedup    %8.1fx' % (results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -12,38 +12,45 @@ app.controller('MainCtrl', function ($scope, $rootScope, $http, ngDialog) {
                     document.getElementById('sha1').value = sha1_msg || msg;
                 };
 
-                $http(
-                    {
-                        method: 'GET',
-                        url: './' + path + '?hashes',
-                        isArray: true,
-                        jsonCallback: 'response',
-                        handleError: false
-                    }
-                ).success(
-                    function (data, status, headers) {
-                        if (headers('content-type') != 'application/json') {
-                            send_msg('Error: invalid response from remote server.');
-                            return;
+                var get_hashes = function () {
+                    $http(
+                        {
+                            method: 'GET',
+                            url: './' + path + '?hashes',
+                            isArray: true,
+                            jsonCallback: 'response',
+                            handleError: false
                         }
-                        if (status == 200) {
-                            send_msg(data['md5'], data['sha1']);
-                        } else { send_msg('Internal error.'); }
-                    }
-                ).error(function (data, status) {
-                        switch (status) {
-                            case 403:
-                                send_msg('Error: ' + data['message']);
-                                break;
-                            case 404:
-                                send_msg('Error: file not found.');
-                                break;
-                            default:
-                                send_msg('Internal error.');
-                                break;
+                    ).success(
+                        function (data, status, headers) {
+                            if (headers('content-type') != 'application/json') {
+                                send_msg('Error: invalid response from remote server.');
+                                return;
+                            }
+                            if (status == 200) {
+                                send_msg(data['md5'], data['sha1']);
+                            } else if (status == 202) {
+                                // the file is being hashed in background, we ask again later
+                                send_msg('Hashing...');
+                                $timeout(get_hashes, (parseInt(headers('retry-after'), 10) || 1) * 1000);
+                            } else { send_msg('Internal error.'); }
                         }
-                    }
-                )
+                    ).error(function (data, status) {
+                            switch (status) {
+                                case 403:
+                                    send_msg('Error: ' + data['message']);
+                                    break;
+                                case 404:
+                                    send_msg('Error: file not found.');
+                                    break;
+                                default:
+                                    send_msg('Internal error.');
+                                    break;
+                            }
+                        }
+                    )
+                };
+                get_hashes();
             }],
             className: 'ngdialog-theme-default',
             showClose: true,
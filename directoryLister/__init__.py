@@ -9,10 +9,38 @@ except ImportError:
 from .directory_lister import (
     DEFAULT_BODY,
     DEFAULT_CSS,
+    CompiledTemplate,
+    HiddenMatcher,
+    Entry,
+    Listing,
+    ListingCache,
+    InotifyWatcher,
+    PollingWatcher,
+    make_watcher,
+    SortedEntries,
+    DirectoryIndex,
+    HashStore,
+    HashIndexer,
+    DirectorySizes,
+    SearchIndex,
+    DirectoryArchive,
+    Metrics,
+    Span,
+    Trace,
+    RequestTracer,
     ListDirectory,
     DEFAULT_JAVASCRIPT,
     ThreadPoolWSGIServer,
+    PreforkServer,
+    SendfileServerHandler,
+    SendfileRequestHandler,
+    KeepAliveServerHandler,
+    KeepAliveRequestHandler,
+    FileRange,
     make_multithread_server,
+    EventLoopWSGIServer,
+    EventLoopConnection,
+    make_event_loop_server,
     InvalidStatusCode,
     InvalidConfigurationArgument,
     PrepareResponse,
@@ -22,10 +50,38 @@ from .directory_lister import (
 __all__ = [
     'DEFAULT_BODY',
     'DEFAULT_CSS',
+    'CompiledTemplate',
+    'HiddenMatcher',
+    'Entry',
+    'Listing',
+    'ListingCache',
+    'InotifyWatcher',
+    'PollingWatcher',
+    'make_watcher',
+    'SortedEntries',
+    'DirectoryIndex',
+    'HashStore',
+    'HashIndexer',
+    'DirectorySizes',
+    'SearchIndex',
+    'DirectoryArchive',
+    'Metrics',
+    'Span',
+    'Trace',
+    'RequestTracer',
     'ListDirectory',
     'DEFAULT_JAVASCRIPT',
     'ThreadPoolWSGIServer',
+    'PreforkServer',
+    'SendfileServerHandler',
+    'SendfileRequestHandler',
+    'KeepAliveServerHandler',
+    'KeepAliveRequestHandler',
+    'FileRange',
     'make_multithread_server',
+    'EventLoopWSGIServer',
+    'EventLoopConnection',
+    'make_event_loop_server',
     'InvalidStatusCode',
     'InvalidConfigurationArgument',
     'PrepareResponse',
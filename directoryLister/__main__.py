@@ -1,4 +1,4 @@
 from .directory_lister import main, parse_arguments
 
 if __name__ == '__main__':
-    main(**parse_arguments().__dict__)
+    main(reload_arguments=parse_arguments, **parse_arguments().__dict__)
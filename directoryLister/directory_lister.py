@@ -32,6 +32,7 @@
 # from https://github.com/RonRothman/mtwsgi/blob/master/mtwsgi.py
 
 
+import sys
 from sys import version_info
 
 if version_info <= (2, 6) or version_info.major > 2:
@@ -43,24 +44,76 @@ import sqlite3
 import socket
 import re
 import os.path
-import multiprocessing.pool
+import multiprocessing
 import mimetypes
 import json
-from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+import marshal
+import shutil
+import struct
+import tarfile
+import zlib
+import errno
+import select
+import threading
+import signal
+import traceback
+import Queue
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, deque
+from cStringIO import StringIO
+from itertools import count, chain
+from heapq import heapify, heapreplace, heappop
+from tempfile import TemporaryFile, mkdtemp
+from bisect import bisect_left, bisect_right
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler, make_server
+from wsgiref.util import FileWrapper
 from urlparse import parse_qs
 from urllib import quote, unquote
-from time import gmtime, strftime
+from time import gmtime, localtime, strftime, time, sleep
 from string import Template
+from abc import ABCMeta, abstractmethod
 from stat import *
-from os import listdir, getcwd, stat, fstat
-from operator import itemgetter
+from os import listdir, getcwd, stat, lstat, fstat
+from operator import itemgetter, attrgetter
 from math import log, floor
 from inspect import getargspec
-from hashlib import md5, sha1
-from fnmatch import fnmatch
+from hashlib import md5, new as new_hash
+from fnmatch import translate
 from Cookie import SimpleCookie
 from cgi import escape
 from argparse import ArgumentParser, FileType
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from uuid import uuid4
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # https://pypi.python.org/pypi/scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile  # https://pypi.python.org/pypi/pysendfile
+    except ImportError:
+        sendfile = None
+
+try:
+    from cProfile import Profile
+except ImportError:
+    from profile import Profile  # e.g. on PyPy
+
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1  # only available on Linux
+except (ImportError, OSError, AttributeError):
+    libc = None
 
 
 DEFAULT_BODY = """\
@@ -178,10 +231,24 @@ a { text-decoration: none; color: #0063c6 }
 a:hover { color: #02417f }
 """
 DEFAULT_JAVASCRIPT = ''
+# not defined by the `socket` module of Python 2.7
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+# the size of the blocks read from the served files when they are not sent by `sendfile`
+FILE_BLOCK_SIZE = 2**18
+# the size of the blocks read from the files to hash, and the available digests
+HASH_BLOCK_SIZE = 2**20
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512')
+# the mimetypes not compressed on the fly, as already compressed (a trailing slash matches any subtype)
+UNCOMPRESSED_MIMETYPES = (
+    'image/', 'video/', 'audio/', 'font/woff', 'font/woff2', 'application/zip', 'application/gzip',
+    'application/x-gzip', 'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed',
+    'application/x-rar-compressed', 'application/pdf', 'application/octet-stream',
+)
 ERRORS = dict(
     NOT_FOUND='Invalid file or directory',
     HASHING_DISABLED='Hashing disabled.',
-    FILE_TOO_LARGE='File is too large.'
+    FILE_TOO_LARGE='File is too large.',
+    HASHING_PENDING='The file is being hashed, retry later.',
 )
 
 
@@ -191,11 +258,64 @@ class ThreadPoolWSGIServer(WSGIServer):
         to Ron Rothman, full license available here: https://github.com/RonRothman/mtwsgi/blob/master/LICENSE.
     ----
     WSGI-compliant HTTP server. Dispatches requests to a pool of threads.
+
+    The accepted requests wait into a queue limited to `queue_size` requests. Once full, the `overload_policy` is
+    applied: `block` stops accepting the connections until a request leaves the queue, `reject` answers the new
+    request by a 503 with a `Retry-After` header, and `drop-oldest` does the same to the oldest queued request to
+    queue the new one.
     """
+    OVERLOAD_POLICIES = ('block', 'reject', 'drop-oldest')
+
     def __init__(self, thread_count=None, *args, **kwargs):
-        """If 'thread_count' == None, we'll use multiprocessing.cpu_count() threads."""
+        """
+        If 'thread_count' == None, we'll use multiprocessing.cpu_count() threads.
+        Also takes the `queue_size` (64 by default), `overload_policy` (`block` by default) and `retry_after` (the
+            number of seconds to send into the `Retry-After` header of the rejected requests, 1 by default) keywords,
+            and the `keep_alive_timeout` (15 seconds by default) and `max_keep_alive_requests` (100 by default)
+            keywords used by `KeepAliveRequestHandler`.
+        """
+        self.queue_size = kwargs.pop('queue_size', 64)
+        self.overload_policy = kwargs.pop('overload_policy', 'block')
+        self.retry_after = kwargs.pop('retry_after', 1)
+        self.reuse_port = kwargs.pop('reuse_port', False)
+        # read by `KeepAliveRequestHandler`
+        self.keep_alive_timeout = kwargs.pop('keep_alive_timeout', 15)
+        self.max_keep_alive_requests = kwargs.pop('max_keep_alive_requests', 100)
+        if self.queue_size < 1:
+            # a queue never accepting any request would block the server forever
+            raise InvalidConfigurationArgument('The queue size must be at least 1 (got %r).' % self.queue_size)
+        if self.overload_policy not in self.OVERLOAD_POLICIES:
+            raise InvalidConfigurationArgument(
+                '"%s" is not a valid overload policy (%s).' % (self.overload_policy, ', '.join(self.OVERLOAD_POLICIES)))
+        if self.reuse_port and SO_REUSEPORT is None:
+            raise InvalidConfigurationArgument('SO_REUSEPORT is not available on this platform.')
         WSGIServer.__init__(self, *args, **kwargs)
-        self.pool = multiprocessing.pool.ThreadPool(thread_count)
+
+        self.thread_count = thread_count or multiprocessing.cpu_count()
+        self.requests = deque()
+        self.condition = threading.Condition()
+        self.active = self.handled = self.rejected = self.dropped = 0
+        # the threads are started with the first request, so a server can be created before forking the processes
+        #   serving it (see `PreforkServer`).
+        self.threads = []
+
+    def server_bind(self):
+        if self.reuse_port:
+            # each process binds its own socket on the same port, the kernel balancing the connections between them
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        WSGIServer.server_bind(self)
+
+    def start_threads(self):
+        for i in range(self.thread_count):
+            thread = threading.Thread(target=self.process_requests, name='ThreadPoolWSGIServer-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def setup_environ(self):
+        WSGIServer.setup_environ(self)
+        # allows the application to read the counters of the server
+        self.base_environ['directory_lister.server'] = self
 
     # Inspired by SocketServer.ThreadingMixIn.
     def process_request_thread(self, request, client_address):
@@ -206,22 +326,1043 @@ class ThreadPoolWSGIServer(WSGIServer):
             self.handle_error(request, client_address)
             self.shutdown_request(request)
 
+    def process_requests(self):
+        while True:
+            with self.condition:
+                while not self.requests:
+                    self.condition.wait()
+                item = self.requests.popleft()
+                if item is None:  # the server is closed
+                    return
+                self.active += 1
+                self.condition.notify_all()
+            try:
+                self.process_request_thread(*item)
+            finally:
+                with self.condition:
+                    self.active -= 1
+                    self.handled += 1
+
     def process_request(self, request, client_address):
-        self.pool.apply_async(self.process_request_thread, args=(request, client_address))
+        rejected = None
+        with self.condition:
+            if not self.threads:
+                self.start_threads()
+            if len(self.requests) >= self.queue_size:
+                if self.overload_policy == 'block':
+                    while len(self.requests) >= self.queue_size:
+                        self.condition.wait()
+                elif self.overload_policy == 'reject':
+                    self.rejected += 1
+                    rejected = request
+                else:
+                    self.dropped += 1
+                    rejected = self.requests.popleft()[0]
+            if rejected is not request:
+                self.requests.append((request, client_address))
+                self.condition.notify_all()
+        if rejected is not None:
+            self.reject_request(rejected)
+
+    def reject_request(self, request):
+        """
+        Answers a request by a 503 without reading it, then closes it.
+        :param request: the client socket.
+        :return:
+        """
+        body = '503 Service Unavailable'
+        try:
+            request.settimeout(1)
+            request.sendall(
+                'HTTP/1.0 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Type: text/plain\r\n'
+                'Content-Length: %d\r\nConnection: close\r\n\r\n%s' % (self.retry_after, len(body), body))
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def counters(self):
+        """
+        Returns the number of queued requests, of requests in progress (active), of handled requests and of the
+        requests rejected or dropped by the overload policy.
+        :return:
+        """
+        with self.condition:
+            return dict(
+                threads=self.thread_count, queue_size=self.queue_size, queued=len(self.requests), active=self.active,
+                handled=self.handled, rejected=self.rejected, dropped=self.dropped,
+            )
+
+    def drain(self, timeout=None):
+        """
+        Waits until the queued and active requests are handled.
+        :param timeout: the maximal number of seconds to wait (no limit by default).
+        :return: True if all the requests were handled.
+        """
+        deadline = timeout and time() + timeout
+        with self.condition:
+            while self.requests or self.active:
+                remaining = deadline and deadline - time()
+                if deadline and remaining <= 0:
+                    return False
+                self.condition.wait(remaining or None)
+        return True
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        with self.condition:
+            self.requests.extend([None] * len(self.threads))
+            self.condition.notify_all()
+
+
+class PreforkServer(object):
+    """
+    Serves a port with several processes. The listening socket is bound once then each worker process, forked from
+    this one, runs its own server on it (or binds its own socket with SO_REUSEPORT if `reuse_port` is set).
+
+    The crashed workers are restarted. SIGTERM and SIGINT stop the workers gracefully: they stop accepting the
+    connections and finish the accepted requests. SIGHUP replaces the workers by new ones, created with a new
+    application (see `app_factory`), the old ones being stopped gracefully. SIGUSR2 is forwarded to the workers (see
+    `RequestTracer`).
+    """
+    def __init__(self, server_factory, app_factory, workers=2, reuse_port=False, graceful_timeout=30):
+        """
+        :param server_factory: a callable returning a new bound server, e.g. a `ThreadPoolWSGIServer`; called once
+            by this process, or by each worker if `reuse_port` is set.
+        :param app_factory: a callable returning the WSGI application, called by each worker.
+        :param workers: the number of worker processes.
+        :param reuse_port: must each worker bind its own socket with SO_REUSEPORT or not.
+        :param graceful_timeout: the number of seconds given to the workers to finish their requests.
+        """
+        if not hasattr(os, 'fork'):
+            raise InvalidConfigurationArgument('The worker processes require `os.fork`.')
+        self.server_factory, self.app_factory = server_factory, app_factory
+        self.workers, self.reuse_port = workers, reuse_port
+        self.graceful_timeout = graceful_timeout
+        self.server = None
+        self.children = {}  # pid -> spawn time of the current workers
+        self.retiring = set()  # pid of the workers being stopped
+        self.stopping = self.reloading = False
+        self.generation = 0  # incremented by each reload
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time()
+            return
+        try:
+            code = self.run_worker()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        os._exit(code)
+
+    def run_worker(self):
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+        # the master process handles these ones
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)  # until the application handles it
+
+        server = self.server or self.server_factory()
+        app = self.app_factory()
+        server.set_app(app)
+        thread = threading.Thread(target=server.serve_forever, name='PreforkServer.worker')
+        thread.daemon = True
+        thread.start()
+        while not stopping and thread.is_alive():
+            thread.join(0.5)  # a timeout keeps the signals handled
+        if not thread.is_alive():  # the server crashed
+            return 1
+
+        server.shutdown()
+        server.socket.close()  # the other workers keep accepting on their copy of the listening socket
+        if hasattr(server, 'drain'):
+            server.drain(self.graceful_timeout)
+        if hasattr(app, 'close'):
+            app.close()
+        return 0
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        elif signum == getattr(signal, 'SIGUSR2', None):
+            self.kill(list(self.children), signum)
+        else:
+            self.stopping = True
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if pid in self.children:
+                spawned = self.children.pop(pid)
+                if not self.stopping:
+                    print('Worker %d exited (status %d), restarting it.' % (pid, status))
+                    if time() - spawned < 1:
+                        sleep(1)  # not restarting a worker crashing at startup in a tight loop
+            self.retiring.discard(pid)
+
+    def serve_forever(self):
+        if not self.reuse_port:
+            self.server = self.server_factory()
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.handle_signal)
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, self.handle_signal)
+
+        try:
+            while not self.stopping:
+                if self.reloading:
+                    self.reloading = False
+                    self.generation += 1
+                    print('Reloading the workers...')
+                    self.retiring.update(self.children)
+                    old = list(self.children)
+                    self.children.clear()
+                    self.kill(old, signal.SIGTERM)
+                while len(self.children) < self.workers and not self.stopping:
+                    self.spawn()
+                sleep(1)  # interrupted by the signals
+                self.reap()
+        finally:
+            self.stop()
+
+    def kill(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.stopping = True
+        self.retiring.update(self.children)
+        self.children.clear()
+        self.kill(self.retiring, signal.SIGTERM)
+        deadline = time() + self.graceful_timeout + 5
+        while self.retiring and time() < deadline:
+            sleep(0.1)
+            self.reap()
+        self.kill(self.retiring, signal.SIGKILL)
+        if self.server is not None:
+            self.server.server_close()
+
+
+class SendfileServerHandler(ServerHandler):
+    """
+    Sends the `wsgi.file_wrapper` responses with `sendfile` (when available), straight from the file descriptor to the
+    client socket, instead of reading the file into strings written one after one.
+    """
+    def __init__(self, connection, *args, **kwargs):
+        """
+        :param connection: the client socket.
+        """
+        ServerHandler.__init__(self, *args, **kwargs)
+        self.connection = connection
+
+    def sendfile(self):
+        if sendfile is None:
+            return False
+        try:
+            in_fd = self.result.filelike.fileno()
+            offset = self.result.filelike.tell()
+            remaining = getattr(self.result, 'remaining', None)
+            if remaining is None:
+                remaining = fstat(in_fd)[ST_SIZE] - offset
+        except (AttributeError, IOError, OSError):  # not a real file
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+
+        out_fd = self.connection.fileno()
+        while remaining > 0:
+            try:
+                sent = sendfile(out_fd, in_fd, offset, min(remaining, 2**30))
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                # a socket with a timeout is non blocking, we wait until it can be written again
+                if not select.select([], [out_fd], [], self.connection.gettimeout())[1]:
+                    raise socket.timeout('timed out')
+                continue
+            if not sent:  # the file was truncated
+                break
+            offset += sent
+            remaining -= sent
+            self.bytes_sent += sent
+        return True
+
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    """
+    `WSGIRequestHandler` running the application through a `SendfileServerHandler`.
+    """
+    def handle(self):
+        """Handle a single HTTP request"""
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():  # An error code has been sent, just exit
+            return
+        handler = SendfileServerHandler(
+            self.connection, self.rfile, self.wfile, self.get_stderr(), self.get_environ()
+        )
+        handler.request_handler = self  # backpointer for logging
+        handler.run(self.server.get_app())
+
+
+class KeepAliveServerHandler(SendfileServerHandler):
+    """
+    `SendfileServerHandler` answering in HTTP/1.1 on a persistent connection: the responses without a
+    `Content-Length` are sent with the chunked transfer encoding to the HTTP/1.1 clients (the connection is closed
+    after them for the HTTP/1.0 ones) and the bodies of the HEAD requests are dropped.
+    """
+    http_version = '1.1'
+
+    def __init__(self, connection, keep_alive, *args, **kwargs):
+        """
+        :param connection: the client socket.
+        :param keep_alive: can the connection be kept open after the response or not, set to False by the handler
+            if it can't.
+        """
+        SendfileServerHandler.__init__(self, connection, *args, **kwargs)
+        self.keep_alive = keep_alive
+        self.chunked = self.no_body = False
+
+    def cleanup_headers(self):
+        SendfileServerHandler.cleanup_headers(self)
+        status_code = int(self.status[:3])
+        self.no_body = self.environ['REQUEST_METHOD'] == 'HEAD' or status_code in (204, 304) or status_code < 200
+        if 'Content-Length' not in self.headers and not self.no_body:
+            if self.environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                self.chunked = True
+                self.headers['Transfer-Encoding'] = 'chunked'
+            else:  # the end of the body is given by the end of the connection
+                self.keep_alive = False
+        if not self.keep_alive:
+            self.headers['Connection'] = 'close'
+        elif self.environ['SERVER_PROTOCOL'] != 'HTTP/1.1':
+            self.headers['Connection'] = 'keep-alive'
+
+    def write(self, data):
+        if not self.status:
+            raise AssertionError('write() before start_response()')
+        elif not self.headers_sent:
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent += len(data)
+        if self.no_body or not data:  # an empty chunk would end the body
+            return
+        if self.chunked:
+            data = '%x\r\n%s\r\n' % (len(data), data)
+        self._write(data)
+        self._flush()
+
+    def sendfile(self):
+        if not self.headers_sent:
+            self.send_headers()
+        if self.no_body:
+            return True
+        if self.chunked:  # iterated to be written by chunks
+            return False
+        return SendfileServerHandler.sendfile(self)
+
+    def finish_content(self):
+        SendfileServerHandler.finish_content(self)
+        if self.chunked and not self.no_body:
+            self._write('0\r\n\r\n')
+            self._flush()
+
+    def handle_error(self):
+        if self.headers_sent:  # the response is truncated
+            self.keep_alive = False
+        SendfileServerHandler.handle_error(self)
+
+
+class KeepAliveRequestHandler(SendfileRequestHandler):
+    """
+    `SendfileRequestHandler` keeping the HTTP/1.1 connections (and the HTTP/1.0 ones asking for it) open to handle
+    their next requests, pipelined or not. A connection is closed once idle for `keep_alive_timeout` seconds or after
+    `max_keep_alive_requests` requests (both read from the server, see `ThreadPoolWSGIServer`).
+    """
+    protocol_version = 'HTTP/1.1'
+    keep_alive_timeout = 15
+    max_keep_alive_requests = 100
+
+    def handle(self):
+        self.requests_count = 0
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        if self.requests_count:  # waiting for the next request
+            self.connection.settimeout(getattr(self.server, 'keep_alive_timeout', self.keep_alive_timeout))
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        self.connection.settimeout(None)
+        if not self.raw_requestline:  # the client closed the connection
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.parse_request():  # An error code has been sent, just exit
+            return
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+            if content_length < 0:
+                raise ValueError(content_length)
+        except ValueError:
+            self.send_error(400)
+            self.close_connection = 1
+            return
+
+        self.requests_count += 1
+        keep_alive = (
+            not self.close_connection and
+            self.requests_count < getattr(self.server, 'max_keep_alive_requests', self.max_keep_alive_requests) and
+            # the request bodies are not read by the application, the next request would start in the middle of it
+            not content_length and 'Transfer-Encoding' not in self.headers
+        )
+        handler = KeepAliveServerHandler(
+            self.connection, keep_alive, self.rfile, self.wfile, self.get_stderr(), self.get_environ()
+        )
+        handler.request_handler = self  # backpointer for logging
+        handler.run(self.server.get_app())
+        self.close_connection = not handler.keep_alive
+
+
+class FileRange(FileWrapper):
+    """
+    `FileWrapper` iterating over `length` bytes of a file from `offset`.
+    """
+    def __init__(self, filelike, blksize=FILE_BLOCK_SIZE, offset=0, length=None):
+        FileWrapper.__init__(self, filelike, blksize)
+        filelike.seek(offset)
+        self.remaining = length
 
+    def next(self):
+        if self.remaining is None:
+            return FileWrapper.next(self)
+        data = self.filelike.read(min(self.blksize, self.remaining)) if self.remaining > 0 else ''
+        if not data:
+            raise StopIteration
+        self.remaining -= len(data)
+        return data
 
-def make_multithread_server(host, port, app, thread_count=None, handler_class=WSGIRequestHandler):
+
+def make_multithread_server(host, port, app, thread_count=None, handler_class=SendfileRequestHandler, **kwargs):
     """
     This function from https://github.com/RonRothman/mtwsgi/blob/master/mtwsgi.py is under MIT License and
         belongs to Ron Rothman, full license available here: https://github.com/RonRothman/mtwsgi/blob/master/LICENSE.
     ----
-    Creates a new WSGI server listening on `host` and `port` for `app`
+    Creates a new WSGI server listening on `host` and `port` for `app`, the keyword arguments are given to
+    `ThreadPoolWSGIServer` (e.g. `queue_size`).
+    """
+    h = ThreadPoolWSGIServer(thread_count, (host, port), handler_class, **kwargs)
+    h.set_app(app)
+    return h
+
+
+class EventLoopConnection(object):
+    """
+    A client connection of an `EventLoopWSGIServer`: reads one request, hands it to the executor, then writes the
+    response as the client reads it and closes the connection.
+    """
+    def __init__(self, server, sock, address):
+        self.server, self.socket, self.address = server, sock, address
+        self.fd = sock.fileno()
+        self.input = ''
+        self.environ = self.content_length = None
+        # the response: the strings to write, the application iterable and its iterator, or the file to stream
+        self.output = deque()
+        self.output_offset = self.output_size = 0
+        self.result = self.iterator = self.file = None
+        self.file_fd = self.file_offset = self.file_remaining = None
+        self.done = self.pulling = self.closed = False
+        self.status = self.request_line = None
+        self.bytes_sent = 0
+        # the connection is closed when the client is idle past this time (None while the application works)
+        self.deadline = time() + server.head_timeout
+
+    def readable(self):
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                self.close()
+            return
+        if not data:
+            return self.close()
+        self.input += data
+
+        if self.environ is None:
+            end = self.input.find('\r\n\r\n')
+            if end == -1:
+                if len(self.input) > self.server.max_head_size:
+                    self.error('431 Request Header Fields Too Large')
+                return
+            head, self.input = self.input[:end], self.input[end + 4:]
+            self.request_line = head.split('\r\n', 1)[0]
+            self.environ = self.server.get_environ(head, self.address)
+            if self.environ is None:
+                return self.error('400 Bad Request')
+            try:
+                self.content_length = int(self.environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                return self.error('400 Bad Request')
+            if self.content_length > self.server.max_body_size:
+                return self.error('413 Request Entity Too Large')
+
+        if len(self.input) < self.content_length:
+            return
+        self.environ['wsgi.input'] = StringIO(self.input[:self.content_length])
+        self.input = ''
+        self.deadline = None
+        self.server.watch(self, 0)
+        self.server.submit(self.server.run_app, (self.environ,), self.respond)
+
+    def error(self, status):
+        """
+        Answers the request by an error without running the application.
+        :param status: the status line, e.g. `400 Bad Request`.
+        :return:
+        """
+        self.request_line = self.request_line or '-'
+        self.respond((status, [('Content-Type', 'text/plain'), ('Content-Length', str(len(status)))],
+                      None, None, [status], True))
+
+    def respond(self, response):
+        """
+        Called by the loop with the response of the application.
+        :param response: a `(status, headers, result, iterator, chunks, done)` tuple: the application iterable and its
+            iterator (None for a file), the already pulled strings and if the iterator is exhausted.
+        :return:
+        """
+        status, headers, self.result, self.iterator, chunks, self.done = response
+        if self.closed:  # the client left meanwhile
+            return self.close()
+        self.status = status
+
+        head = ['HTTP/1.0 %s' % status]
+        names = set()
+        for name, value in headers:
+            names.add(name.lower())
+            if name.lower() != 'connection':
+                head.append('%s: %s' % (name, value))
+        if 'date' not in names:
+            head.append('Date: %s' % formatdate(usegmt=True))
+        if 'server' not in names:
+            head.append('Server: %s' % self.server.server_software)
+        head.append('Connection: close')
+        self.write('\r\n'.join(head) + '\r\n\r\n')
+
+        if self.environ and self.environ['REQUEST_METHOD'] == 'HEAD':
+            self.done, chunks = True, []
+        elif isinstance(self.result, FileWrapper):
+            self.done, self.file = True, self.result
+            if sendfile is not None:
+                try:
+                    self.file_fd = self.file.filelike.fileno()
+                    self.file_offset = self.file.filelike.tell()
+                    self.file_remaining = getattr(self.file, 'remaining', None)
+                    if self.file_remaining is None:
+                        self.file_remaining = fstat(self.file_fd)[ST_SIZE] - self.file_offset
+                except (AttributeError, IOError, OSError):  # not a real file, read by blocks
+                    self.file_fd = None
+        for data in chunks:
+            self.write(data)
+        self.deadline = time() + self.server.timeout
+        self.writable()
+
+    def pulled(self, response):
+        """
+        Called by the loop with the next strings pulled by the executor from the application iterable.
+        :param response: a `(chunks, done)` tuple, None if the iterable raised an exception.
+        :return:
+        """
+        self.pulling = False
+        if self.closed or response is None:
+            return self.close()
+        chunks, self.done = response
+        for data in chunks:
+            self.write(data)
+        self.writable()
+
+    def write(self, data):
+        if data:
+            self.output.append(data)
+            self.output_size += len(data)
+
+    def writable(self):
+        while True:
+            if self.output:
+                data = self.output[0]
+                try:
+                    sent = self.socket.send(buffer(data, self.output_offset))
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                        break
+                    return self.close()
+                self.bytes_sent += sent
+                self.output_size -= sent
+                self.output_offset += sent
+                self.deadline = time() + self.server.timeout
+                if self.output_offset < len(data):  # the socket buffer is full
+                    break
+                self.output.popleft()
+                self.output_offset = 0
+            elif self.file is not None:
+                try:
+                    if not self.send_file():
+                        break
+                except (IOError, OSError):
+                    return self.close()
+            else:
+                break
+
+        if self.done and not self.output and self.file is None:
+            return self.close()
+        if not self.done and not self.pulling and self.output_size < FILE_BLOCK_SIZE:
+            # pulls the next strings while the client reads the current ones
+            self.pulling = True
+            self.server.submit(self.server.pull, (self.iterator,), self.pulled)
+        self.server.watch(self, select.POLLOUT if self.output or self.file is not None else 0)
+
+    def send_file(self):
+        """
+        Sends the next block of the file, with `sendfile` when available.
+        :return: False if the socket buffer is full.
+        """
+        if self.file_fd is None:
+            data = next(self.file, '')
+            if data:
+                self.write(data)
+            else:
+                self.file = None
+            return True
+        if self.file_remaining <= 0:
+            self.file = None
+            return True
+        try:
+            sent = sendfile(self.fd, self.file_fd, self.file_offset, min(self.file_remaining, 4 * FILE_BLOCK_SIZE))
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return False
+            raise
+        if not sent:  # the file was truncated
+            self.file_remaining = 0
+        self.bytes_sent += sent
+        self.file_offset += sent
+        self.file_remaining -= sent
+        self.deadline = time() + self.server.timeout
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.server.forget(self)
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            if self.status:
+                self.server.log_request(self)
+        # an iterable being pulled by the executor is closed once pulled
+        if not self.pulling and self.result is not None and hasattr(self.result, 'close'):
+            result, self.result = self.result, None
+            result.close()
+
+
+class EventLoopWSGIServer(object):
+    """
+    WSGI server multiplexing the connections of a single process on an event loop (`epoll`, or `poll`), for many
+    concurrent and slow clients without a thread per client.
+
+    The request heads are read and the responses written by the loop. The application runs on an executor of
+    `thread_count` threads: the files (`wsgi.file_wrapper`) are then streamed by the loop (with `sendfile` when
+    available) and the other bodies are pulled by the executor while the client reads them.
+    """
+    request_queue_size = 1024
+    max_head_size = 65536
+    max_body_size = 2**20
+    head_timeout = 30  # the number of seconds given to send the request head
+    timeout = 120  # the number of seconds a client can stay without reading the response
+    graceful_timeout = 30  # the number of seconds given to the connections to finish when shutting down
+    server_software = 'EventLoopWSGIServer/0.1 Python/' + sys.version.split()[0]
+
+    def __init__(self, server_address, thread_count=None, reuse_port=False):
+        """
+        :param server_address: the `(host, port)` to listen on.
+        :param thread_count: the number of threads of the executor (the number of CPUs by default).
+        :param reuse_port: must set SO_REUSEPORT on the socket or not (see `PreforkServer`).
+        """
+        if not hasattr(select, 'epoll') and not hasattr(select, 'poll'):
+            raise InvalidConfigurationArgument('The event loop requires `select.epoll` or `select.poll`.')
+        if reuse_port and SO_REUSEPORT is None:
+            raise InvalidConfigurationArgument('SO_REUSEPORT is not available on this platform.')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        host, self.server_port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+
+        self.application = None
+        self.thread_count = thread_count or multiprocessing.cpu_count()
+        self.connections = {}  # file descriptor -> EventLoopConnection
+        self.callbacks = deque()  # the results of the executor, handled by the loop
+        self.lock = threading.Lock()
+        self.active = self.handled = 0
+        # created by `serve_forever`, so a server can be created before forking the processes serving it
+        self.poller = self.executor = self.wakeup = None
+        self.stopping = False
+        self.stopped = threading.Event()
+        self.stopped.set()
+        self.base_environ = {
+            'SERVER_NAME': self.server_name, 'GATEWAY_INTERFACE': 'CGI/1.1', 'SERVER_PORT': str(self.server_port),
+            'REMOTE_HOST': '', 'CONTENT_LENGTH': '', 'SCRIPT_NAME': '', 'SERVER_SOFTWARE': self.server_software,
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+            # allows the application to read the counters of the server
+            'directory_lister.server': self,
+        }
+
+    def set_app(self, application):
+        self.application = application
+
+    def get_app(self):
+        return self.application
+
+    def get_environ(self, head, address):
+        """
+        Parses a request head into a WSGI environment.
+        :param head: the request line and headers.
+        :param address: the client address.
+        :return: the environment, None if the head is invalid.
+        """
+        lines = head.split('\r\n')
+        words = lines[0].split()
+        if len(words) != 3 or not words[2].startswith('HTTP/'):
+            return None
+        env = self.base_environ.copy()
+        env['REQUEST_METHOD'], target, env['SERVER_PROTOCOL'] = words
+        path, _, env['QUERY_STRING'] = target.partition('?')
+        env['PATH_INFO'] = unquote(path)
+        env['REMOTE_ADDR'] = address[0]
+        env['CONTENT_TYPE'] = ''
+        name = None
+        for line in lines[1:]:
+            if line[:1] in (' ', '\t') and name:  # folded header
+                env[name] += ' ' + line.strip()
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                return None
+            name, value = name.strip().replace('-', '_').upper(), value.strip()
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in env and name.startswith('HTTP_'):
+                env[name] += ',' + value
+            else:
+                env[name] = value
+        return env
+
+    def run_app(self, environ):
+        """
+        Runs the application (by the executor) and pulls the first strings of its response.
+        :return: the response given to `EventLoopConnection.respond`.
+        """
+        with self.lock:
+            self.active += 1
+        headers_set, written = [], []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is None and headers_set:
+                raise AssertionError('Headers already set!')
+            headers_set[:] = [status, headers]
+            return written.append
+
+        result = None
+        try:
+            result = self.application(environ, start_response)
+            if isinstance(result, FileWrapper):
+                return headers_set[0], headers_set[1], result, None, written, True
+            iterator = iter(result)
+            chunks, done = self.pull(iterator)  # the generators call `start_response` once started
+            if not headers_set:
+                raise AssertionError('start_response was not called.')
+            return headers_set[0], headers_set[1], result, iterator, written + chunks, done
+        except Exception:
+            traceback.print_exc()
+            if hasattr(result, 'close'):
+                result.close()
+            body = '500 Internal Server Error'
+            return body, [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))], None, None, [body], True
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.handled += 1
+
+    @staticmethod
+    def pull(iterator, size=FILE_BLOCK_SIZE):
+        """
+        Pulls at least `size` bytes from an iterator (by the executor).
+        :return: a `(chunks, done)` tuple, `done` being True if the iterator is exhausted.
+        """
+        chunks, pulled = [], 0
+        for data in iterator:
+            if data:
+                chunks.append(data)
+                pulled += len(data)
+                if pulled >= size:
+                    return chunks, False
+        return chunks, True
+
+    def submit(self, function, args, callback):
+        """
+        Calls `function(*args)` on the executor then `callback(result)` from the loop, `result` being None if the
+        function raised an exception.
+        """
+        def call():
+            try:
+                return function(*args)
+            except Exception:
+                traceback.print_exc()
+
+        self.executor.apply_async(call, callback=lambda result: self.call_soon(callback, result))
+
+    def call_soon(self, callback, argument):
+        """Calls `callback(argument)` from the loop, can be called by any thread."""
+        self.callbacks.append((callback, argument))
+        try:
+            self.wakeup[1].send('\0')
+        except socket.error:  # the buffer is full, the loop is already woken up
+            pass
+
+    def watch(self, connection, events):
+        self.poller.modify(connection.fd, events)
+
+    def forget(self, connection):
+        if self.connections.pop(connection.fd, None) is not None:
+            self.poller.unregister(connection.fd)
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR, errno.ECONNABORTED):
+                    return
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    print('Too many open files, not accepting the connections (%d clients).' % len(self.connections))
+                    return
+                raise
+            sock.setblocking(0)
+            connection = EventLoopConnection(self, sock, address)
+            self.connections[connection.fd] = connection
+            self.poller.register(connection.fd, select.POLLIN)
+
+    def log_request(self, connection):
+        sys.stderr.write('%s - - [%s] "%s" %s %d\n' % (
+            connection.address[0], strftime('%d/%b/%Y %H:%M:%S'), connection.request_line,
+            connection.status.split(' ', 1)[0], connection.bytes_sent))
+
+    def counters(self):
+        """
+        Returns the number of open connections, of requests in progress by the executor (active) and of handled
+        requests.
+        :return:
+        """
+        with self.lock:
+            return dict(
+                threads=self.thread_count, connections=len(self.connections), active=self.active,
+                handled=self.handled,
+            )
+
+    def serve_forever(self, poll_interval=0.5):
+        self.stopped.clear()
+        self.stopping = False
+        epoll = hasattr(select, 'epoll')
+        self.poller = select.epoll() if epoll else select.poll()
+        timeout = poll_interval if epoll else poll_interval * 1000
+        # written by the executor threads to wake the loop up
+        self.wakeup = socket.socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(0)
+        self.executor = ThreadPool(self.thread_count)
+        listening_fd = self.socket.fileno()
+        self.poller.register(listening_fd, select.POLLIN)
+        self.poller.register(self.wakeup[0].fileno(), select.POLLIN)
+        deadline = None
+        next_check = time() + 1
+
+        try:
+            while True:
+                if self.stopping:
+                    if deadline is None:  # stops accepting, the open connections are finished
+                        self.poller.unregister(listening_fd)
+                        deadline = time() + self.graceful_timeout
+                    if not self.connections or time() > deadline:
+                        break
+                try:
+                    events = self.poller.poll(timeout)
+                except (IOError, OSError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                for fd, mask in events:
+                    if fd == listening_fd:
+                        self.accept()
+                    elif fd == self.wakeup[0].fileno():
+                        try:
+                            while self.wakeup[0].recv(4096):
+                                pass
+                        except socket.error:
+                            pass
+                    else:
+                        connection = self.connections.get(fd)
+                        if connection is None:
+                            continue
+                        if mask & select.POLLIN:
+                            connection.readable()
+                        elif mask & select.POLLOUT:
+                            connection.writable()
+                        else:  # error or hang up
+                            connection.close()
+                while self.callbacks:
+                    callback, argument = self.callbacks.popleft()
+                    callback(argument)
+
+                now = time()
+                if now >= next_check:  # closes the idle connections
+                    next_check = now + 1
+                    for connection in self.connections.values():
+                        if connection.deadline is not None and now > connection.deadline and not connection.pulling:
+                            connection.close()
+        finally:
+            for connection in self.connections.values():
+                connection.close()
+            self.executor.terminate()
+            if epoll:
+                self.poller.close()
+            for sock in self.wakeup:
+                sock.close()
+            self.stopped.set()
+
+    def shutdown(self):
+        """Stops accepting the connections, then waits until the open ones are finished and the loop exits."""
+        self.stopping = True
+        if not self.stopped.is_set():
+            self.call_soon(lambda argument: None, None)
+            self.stopped.wait()
+
+    def drain(self, timeout=None):
+        return self.stopped.wait(timeout)
+
+    def server_close(self):
+        self.socket.close()
+
+
+def make_event_loop_server(host, port, app, thread_count=None, **kwargs):
+    """
+    Creates a new `EventLoopWSGIServer` listening on `host` and `port` for `app`, the keyword arguments are given to
+    `EventLoopWSGIServer` (e.g. `reuse_port`).
     """
-    h = ThreadPoolWSGIServer(thread_count, (host, port), handler_class)
+    h = EventLoopWSGIServer((host, port), thread_count, **kwargs)
     h.set_app(app)
     return h
 
 
+def scan_dir(path, with_stats=True):
+    """
+    Yields a `(file_name, is_dir, stats)` tuple for each entry of a directory. If `scandir` is available the type of
+    the entry comes from the cached `d_type` and only one stat is done per entry (none if `with_stats` is False, stats
+    being then None), else the entries are listed by `listdir` and stat once to get both the type and the stats.
+
+    :param path: the directory path.
+    :param with_stats: must stat the entries or not.
+    :return:
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                # `is_dir` follows the symbolic links like `os.path.isdir`, its stat is cached by the entry.
+                is_dir = entry.is_dir()
+                stats = entry.stat() if with_stats else None
+            except OSError:  # broken symbolic link
+                is_dir, stats = False, with_stats and entry.stat(follow_symlinks=False) or None
+            yield entry.name, is_dir, stats
+        return
+
+    path = [path + '/', path][path.endswith('/')]
+    for file_name in listdir(path):
+        try:
+            stats = stat(path + file_name)
+        except OSError:  # broken symbolic link
+            stats = lstat(path + file_name)
+        yield file_name, S_ISDIR(stats[ST_MODE]), stats
+
+
+def scan_visible(path, is_hidden=None, follow_links=False):
+    """
+    Yields a `(file_name, is_dir, stats)` tuple for each visible directory and regular file of a directory, as walked
+    by the background tasks: the hidden entries and the special files are skipped, like the symbolic links unless
+    `follow_links` is set (the links to directories being never followed, they could loop).
+
+    :param path: the directory path, ending by a slash.
+    :param is_hidden: a callable returning True if a file name (directory names ending by `/`) must be skipped.
+    :param follow_links: must the symbolic links to files be followed or not.
+    :return:
+    """
+    for file_name in listdir(path):
+        try:
+            stats = lstat(path + file_name)
+            if follow_links and S_ISLNK(stats[ST_MODE]):
+                stats = stat(path + file_name)
+                if S_ISDIR(stats[ST_MODE]):
+                    continue
+        except OSError:
+            continue
+        if S_ISDIR(stats[ST_MODE]):
+            if is_hidden is None or not is_hidden(file_name + '/'):
+                yield file_name, True, stats
+        elif S_ISREG(stats[ST_MODE]) and (is_hidden is None or not is_hidden(file_name)):
+            yield file_name, False, stats
+
+
 class InvalidStatusCode(BaseException):
     pass
 
@@ -323,79 +1464,2479 @@ class PrepareResponse:
 
     def send_response(self):
         status = self.status()
-        if not self.content:
+        if self.status_code in (204, 304):
+            self.content = ''  # these responses must not have a body
+            self.headers.pop('Content-Length', None)
+        elif not self.content:
             self.content = status  # if no content, we return the HTTP status
+        if isinstance(self.content, basestring):
+            # a string is sent in one piece instead of being iterated character by character
+            if self.content:
+                self.headers.setdefault('Content-Length', str(len(self.content)))
+            self.content = [self.content]
         self.start_response(self.status(), self.get_headers())
         return self.content
 
 
-class ListDirectory(object):
-    def __init__(
-            self,
-            path=getcwd(),
-            body=DEFAULT_BODY,
-            css=DEFAULT_CSS,
-            js=DEFAULT_JAVASCRIPT,
-            date_format='%Y-%m-%d %H:%M:%S',
-            binary_prefix=False,
-            allow_access_to_hidden=False,
-            hidden_files=None,
-            database=':memory:',
-            must_hash_files=True,
-            max_file_size_to_hash=2.1 * 10**8,  # 200MiB
-            keep_hashes_cache=True,
-            hide_parent=False,
-            resources_directory=None,
-    ):
-        self.error_regex = re.compile(r'{{\s*if error\s*}}(?P<CONTENT>.*?){{\s*endif\s*}}', re.S)
-        self.no_error_regex = re.compile(r'{{\s*if no error\s*}}(?P<CONTENT>.*?){{\s*endif\s*}}', re.S)
-        self.loop_regex = re.compile(r'{{\s*loop\s*}}(?P<CONTENT>.*?){{\s*endloop\s*}}', re.S)
-        self.if_file = re.compile(r'{{\s*if file\s*}}(?P<CONTENT>.*?){{\s*endif file\s*}}', re.S)
-        self.if_not_file = re.compile(r'{{\s*if not file\s*}}(?P<CONTENT>.*?){{\s*endif not file\s*}}', re.S)
+class ListingCache(object):
+    """
+    A thread-safe LRU cache of the rendered directory pages, limited by a number of entries and a total size in bytes.
+    Each page is stored with the validator of the directory it was rendered from, e.g. its `(st_mtime, st_ino)`, and
+    is only returned while the directory still has the same validator.
+    """
+    def __init__(self, max_entries=128, max_size=2**25):
+        """
+        :param max_entries: the maximal number of pages to keep.
+        :param max_size: the maximal size of all the pages (in bytes, or in the unit of the sizes given to `set`).
+        """
+        self.max_entries, self.max_size = max_entries, max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
 
-        self.css_invalid_chars = re.compile('[^_a-zA-Z\-]+[^_a-zA-Z0-9-]*')
+    def get(self, key, validator):
+        """
+        Returns the `(content, etag)` of the page, or None if not cached or outdated.
+        :param key:
+        :param validator:
+        :return:
+        """
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return
+            if item[0] != validator:  # the directory has changed since
+                self.size -= item[3]
+                self.misses += 1
+                return
+            self.entries[key] = item  # most recently used are at the end
+            self.hits += 1
+            return item[1], item[2]
 
-        self.working_path = [path + '/', path][path.endswith('/')]
-        self.body = body
-        self.date_format = date_format
-        self.binary_prefix = binary_prefix
+    def set(self, key, validator, content, etag, size=None):
+        """
+        :param size: the size of the content, its length by default.
+        """
+        size = len(content) if size is None else size
+        if size > self.max_size:
+            return
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is not None:
+                self.size -= item[3]
+            self.entries[key] = (validator, content, etag, size)
+            self.size += size
+            # dropping the least recently used pages
+            while len(self.entries) > self.max_entries or self.size > self.max_size:
+                self.size -= self.entries.popitem(last=False)[1][3]
 
-        self.resources_directory = resources_directory
+    def tee(self, key, validator, chunks):
+        """
+        Yields the chunks of a page being rendered, then caches the page once it is complete (unless it is larger than
+        the cache), its ETag being the same as if it was rendered in one piece.
+        :param chunks: the iterable of the page chunks.
+        :return:
+        """
+        content, size = [], 0
+        for data in chunks:
+            if content is not None:
+                size += len(data)
+                if size > self.max_size:
+                    content = None
+                else:
+                    content.append(data)
+            yield data
+        if content is not None:
+            content = ''.join(content)
+            self.set(key, validator, content, '"%s"' % md5(content).hexdigest())
+
+    def invalidate(self, path):
+        """
+        Drops the pages of a directory, whatever their validator.
+        :param path: the directory path, the first item of the keys.
+        :return:
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == path]:
+                self.size -= self.entries.pop(key)[3]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class DirectoryWatcher(object):
+    """
+    Watches the visited directories of the served tree to know when they change without checking them for each
+    request. Each watched directory has a generation, a number changing each time the directory (or the stats of one
+    of its entries, depending on the implementation) changes, to use as the validator of the cached pages. The
+    listeners are called with `(path, name)` on each change, `name` being the changed entry or None if the directory
+    itself changed or is no longer watched.
+
+    The least recently used directories are no longer watched once `max_watches` directories are watched, a directory
+    being used along with its parents (forgetting a directory forgets its sub-directories).
+
+    This is an abstract class: the subclasses implement `add` (and `remove`) to watch a directory and `run` to detect
+    the changes, see `InotifyWatcher` and `PollingWatcher`, `make_watcher` choosing the one available.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, root, max_watches=4096, listeners=()):
+        """
+        :param root: the served directory, ending by a slash.
+        :param max_watches: the maximal number of watched directories.
+        :param listeners: the callables called on each change.
+        """
+        self.root, self.max_watches = root, max_watches
+        self.listeners = list(listeners)
+        self.lock = threading.RLock()
+        self.watches = OrderedDict()  # path -> generation, the most recently used at the end
+        self.handles = {}  # path -> implementation data (see `add`)
+        self.generations = count(1)
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='directory-watcher')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def get(self, path):
+        """
+        Returns the generation of a watched directory, None if not watched. This doesn't make any system call.
+        :param path: the directory path, ending by a slash.
+        :return:
+        """
+        with self.lock:
+            generation = self.watches.get(path)
+            if generation is not None:
+                # its parents are used with it, else forgetting them would forget it too (see `forget`)
+                parent = path
+                while True:
+                    parent_generation = self.watches.pop(parent, None)
+                    if parent_generation is None:
+                        break
+                    self.watches[parent] = parent_generation
+                    if parent == self.root:
+                        break
+                    parent = parent[:parent.rindex('/', 0, -1) + 1]
+            return generation
+
+    def watch(self, path):
+        """
+        Starts watching a directory of the served tree (and its parents, to know when it is moved).
+        :param path: the directory path, ending by a slash.
+        :return: the generation of the directory, None if it can't be watched.
+        """
+        if self.closed or not path.startswith(self.root) or any(
+                name in ('', '.', '..') for name in path[len(self.root):].split('/')[:-1]):
+            return  # only the normalized paths are watched
+        parents = [path]
+        while parents[-1] != self.root:
+            parents.append(parents[-1][:parents[-1].rindex('/', 0, -1) + 1])
+        if len(parents) > self.max_watches:
+            return
+        with self.lock:
+            for parent in reversed(parents):
+                generation = self.watches.pop(parent, None)
+                if generation is None:
+                    try:
+                        self.handles[parent] = self.add(parent)
+                    except (OSError, IOError):
+                        return
+                    generation = next(self.generations)
+                self.watches[parent] = generation
+            while len(self.watches) > self.max_watches:
+                self.forget(next(iter(self.watches)))
+            return generation
+
+    def changed(self, path, name=None):
+        """
+        Gives a new generation to a watched directory.
+        :param path: the directory path.
+        :param name: the name of the changed entry, None if the directory itself changed.
+        :return:
+        """
+        with self.lock:
+            if path in self.watches:
+                self.watches[path] = next(self.generations)
+        self.notify(path, name)
+
+    def forget(self, path):
+        """
+        Stops watching a directory and its sub-directories, e.g. once removed or moved.
+        :param path: the directory path, ending by a slash.
+        :return:
+        """
+        with self.lock:
+            paths = [p for p in self.watches if p.startswith(path)]
+            for p in paths:
+                del self.watches[p]
+                self.remove(p, self.handles.pop(p))
+        for p in paths:
+            self.notify(p, None)
+
+    def forget_all(self):
+        self.forget(self.root)
+
+    def notify(self, path, name):
+        for listener in self.listeners:
+            try:
+                listener(path, name)
+            except Exception:
+                traceback.print_exc()
+
+    @abstractmethod
+    def add(self, path):
+        """
+        Starts watching a directory.
+        :return: the data given to `remove`.
+        :raise OSError: if the directory can't be watched.
+        """
+
+    def remove(self, path, handle):
+        """
+        Stops watching a directory, nothing to do by default.
+        :param handle: the data returned by `add`.
+        """
+
+    @abstractmethod
+    def run(self):
+        """
+        Detects the changes of the watched directories until closed, calling `changed` or `forget` (run by the
+        watcher thread).
+        """
+
+    def close(self):
+        self.closed = True
+        self.forget_all()
+
+
+class InotifyWatcher(DirectoryWatcher):
+    """
+    Watches the directories with inotify (Linux): the entries added, removed, renamed, modified or having new
+    attributes change the generation of their directory right away.
+    """
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_ISDIR = 0x4000, 0x8000, 0x1000000, 0x40000000
+    IN_NONBLOCK, IN_CLOEXEC = 0x800, 0x80000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+        IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, len, followed by the name padded with null bytes
+
+    def __init__(self, *args, **kwargs):
+        if libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        DirectoryWatcher.__init__(self, *args, **kwargs)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.paths = {}  # watch descriptor -> set of paths, a directory may be reached by several paths (symlinks)
+        self.wake_r, self.wake_w = os.pipe()
+
+    def add(self, path):
+        wd = libc.inotify_add_watch(self.fd, path, self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        self.paths.setdefault(wd, set()).add(path)
+        return wd
+
+    def remove(self, path, wd):
+        paths = self.paths.get(wd)
+        if paths is None:
+            return
+        paths.discard(path)
+        if not paths:
+            del self.paths[wd]
+            libc.inotify_rm_watch(self.fd, wd)
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        poller.register(self.wake_r, select.POLLIN)
+        while not self.closed:
+            try:
+                poller.poll()
+                data = os.read(self.fd, 2**16)
+            except (OSError, select.error) as e:
+                if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                    continue
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip('\0') or None
+                offset += length
+                self.dispatch(wd, mask, name)
+
+    def dispatch(self, wd, mask, name):
+        if mask & self.IN_Q_OVERFLOW:  # events were lost
+            self.forget_all()
+            return
+        with self.lock:
+            paths = list(self.paths.get(wd, ()))
+        for path in paths:
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                self.forget(path)
+                continue
+            if mask & self.IN_ISDIR and mask & (self.IN_MOVED_FROM | self.IN_DELETE):
+                self.forget(path + name + '/')
+            self.changed(path, name)
+
+    def close(self):
+        DirectoryWatcher.close(self)
+        os.write(self.wake_w, 'x')
+        if self.thread.is_alive():
+            self.thread.join()
+        for fd in (self.fd, self.wake_r, self.wake_w):
+            os.close(fd)
+
+
+class PollingWatcher(DirectoryWatcher):
+    """
+    Watches the directories by checking their stats every `interval` seconds, when inotify is not available: only the
+    entries added, removed or renamed change the generation of their directory, within `interval` seconds.
+    """
+    def __init__(self, root, max_watches=4096, listeners=(), interval=2.0):
+        DirectoryWatcher.__init__(self, root, max_watches, listeners)
+        self.interval = interval
+        self.wakeup = threading.Event()
+
+    @staticmethod
+    def add(path):
+        stats = stat(path)
+        if not S_ISDIR(stats[ST_MODE]):
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        return stats.st_mtime, stats.st_ctime, stats[ST_INO]
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            with self.lock:
+                handles = self.handles.items()
+            for path, validator in handles:
+                try:
+                    current = self.add(path)
+                except OSError:
+                    self.forget(path)
+                    continue
+                if current != validator:
+                    with self.lock:
+                        if path in self.handles:
+                            self.handles[path] = current
+                    self.changed(path)
+
+    def close(self):
+        DirectoryWatcher.close(self)
+        self.wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+def make_watcher(root, max_watches=4096, listeners=()):
+    """
+    Starts watching the directories with inotify, or by polling them if inotify is not available.
+    :return: the started `InotifyWatcher` or `PollingWatcher`.
+    """
+    try:
+        watcher = InotifyWatcher(root, max_watches, listeners)
+    except OSError:
+        watcher = PollingWatcher(root, max_watches, listeners)
+    return watcher.start()
+
+
+class ReverseKey(object):
+    """Reverses the order of a sorting key, for the descending merges."""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+class SortedEntries(object):
+    """
+    The rows of a listing sorted by kind (the directories first) then by key, with a bounded memory: the rows are
+    sorted by runs of `run_size` rows, the full runs being written into temporary files then merged while iterated.
+    A listing smaller than a run is simply sorted in memory.
+    """
+    KINDS = ('dirs', 'files')
+
+    def __init__(self, entries, descending=False, run_size=10000, pack=None, unpack=None):
+        """
+        :param entries: an iterable of `(kind, key, row)`, kind being `dirs` or `files`.
+        :param descending: must sort by descending keys or not, the directories staying first.
+        :param run_size: the maximal number of rows kept in memory for each kind.
+        :param pack: a callable converting a row into a value `marshal` can write, e.g. `Entry.pack`.
+        :param unpack: a callable converting it back into a row.
+        """
+        self.descending = descending
+        self.pack, self.unpack = pack, unpack
+        self.count = 0
+        self.runs = dict((kind, []) for kind in self.KINDS)  # the temporary files of the full runs
+        self.buffers = dict((kind, []) for kind in self.KINDS)  # the last run of each kind, kept in memory
+        for kind, key, row in entries:
+            buf = self.buffers[kind]
+            buf.append((key, row))
+            self.count += 1
+            if len(buf) >= run_size:
+                self.runs[kind].append(self.spill(buf))
+                self.buffers[kind] = []
+        for buf in self.buffers.values():
+            buf.sort(key=itemgetter(0), reverse=descending)
+
+    def spill(self, buf):
+        buf.sort(key=itemgetter(0), reverse=self.descending)
+        f = TemporaryFile()
+        if self.pack is None:
+            for item in buf:
+                marshal.dump(item, f)
+        else:
+            for key, row in buf:
+                marshal.dump((key, self.pack(row)), f)
+        return f
+
+    def read_run(self, f):
+        f.seek(0)
+        while True:
+            try:
+                key, row = marshal.load(f)
+            except EOFError:
+                return
+            yield key, row if self.unpack is None else self.unpack(row)
+
+    def iter_kind(self, kind):
+        """
+        Yields the sorted rows of a kind, merging the runs (a new iteration reads them again).
+        :param kind: `dirs` or `files`.
+        :return:
+        """
+        if not self.runs[kind]:
+            for _, row in self.buffers[kind]:
+                yield row
+            return
+
+        # the runs are numbered in the scanning order to keep the sorting stable
+        wrap = ReverseKey if self.descending else lambda key: key
+        heap = []
+        for n, it in enumerate([self.read_run(f) for f in self.runs[kind]] + [iter(self.buffers[kind])]):
+            for key, row in it:
+                heap.append([wrap(key), n, row, it])
+                break
+        heapify(heap)
+        while heap:
+            entry = heap[0]
+            yield entry[2]
+            for key, row in entry[3]:
+                entry[0], entry[2] = wrap(key), row
+                heapreplace(heap, entry)
+                break
+            else:
+                heappop(heap)
+
+    def rows(self):
+        """
+        Returns the `(kind, rows)` of the listing, as given to `CompiledTemplate.iter_listing`.
+        :return:
+        """
+        return [(kind, self.iter_kind(kind)) for kind in self.KINDS]
+
+    def close(self):
+        for runs in self.runs.values():
+            for f in runs:
+                f.close()
+            del runs[:]
+
+
+class DirectoryIndex(object):
+    """
+    The sorted rows of a directory, kept in cache to render any page of it without scanning and sorting it again.
+
+    The pages are given by an offset or by a cursor: an opaque string holding the sorting and the `(kind, key)` of
+    the row before (or after) the page, found back by a binary search. As the keys end by the file name, the order
+    is the same on each page and a cursor keeps its position when entries are added or removed.
+    """
+    KINDS = ('dirs', 'files')
+
+    def __init__(self, entries, sorting, descending=False):
+        """
+        :param entries: an iterable of `(kind, key, row)`, kind being `dirs` or `files`.
+        :param sorting: the sorting name, stored into the cursors.
+        :param descending: must sort by descending keys or not, the directories staying first.
+        """
+        self.sorting, self.descending = sorting, descending
+        content = dict((kind, []) for kind in self.KINDS)
+        for kind, key, row in entries:
+            content[kind].append((key, row))
+        self.entries = []  # the `(kind, key, row)` in the listing order
+        for kind in self.KINDS:
+            self.entries.extend(
+                (kind, key, row) for key, row in sorted(content[kind], key=itemgetter(0), reverse=descending))
+        self.keys = [self.sort_key(kind, key) for kind, key, _ in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sort_key(self, kind, key):
+        return self.KINDS.index(kind), ReverseKey(key) if self.descending else key
+
+    def page(self, start, end):
+        """
+        Returns the rows from `start` to `end` as a list of `(kind, row_dicts)`, as given to
+        `CompiledTemplate.render_listing`.
+        """
+        rows = []
+        for kind, _, row in self.entries[start:end]:
+            if not rows or rows[-1][0] != kind:
+                rows.append((kind, []))
+            rows[-1][1].append(row)
+        return rows
+
+    def locate(self, cursor):
+        """
+        Returns the position of the first row of the page given by a cursor.
+        :param cursor: a `(direction, kind, key, limit)` tuple given by `parse_cursor`.
+        :return:
+        """
+        direction, kind, key, limit = cursor
+        if direction == 'after':
+            return bisect_right(self.keys, self.sort_key(kind, key))
+        return max(0, bisect_left(self.keys, self.sort_key(kind, key)) - limit)
+
+    def cursor(self, position, direction):
+        """
+        Returns the cursor of the page after (or before) the row at `position`.
+        :param position:
+        :param direction: `after` or `before`.
+        :return:
+        """
+        kind, key, _ = self.entries[position]
+        # the names are not always UTF-8, each byte is kept as a character
+        key = [key[0], key[1].decode('latin-1')] if isinstance(key, tuple) else key.decode('latin-1')
+        return urlsafe_b64encode(json.dumps([direction, self.sorting, kind, key])).rstrip('=')
+
+    def parse_cursor(self, value, limit):
+        """
+        Returns a `(direction, kind, key, limit)` tuple from a cursor, None if it is invalid or was given for another
+        sorting.
+        :param value:
+        :param limit: the number of rows of the page.
+        :return:
+        """
+        try:
+            direction, sorting, kind, key = json.loads(urlsafe_b64decode(str(value) + '=' * (-len(value) % 4)))
+            if isinstance(key, list):
+                key = (key[0], key[1].encode('latin-1'))
+            else:
+                key = key.encode('latin-1')
+        except (TypeError, ValueError, IndexError, AttributeError, UnicodeError):
+            return
+        if direction not in ('after', 'before') or kind not in self.KINDS or sorting != self.sorting:
+            return
+        return direction, kind, key, limit
+
+
+class HashStore(object):
+    """
+    The hashes cache, kept into a sqlite database across the restarts. The entries are keyed on the file path and
+    only valid as long as the file has the same size, modification time and inode.
+
+    The readers use a connection per thread, the database being in WAL mode to not be blocked by the writes. The
+    writes are serialized through a single connection and committed by batch; until then they are kept in memory and
+    returned from there. An in-memory database can't be shared between connections, so it uses a single connection
+    serialized by a lock.
+    """
+    SCHEMA = """
+        -- the previous cache, it was dropped at each start anyway
+        DROP TABLE IF EXISTS files;
+        CREATE TABLE IF NOT EXISTS hashes (
+            path TEXT NOT NULL,
+            st_size INTEGER NOT NULL,
+            st_mtime REAL NOT NULL,
+            st_ino INTEGER NOT NULL,
+            hashes TEXT NOT NULL,
+            PRIMARY KEY (path)
+        );
+    """
+
+    def __init__(self, database=':memory:', batch_size=64, batch_delay=1.0):
+        """
+        :param database: the sqlite database path.
+        :param batch_size: the number of pending writes from which they are committed.
+        :param batch_delay: the maximal time (in seconds) a write is kept pending.
+        """
+        self.database = database
+        self.in_memory = database == ':memory:'
+        self.batch_size, self.batch_delay = batch_size, batch_delay
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pending = {}  # path -> ((st_size, st_mtime, st_ino), hashes), None for the hashes to delete
+        self.timer = None
+
+        self.writer = self.connect()
+        self.writer.executescript(self.SCHEMA)
+
+    def connect(self):
+        connection = sqlite3.connect(self.database, timeout=30, check_same_thread=False)
+        connection.text_factory = str
+        if not self.in_memory:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @staticmethod
+    def get_key(stats):
+        return stats[ST_SIZE], stats.st_mtime, stats[ST_INO]
+
+    def get(self, path, stats):
+        """
+        Returns the stored hashes of a file as a dict, or None if unknown or outdated.
+        :param path: the file path.
+        :param stats: the current stats of the file.
+        :return:
+        """
+        key = self.get_key(stats)
+        query = "SELECT st_size, st_mtime, st_ino, hashes FROM hashes WHERE path=?"
+        with self.lock:
+            if path in self.pending:
+                pending = self.pending[path]
+                return pending[1] if pending and pending[0] == key else None
+            if self.in_memory:
+                row = self.writer.execute(query, (path,)).fetchone()
+        if not self.in_memory:
+            connection = getattr(self.local, 'connection', None)
+            if connection is None:
+                connection = self.local.connection = self.connect()
+            row = connection.execute(query, (path,)).fetchone()
+        if row and tuple(row[:3]) == key:
+            return json.loads(row[3])
+
+    def set(self, path, stats, hashes):
+        with self.lock:
+            self.pending[path] = (self.get_key(stats), hashes) if stats is not None else None  # None to delete
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.batch_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def invalidate(self, path):
+        """
+        Deletes the hashes of a file, e.g. once modified or removed.
+        :param path: the file path.
+        :return:
+        """
+        self.set(path, None, None)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        self.writer.executemany(
+            "INSERT OR REPLACE INTO hashes(path, st_size, st_mtime, st_ino, hashes) VALUES (?, ?, ?, ?, ?)",
+            [(path,) + item[0] + (json.dumps(item[1]),) for path, item in self.pending.iteritems() if item]
+        )
+        self.writer.executemany(
+            "DELETE FROM hashes WHERE path=?", [(path,) for path, item in self.pending.iteritems() if not item])
+        self.writer.commit()
+        self.pending.clear()
+
+    def prune(self):
+        """
+        Deletes the entries of the files which no longer exist or have changed.
+        :return: the number of deleted entries.
+        """
+        self.flush()
+        outdated = []
+        with self.lock:
+            rows = self.writer.execute("SELECT path, st_size, st_mtime, st_ino FROM hashes").fetchall()
+        for row in rows:
+            try:
+                if self.get_key(stat(row[0])) != tuple(row[1:]):
+                    outdated.append((row[0],))
+            except OSError:
+                outdated.append((row[0],))
+        with self.lock:
+            self.writer.executemany("DELETE FROM hashes WHERE path=?", outdated)
+            self.writer.commit()
+        return len(outdated)
+
+    def close(self):
+        self.flush()
+
+
+def hash_path(path, algorithms, rate_limit=0):
+    """
+    Hashes a file in a worker process of the `HashIndexer`.
+    :return: a `(path, stats, hashes)` tuple, `stats` and `hashes` being None if the file couldn't be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return path, fstat(f.fileno()), ListDirectory.get_hashes(f, algorithms, rate_limit=rate_limit)
+    except (IOError, OSError):
+        return path, None, None
+
+
+def ignore_sigint():
+    # the keyboard interrupts are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class HashIndexer(object):
+    """
+    Hashes the files of the served directory ahead of time, on a pool of processes, to fill the `HashStore`.
+
+    A thread walks the directory and queues each file not hashed yet, and another one submits the queued files to the
+    pool. The files asked by the requests are queued with a higher priority, so they are hashed before the others.
+    """
+    def __init__(self, store, path, algorithms, max_file_size, is_hidden=None, processes=None, rate_limit=0):
+        """
+        :param store: the `HashStore` to fill.
+        :param path: the directory to walk.
+        :param algorithms: the digests to compute.
+        :param max_file_size: the files greater than this size (in bytes) are not hashed.
+        :param is_hidden: the hidden entries matcher (see `scan_visible`).
+        :param processes: the number of processes hashing the files, `multiprocessing.cpu_count()` by default.
+        :param rate_limit: the maximal number of bytes read per second by all the processes (0 for no limit).
+        """
+        self.store, self.path = store, path
+        self.algorithms, self.max_file_size = tuple(algorithms), max_file_size
+        self.is_hidden = is_hidden
+        self.processes = processes or multiprocessing.cpu_count()
+        self.rate_limit = rate_limit
+
+        self.lock = threading.Lock()
+        self.queue = Queue.PriorityQueue()
+        self.counter = count()
+        self.queued = {}  # path -> priority of the files waiting into the queue
+        self.in_progress = set()
+        # limits the number of files submitted to the pool, to keep the priorities meaningful
+        self.slots = threading.Semaphore(self.processes * 2)
+        self.hashed_files = self.hashed_bytes = self.failed = 0
+        self.completions = deque(maxlen=256)  # (time, size) of the last hashed files
+        self.walking = False
+        self.pool = None
+
+    def start(self):
+        self.pool = multiprocessing.Pool(self.processes, initializer=ignore_sigint)
+        for target in (self.walk, self.dispatch):
+            thread = threading.Thread(target=target, name='HashIndexer.%s' % target.__name__)
+            thread.daemon = True
+            thread.start()
+
+    def walk(self):
+        self.walking = True
+        try:
+            stack = [self.path]
+            while stack:
+                path = stack.pop()
+                try:
+                    entries = list(scan_visible(path, self.is_hidden, follow_links=True))
+                except OSError:
+                    continue
+                for file_name, is_dir, _ in entries:
+                    if is_dir:
+                        stack.append(path + file_name + '/')
+                    else:
+                        self.add(path + file_name)
+        finally:
+            self.walking = False
+
+    def add(self, path, priority=1):
+        """
+        Queues a file to hash if not already hashed or queued with a higher priority.
+        :param path:
+        :param priority: 0 for the files asked by the requests, 1 for the others.
+        :return: the file stats, or None if the file can't be hashed.
+        """
+        try:
+            stats = stat(path)
+        except OSError:
+            return
+        if not S_ISREG(stats[ST_MODE]) or stats[ST_SIZE] > self.max_file_size:
+            return
+        stored = self.store.get(path, stats)
+        if stored and all(name in stored for name in self.algorithms):
+            return stats
+        with self.lock:
+            if path in self.in_progress or self.queued.get(path, priority + 1) <= priority:
+                return stats
+            self.queued[path] = priority
+        # a file queued again with a higher priority leaves its previous entry outdated (see `dispatch`)
+        self.queue.put((priority, next(self.counter), path))
+        return stats
+
+    def request(self, path):
+        """
+        Queues a file asked by a request.
+        :param path:
+        :return: the estimated number of seconds before the file is hashed.
+        """
+        stats = self.add(path, priority=0)
+        throughput = self.get_throughput() or self.rate_limit or 5 * 10**7
+        return max(1, min(60, int(((stats and stats[ST_SIZE]) or 0) / throughput) + 1))
+
+    def dispatch(self):
+        # split between the processes, at least 1 byte per second each as 0 would remove the limit
+        rate_limit = max(1, self.rate_limit // self.processes) if self.rate_limit else 0
+        while True:
+            priority, _, path = self.queue.get()
+            with self.lock:
+                if self.queued.get(path) != priority:  # outdated entry
+                    continue
+                del self.queued[path]
+                self.in_progress.add(path)
+            self.slots.acquire()
+            self.pool.apply_async(hash_path, (path, self.algorithms, rate_limit), callback=self.done)
+
+    def done(self, result):
+        path, stats, hashes = result
+        self.slots.release()
+        if hashes:
+            stored = self.store.get(path, stats) or {}
+            stored.update(hashes)
+            self.store.set(path, stats, stored)
+        with self.lock:
+            self.in_progress.discard(path)
+            if hashes:
+                self.hashed_files += 1
+                self.hashed_bytes += stats[ST_SIZE]
+                self.completions.append((time(), stats[ST_SIZE]))
+            else:
+                self.failed += 1
+
+    def get_throughput(self):
+        """
+        Returns the number of bytes hashed per second over the last hashed files.
+        :return:
+        """
+        with self.lock:
+            if len(self.completions) < 2:
+                return 0
+            elapsed = time() - self.completions[0][0]
+            return int(sum(size for _, size in list(self.completions)[1:]) / elapsed) if elapsed > 0 else 0
+
+    def status(self):
+        throughput = self.get_throughput()
+        with self.lock:
+            return dict(
+                walking=self.walking,
+                queue_depth=len(self.queued),
+                in_progress=len(self.in_progress),
+                hashed_files=self.hashed_files,
+                hashed_bytes=self.hashed_bytes,
+                failed=self.failed,
+                throughput=throughput,
+            )
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+
+class DirectorySizes(object):
+    """
+    Aggregates the recursive size and number of files of each directory of the served tree, in a background thread,
+    to show them in the listings.
+
+    The tree is walked every `interval` seconds, but a directory is only listed again when its modification time (or
+    inode) changed since the previous walk: its own files are summed once, then the totals of the directories are
+    recomputed from the ones of their sub-directories. The files modified in place (without any entry added, removed
+    or renamed in their directory) are thus only counted again once their directory changes. The results are read
+    from memory by the requests and kept into the sqlite database across the restarts. The hidden entries, the
+    symbolic links and the special files are not counted.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS directory_sizes (
+            path TEXT NOT NULL,
+            st_mtime REAL NOT NULL,
+            st_ino INTEGER NOT NULL,
+            own_size INTEGER NOT NULL,
+            own_count INTEGER NOT NULL,
+            subdirs TEXT NOT NULL,
+            total_size INTEGER NOT NULL,
+            total_count INTEGER NOT NULL,
+            PRIMARY KEY (path)
+        );
+    """
+
+    def __init__(self, path, database=':memory:', interval=60, is_hidden=None):
+        """
+        :param path: the served directory, ending by a slash.
+        :param database: the sqlite database path.
+        :param interval: the number of seconds between the walks.
+        :param is_hidden: the hidden entries matcher (see `scan_visible`).
+        """
+        self.path, self.interval = path, interval
+        self.is_hidden = is_hidden
+        # path -> a number changing each time the total of one of its sub-directories changes, to outdate the
+        #   cached pages of this directory only
+        self.generations = {}
+        self.next_generation = count(1)
+        self.walking = False
+        self.closed = False
+        self.wakeup = threading.Event()
+
+        self.connection = sqlite3.connect(database, timeout=30, check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.executescript(self.SCHEMA)
+        # path -> (st_mtime, st_ino, own_size, own_count, subdirs, total_size, total_count), replaced after each walk
+        self.records = dict(
+            (row[0], row[1:5] + (tuple(row[5].split('/')) if row[5] else (),) + row[6:])
+            for row in self.connection.execute(
+                "SELECT path, st_mtime, st_ino, own_size, own_count, subdirs, total_size, total_count "
+                "FROM directory_sizes"))
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='DirectorySizes.run')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def get(self, path):
+        """
+        Returns the `(total_size, file_count)` of a directory, None if not known yet.
+        :param path: the directory path, ending by a slash.
+        :return:
+        """
+        record = self.records.get(path)
+        return record and record[5:]
+
+    def get_generation(self, path):
+        """
+        Returns a number changing each time the total of a sub-directory of a directory changes.
+        :param path: the directory path, ending by a slash.
+        :return:
+        """
+        return self.generations.get(path, 0)
+
+    def run(self):
+        while not self.closed:
+            try:
+                self.walk()
+            except Exception:
+                traceback.print_exc()
+            self.wakeup.wait(self.interval)
+
+    def scan(self, path):
+        """
+        Lists a directory.
+        :return: the `(own_size, own_count, subdirs)` of the directory.
+        """
+        size = files = 0
+        subdirs = []
+        for file_name, is_dir, entry_stats in scan_visible(path, self.is_hidden):
+            if is_dir:
+                subdirs.append(file_name)
+            else:
+                size += entry_stats[ST_SIZE]
+                files += 1
+        return size, files, tuple(subdirs)
+
+    def walk(self):
+        """
+        Updates the totals of the changed directories.
+        :return:
+        """
+        self.walking = True
+        try:
+            self._walk()
+        finally:
+            self.walking = False
+
+    def _walk(self):
+        previous, records, order = self.records, {}, []
+        stack = [self.path]
+        while stack:
+            if self.closed:
+                return
+            path = stack.pop()
+            try:
+                stats = stat(path)
+                record = previous.get(path)
+                if record is None or record[:2] != (stats.st_mtime, stats[ST_INO]):
+                    record = (stats.st_mtime, stats[ST_INO]) + self.scan(path) + (0, 0)
+            except OSError:
+                continue
+            records[path] = record
+            order.append(path)
+            stack.extend(path + name + '/' for name in record[4])
+
+        # the sub-directories are after their parent in `order`
+        for path in reversed(order):
+            record = records[path]
+            size, files = record[2], record[3]
+            for name in record[4]:
+                sub = records.get(path + name + '/')
+                if sub:
+                    size, files = size + sub[5], files + sub[6]
+            records[path] = record[:5] + (size, files)
+
+        changed = [(path, record) for path, record in records.iteritems() if previous.get(path) != record]
+        removed = [(path,) for path in previous if path not in records]
+        self.records = records
+        for path, record in records.iteritems():
+            for name in record[4]:
+                sub = path + name + '/'
+                if (previous.get(sub) or ())[5:] != (records.get(sub) or ())[5:]:
+                    self.generations[path] = next(self.next_generation)
+                    break
+        if changed or removed:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO directory_sizes(path, st_mtime, st_ino, own_size, own_count, subdirs, "
+                "total_size, total_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(path,) + record[:4] + ('/'.join(record[4]),) + record[5:] for path, record in changed])
+            self.connection.executemany("DELETE FROM directory_sizes WHERE path=?", removed)
+            self.connection.commit()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+
+
+class SearchIndex(object):
+    """
+    Indexes the names of the visible files and directories of the served tree into a sqlite full-text table, to find
+    them by `?search=` without walking the tree.
+
+    A background thread walks the tree every `interval` seconds, but a directory is only listed again when its
+    modification time (or inode) changed since the previous walk, its entries being then replaced in the index. The
+    directories reported as changed (see `changed`, called by the directory watcher) are listed again right away. The
+    names are split into words (`photo_2015-Summer.JPG` gives `photo 2015 summer jpg`), each searched word matching
+    the indexed words it begins. The hidden entries, the symbolic links and the special files are not indexed.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS search_directories (
+            path TEXT NOT NULL,
+            st_mtime REAL NOT NULL,
+            st_ino INTEGER NOT NULL,
+            subdirs TEXT NOT NULL,
+            PRIMARY KEY (path)
+        );
+        CREATE TABLE IF NOT EXISTS search_entries (
+            id INTEGER PRIMARY KEY,
+            directory TEXT NOT NULL,
+            name TEXT NOT NULL,
+            is_dir INTEGER NOT NULL,
+            st_size INTEGER NOT NULL,
+            st_mtime REAL NOT NULL,
+            st_ctime REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS search_entries_directory ON search_entries (directory);
+        -- the words of the names, the docid being the id of the entry
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_words USING fts4(words, prefix="2,4");
+    """
+    word_regex = re.compile(r'[0-9]+|[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[^\x00-\x7f]+')
+    # the maximal number of entries given by a search
+    MAX_RESULTS = 1000
+
+    def __init__(self, path, database=':memory:', interval=300, is_hidden=None, batch_size=256):
+        """
+        :param path: the served directory, ending by a slash.
+        :param database: the sqlite database path.
+        :param interval: the number of seconds between the walks.
+        :param is_hidden: the hidden entries matcher (see `scan_visible`).
+        :param batch_size: the number of listed directories written by a transaction.
+        """
+        self.path, self.interval, self.batch_size = path, interval, batch_size
+        self.is_hidden = is_hidden
+        self.database = database
+        self.in_memory = database == ':memory:'
+        self.walking = False
+        self.closed = False
+        self.wakeup = threading.Event()
+        self.changed_paths = set()
+        # the writes are done by the thread walking the tree, the reads use a connection per thread (see `HashStore`)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        self.writer = self.connect()
+        self.writer.executescript(self.SCHEMA)
+        # path -> (st_mtime, st_ino, subdirs), only updated by the walking thread
+        self.records = dict(
+            (row[0], (row[1], row[2], tuple(row[3].split('/')) if row[3] else ()))
+            for row in self.writer.execute("SELECT path, st_mtime, st_ino, subdirs FROM search_directories"))
+
+    def connect(self):
+        connection = sqlite3.connect(self.database, timeout=30, check_same_thread=False)
+        connection.text_factory = str
+        if not self.in_memory:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='SearchIndex.run')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    @classmethod
+    def words(cls, name):
+        """
+        Splits a name (or a search) into its lower case words.
+        :param name:
+        :return: the list of the words.
+        """
+        return [word.lower() for word in cls.word_regex.findall(name)]
+
+    def search(self, path, query, limit=100):
+        """
+        Returns the indexed entries under a directory whose name has every word of a search.
+        :param path: the directory searched, ending by a slash.
+        :param query: the searched words, e.g. `summer jpg`.
+        :param limit: the maximal number of entries.
+        :return: a list of `(relative_path, is_dir, st_size, st_mtime, st_ctime)` tuples, the path being relative to
+            the searched directory.
+        """
+        words = self.words(query)
+        if not words:
+            return []
+        # the dates were integers in the previous indexes
+        sql = ("SELECT e.directory, e.name, e.is_dir, e.st_size, CAST(e.st_mtime AS REAL), CAST(e.st_ctime AS REAL) "
+               "FROM search_words JOIN search_entries e ON e.id = search_words.docid "
+               "WHERE search_words MATCH ? AND e.directory >= ? AND e.directory < ? LIMIT ?")
+        # the paths under the directory are between `/path/` and `/path0` ('0' follows '/')
+        args = (' '.join(word + '*' for word in words), path, path[:-1] + '0', limit)
+        if self.in_memory:
+            with self.lock:
+                rows = self.writer.execute(sql, args).fetchall()
+        else:
+            connection = getattr(self.local, 'connection', None)
+            if connection is None:
+                connection = self.local.connection = self.connect()
+            rows = connection.execute(sql, args).fetchall()
+        return [(row[0][len(path):] + row[1],) + row[2:] for row in rows]
+
+    def changed(self, path):
+        """
+        Lists again a changed directory (and its new sub-directories) without waiting for the next walk.
+        :param path: the directory path, ending by a slash.
+        :return:
+        """
+        if path in self.records:
+            self.changed_paths.add(path)
+            self.wakeup.set()
+
+    def run(self):
+        last_walk = None
+        while not self.closed:
+            self.wakeup.clear()
+            try:
+                if last_walk is None or time() - last_walk >= self.interval:
+                    last_walk = time()
+                    self.walk(self.path)
+                while self.changed_paths and not self.closed:
+                    self.walk(self.changed_paths.pop())
+            except Exception:
+                traceback.print_exc()
+            self.wakeup.wait(max(0, last_walk + self.interval - time()))
+
+    def scan(self, path):
+        """
+        Lists a directory.
+        :return: the `(name, is_dir, st_size, st_mtime, st_ctime)` of its visible entries.
+        """
+        return [(file_name, int(is_dir), 0 if is_dir else entry_stats[ST_SIZE], entry_stats.st_mtime,
+                 entry_stats.st_ctime) for file_name, is_dir, entry_stats in scan_visible(path, self.is_hidden)]
+
+    def walk(self, root):
+        """
+        Indexes again the changed directories of a sub-tree.
+        :param root: the sub-tree path, ending by a slash.
+        :return:
+        """
+        self.walking = True
+        try:
+            self._walk(root)
+        finally:
+            self.walking = False
+
+    def _walk(self, root):
+        records, visited, listed = self.records, set(), []
+        stack = [root]
+        while stack:
+            if self.closed:
+                return
+            path = stack.pop()
+            try:
+                stats = stat(path)
+                record = records.get(path)
+                if record is None or record[:2] != (stats.st_mtime, stats[ST_INO]):
+                    entries = self.scan(path)
+                    record = (stats.st_mtime, stats[ST_INO], tuple(e[0] for e in entries if e[1]))
+                    listed.append((path, record, entries))
+            except OSError:
+                continue
+            records[path] = record
+            visited.add(path)
+            stack.extend(path + name + '/' for name in record[2])
+            if len(listed) >= self.batch_size:
+                self.write(listed, ())
+                listed = []
+
+        # the directories removed (or hidden) from the sub-tree since the previous walk
+        removed = [path for path in records if path.startswith(root) and path not in visited]
+        for path in removed:
+            del records[path]
+        self.write(listed, removed)
+
+    def write(self, listed, removed):
+        """
+        Replaces the entries of the listed directories and deletes the ones of the removed directories.
+        :param listed: a list of `(path, record, entries)` tuples.
+        :param removed: a list of paths.
+        :return:
+        """
+        with self.lock:
+            execute = self.writer.execute
+            for path in chain((path for path, _, _ in listed), removed):
+                execute("DELETE FROM search_words WHERE docid IN (SELECT id FROM search_entries WHERE directory=?)",
+                        (path,))
+                execute("DELETE FROM search_entries WHERE directory=?", (path,))
+            for path, record, entries in listed:
+                execute(
+                    "INSERT OR REPLACE INTO search_directories(path, st_mtime, st_ino, subdirs) VALUES (?, ?, ?, ?)",
+                    (path, record[0], record[1], '/'.join(record[2])))
+                for entry in entries:
+                    docid = execute(
+                        "INSERT INTO search_entries(directory, name, is_dir, st_size, st_mtime, st_ctime) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (path,) + entry).lastrowid
+                    execute("INSERT INTO search_words(docid, words) VALUES (?, ?)",
+                            (docid, ' '.join(self.words(entry[0]))))
+            self.writer.executemany("DELETE FROM search_directories WHERE path=?", [(path,) for path in removed])
+            self.writer.commit()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+
+
+class DirectoryArchive(object):
+    """
+    A directory and its visible content (the hidden entries being skipped, the symbolic links to directories not
+    followed) as a zip, tar or tar.gz archive built while sent: the files are read by blocks, so the memory doesn't
+    depend on their sizes (the zip central directory keeps a few bytes for each entry). The zip entries are stored
+    uncompressed unless a compression level is given, and use the ZIP64 extensions when they are larger than 4GiB.
+    """
+    # format -> (content type, extension)
+    FORMATS = OrderedDict([
+        ('zip', ('application/zip', '.zip')),
+        ('tar', ('application/x-tar', '.tar')),
+        ('tar.gz', ('application/gzip', '.tar.gz')),
+    ])
+    ZIP64_LIMIT = 0xffffffff
+
+    def __init__(self, path, name, is_hidden=None, max_size=0, compression_level=0, block_size=FILE_BLOCK_SIZE):
+        """
+        :param path: the directory path, ending by a slash.
+        :param name: the name of the directory into the archive.
+        :param is_hidden: the hidden entries matcher (see `scan_visible`).
+        :param max_size: the maximal size of the archived files (0 for no limit), the next files being skipped.
+        :param compression_level: the deflate level of the zip entries (0 to store them) and of the tar.gz archives
+            (6 if 0).
+        :param block_size: the size of the blocks read from the files.
+        """
+        self.path, self.name = path, name
+        self.is_hidden = is_hidden
+        self.max_size, self.compression_level, self.block_size = max_size, compression_level, block_size
+
+    def walk(self):
+        """
+        Yields the `(name, path, stats)` of the directory and of its visible content, the directory names ending by
+        a slash, each directory being followed by its content.
+        :return:
+        """
+        stack = [(self.path, self.name + '/')]
+        while stack:
+            path, name = stack.pop()
+            try:
+                stats = stat(path)
+                entries = sorted(scan_visible(path, self.is_hidden, follow_links=True))
+            except OSError:
+                continue
+            yield name, path, stats
+            subdirs = []
+            for file_name, is_dir, entry_stats in entries:
+                if is_dir:
+                    subdirs.append((path + file_name + '/', name + file_name + '/'))
+                else:
+                    yield name + file_name, path + file_name, entry_stats
+            stack.extend(reversed(subdirs))
+
+    def size(self):
+        """
+        Returns the total size of the files to archive, or of the first ones exceeding `max_size`.
+        :return:
+        """
+        total = 0
+        for name, _, stats in self.walk():
+            if not name.endswith('/'):
+                total += stats[ST_SIZE]
+                if self.max_size and total > self.max_size:
+                    break
+        return total
+
+    def iter_files(self):
+        """
+        Yields the `(name, stats, blocks)` of each entry to archive, `blocks` being an iterator of the file content
+        (None for the directories) stopping at the size given by its stats.
+        :return:
+        """
+        total = 0
+        for name, path, stats in self.walk():
+            if name.endswith('/'):
+                yield name, stats, None
+                continue
+            total += stats[ST_SIZE]
+            if self.max_size and total > self.max_size:
+                continue
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                continue
+            try:
+                yield name, stats, self.read_blocks(f, stats[ST_SIZE])
+            finally:
+                f.close()
+
+    def read_blocks(self, f, size):
+        while size > 0:
+            data = f.read(min(self.block_size, size))
+            if not data:
+                return
+            size -= len(data)
+            yield data
+
+    def iter_tar(self):
+        """
+        Yields the chunks of the tar archive.
+        :return:
+        """
+        offset = 0
+        for name, stats, blocks in self.iter_files():
+            info = tarfile.TarInfo(name)
+            info.mtime, info.mode = stats[ST_MTIME], S_IMODE(stats[ST_MODE])
+            if blocks is None:
+                info.type = tarfile.DIRTYPE
+            else:
+                info.size = stats[ST_SIZE]
+            header = info.tobuf(tarfile.GNU_FORMAT)
+            yield header
+            offset += len(header)
+            if blocks is None:
+                continue
+            written = 0
+            for data in blocks:
+                written += len(data)
+                yield data
+            if written < info.size:  # truncated since listed, the size of the header is kept
+                yield '\0' * (info.size - written)
+            padding = -info.size % tarfile.BLOCKSIZE
+            yield '\0' * padding
+            offset += info.size + padding
+        # two empty blocks, then the archive is padded to a full record like `tarfile` does
+        end = 2 * tarfile.BLOCKSIZE
+        yield '\0' * (end + -(offset + end) % tarfile.RECORDSIZE)
+
+    def iter_tar_gz(self):
+        compressor = zlib.compressobj(self.compression_level or 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for data in self.iter_tar():
+            data = compressor.compress(data)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    @staticmethod
+    def dos_date_time(timestamp):
+        t = localtime(max(timestamp, 315532800))  # the zip dates start in 1980
+        return (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday, t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+
+    def iter_zip(self):
+        """
+        Yields the chunks of the zip archive: each entry is written with a data descriptor after its content (its CRC
+        being known once read), then the central directory.
+        :return:
+        """
+        method = zlib.DEFLATED if self.compression_level else 0
+        central, offset = [], 0
+        for name, stats, blocks in self.iter_files():
+            is_dir = blocks is None
+            size = 0 if is_dir else stats[ST_SIZE]
+            # the deflated data can be slightly larger than the file
+            zip64 = size >= self.ZIP64_LIMIT - 2**24
+            try:
+                name.decode('utf-8')
+                flags = 0x808  # data descriptor, UTF-8 name
+            except UnicodeError:
+                flags = 0x8
+            entry_method = 0 if is_dir else method
+            date, time_ = self.dos_date_time(stats[ST_MTIME])
+            version = 45 if zip64 else 20
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else ''
+            header = struct.pack(
+                '<IHHHHHIIIHH', 0x04034b50, version, flags, entry_method, time_, date, 0,
+                self.ZIP64_LIMIT if zip64 else 0, self.ZIP64_LIMIT if zip64 else 0, len(name), len(extra)
+            ) + name + extra
+            yield header
+
+            crc = compressed = uncompressed = 0
+            compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS) \
+                if entry_method else None
+            for data in blocks or ():
+                crc = zlib.crc32(data, crc)
+                uncompressed += len(data)
+                if compressor:
+                    data = compressor.compress(data)
+                compressed += len(data)
+                if data:
+                    yield data
+            if compressor:
+                data = compressor.flush()
+                compressed += len(data)
+                yield data
+            crc &= 0xffffffff
+            yield struct.pack('<IIQQ' if zip64 else '<IIII', 0x08074b50, crc, compressed, uncompressed)
+
+            central.append((name, flags, entry_method, time_, date, crc, compressed, uncompressed, offset,
+                            stats[ST_MODE], is_dir))
+            offset += len(header) + compressed + (24 if zip64 else 16)
+
+        # the central directory
+        start = offset
+        for name, flags, entry_method, time_, date, crc, compressed, uncompressed, entry_offset, mode, is_dir \
+                in central:
+            fields = [value for value in (uncompressed, compressed, entry_offset) if value >= self.ZIP64_LIMIT]
+            extra = struct.pack('<HH%dQ' % len(fields), 1, 8 * len(fields), *fields) if fields else ''
+            record = struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | 45, 45 if fields else 20, flags, entry_method, time_,
+                date, crc, min(compressed, self.ZIP64_LIMIT), min(uncompressed, self.ZIP64_LIMIT), len(name),
+                len(extra), 0, 0, 0, (S_IMODE(mode) | (S_IFDIR if is_dir else S_IFREG)) << 16 | (0x10 if is_dir else 0),
+                min(entry_offset, self.ZIP64_LIMIT)
+            ) + name + extra
+            yield record
+            offset += len(record)
+
+        entries, size = len(central), offset - start
+        if entries >= 0xffff or size >= self.ZIP64_LIMIT or start >= self.ZIP64_LIMIT:
+            yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 3 << 8 | 45, 45, 0, 0, entries, entries, size, start)
+            yield struct.pack('<IIQI', 0x07064b50, 0, offset, 1)
+        yield struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(entries, 0xffff), min(entries, 0xffff), min(size, self.ZIP64_LIMIT),
+            min(start, self.ZIP64_LIMIT), 0)
+
+    def iter_archive(self, archive_format):
+        """
+        :param archive_format: `zip`, `tar` or `tar.gz`.
+        :return: a generator of the archive chunks.
+        """
+        return {'zip': self.iter_zip, 'tar': self.iter_tar, 'tar.gz': self.iter_tar_gz}[archive_format]()
 
-        self.hidden = hidden_files or []
-        self.allow_access_to_hidden = allow_access_to_hidden
+
+class Metrics(object):
+    """
+    The counters and histograms of the application, exposed in the Prometheus text format by `/?metrics`.
+
+    Each thread writes into its own shard (a dict of counters and a dict of histograms) without taking any lock, the
+    shards being only summed when the metrics are exposed. The shards of the finished threads are kept, so the totals
+    never decrease.
+
+    The worker processes sharing a socket (see `PreforkServer`) count their own requests but answer the scrapes in
+    turn, so they merge their metrics through a shared `directory`: each one writes its totals into its own file every
+    `interval` seconds (and before answering a scrape), and the process answering a scrape sums the counters and the
+    histograms of every file, the ones of the exited workers included, so the totals still never decrease. The gauges
+    of the running workers are exposed apart, labelled by their `pid`.
+    """
+    LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+    ENTRIES_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+
+    # name -> (type, help), in the exposed order
+    FAMILIES = OrderedDict([
+        ('requests_total', ('counter', 'The handled requests, by route and status code.')),
+        ('request_duration_seconds', (
+            'histogram', 'The time spent to build the responses, by route (the streamed bodies are sent afterwards).')),
+        ('response_bytes_total', ('counter', 'The size of the response bodies, by route.')),
+        ('listing_entries', ('histogram', 'The number of entries scanned by each directory listing.')),
+        ('cache_requests_total', ('counter', 'The lookups into the caches, by cache and result (hit or miss).')),
+        ('cache_entries', ('gauge', 'The number of entries kept by the caches.')),
+        ('cache_bytes', ('gauge', 'The size of the entries kept by the caches.')),
+        ('server_threads', ('gauge', 'The number of threads handling the requests.')),
+        ('server_queue_size', ('gauge', 'The maximal number of queued requests.')),
+        ('server_queued', ('gauge', 'The number of queued requests, waiting for a thread.')),
+        ('server_active', ('gauge', 'The number of requests in progress (the busy threads).')),
+        ('server_connections', ('gauge', 'The number of open connections.')),
+        ('server_handled_total', ('counter', 'The requests handled by the server.')),
+        ('server_rejected_total', ('counter', 'The requests rejected by the overload policy.')),
+        ('server_dropped_total', ('counter', 'The requests dropped by the overload policy.')),
+        ('hashing_queued', ('gauge', 'The number of files waiting to be hashed in background.')),
+        ('hashing_in_progress', ('gauge', 'The number of files being hashed in background.')),
+        ('hashing_files_total', ('counter', 'The files hashed, by mode (by the requests or in background).')),
+        ('hashing_bytes_total', ('counter', 'The bytes hashed, by mode (by the requests or in background).')),
+        ('hashing_seconds_total', ('counter', 'The time spent by the requests to hash the files.')),
+        ('hashing_failures_total', ('counter', 'The files which could not be hashed in background.')),
+        ('hashing_throughput_bytes', ('gauge', 'The number of bytes hashed per second over the last hashed files.')),
+    ])
+    BUCKETS = dict(request_duration_seconds=LATENCY_BUCKETS, listing_entries=ENTRIES_BUCKETS)
+
+    def __init__(self, prefix='directory_lister_', directory=None, interval=1):
+        """
+        :param prefix: the prefix of the exposed names.
+        :param directory: the directory merging the metrics of the worker processes, None for a single process.
+        :param interval: the number of seconds between the writes of the metrics into `directory`.
+        """
+        self.prefix = prefix
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()  # only taken to add a shard and to read them
+        self.directory, self.interval = directory, interval
+        # a reused pid doesn't overwrite the file of an exited worker
+        self.file_name = 'metrics-%d-%d' % (os.getpid(), time() * 1000)
+        self.write_lock = threading.Lock()
+        self.closed = False
+
+    def start(self, sampler):
+        """
+        Writes the metrics into `directory` every `interval` seconds, for the scrapes answered by the other workers.
+        :param sampler: a callable returning the samples given to `render`.
+        :return:
+        """
+        def run():
+            while not self.closed:
+                try:
+                    self.write(*self.collect(sampler()))
+                except Exception:
+                    traceback.print_exc()
+                sleep(self.interval)
+        thread = threading.Thread(target=run, name='Metrics.write')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = ({}, {})  # (labels, name) -> value, (labels, name) -> buckets + [count, sum]
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def count(self, name, labels=(), value=1):
+        """
+        Increments a counter.
+        :param name: e.g. `requests_total`.
+        :param labels: a tuple of `(label, value)` pairs.
+        :param value:
+        :return:
+        """
+        counters = self.shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """
+        Counts a value into a histogram.
+        :param name: e.g. `request_duration_seconds`, its buckets being given by `BUCKETS`.
+        :param labels: a tuple of `(label, value)` pairs.
+        :param value:
+        :return:
+        """
+        histograms = self.shard()[1]
+        key = (name, labels)
+        histogram = histograms.get(key)
+        buckets = self.BUCKETS[name]
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(buckets) + 2)
+        histogram[bisect_left(buckets, value)] += 1  # the last bucket is +Inf
+        histogram[-1] += value
+
+    def iter_observed(self, items, name, labels):
+        """
+        Yields the items of an iterable, then counts their number into a histogram.
+        :param items:
+        :param name: e.g. `listing_entries`.
+        :param labels:
+        :return:
+        """
+        number = 0
+        try:
+            for item in items:
+                number += 1
+                yield item
+        finally:
+            self.observe(name, labels, number)
+
+    def iter_counted(self, chunks, labels):
+        """
+        Yields the chunks of a streamed response, then counts their size into `response_bytes_total`.
+        :param chunks: the iterable of the response body.
+        :param labels:
+        :return:
+        """
+        size = 0
+        try:
+            for data in chunks:
+                size += len(data)
+                yield data
+        finally:
+            self.count('response_bytes_total', labels, size)
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def render(self, samples=()):
+        """
+        Returns the metrics in the Prometheus text format.
+        :param samples: the values known out of the shards, as `(name, labels, value)` tuples.
+        :return:
+        """
+        values, histograms = self.collect(samples)
+        if self.directory:
+            self.write(values, histograms)
+            values, histograms = self.merge()
+
+        lines = []
+        for name, (kind, description) in self.FAMILIES.iteritems():
+            if name not in values and name not in histograms:
+                continue
+            full_name = self.prefix + name
+            lines.append('# HELP %s %s' % (full_name, description))
+            lines.append('# TYPE %s %s' % (full_name, kind))
+            for labels, value in sorted(values.get(name, {}).iteritems()):
+                lines.append('%s%s %s' % (full_name, self.format_labels(labels), self.format_value(value)))
+            for labels, histogram in sorted(histograms.get(name, {}).iteritems()):
+                cumulated = 0
+                for bound, value in zip(self.BUCKETS[name] + ('+Inf',), histogram):
+                    cumulated += value
+                    lines.append('%s_bucket%s %d' % (
+                        full_name, self.format_labels(labels + (('le', str(bound)),)), cumulated))
+                lines.append('%s_sum%s %s' % (
+                    full_name, self.format_labels(labels), self.format_value(histogram[-1])))
+                lines.append('%s_count%s %d' % (full_name, self.format_labels(labels), cumulated))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def collect(self, samples=()):
+        """
+        Sums the shards of the threads of this process.
+        :param samples: see `render`.
+        :return: the `(values, histograms)`, as `name -> labels -> value` and `name -> labels -> buckets + [sum]`.
+        """
+        values, histograms = {}, {}
+        with self.lock:
+            shards = list(self.shards)
+        for counters, shard_histograms in shards:
+            for (name, labels), value in counters.items():  # items() copies the dict atomically
+                values.setdefault(name, {})
+                values[name][labels] = values[name].get(labels, 0) + value
+            for (name, labels), histogram in shard_histograms.items():
+                total = histograms.setdefault(name, {}).setdefault(labels, [0] * len(histogram))
+                for i, value in enumerate(list(histogram)):
+                    total[i] += value
+        for name, labels, value in samples:
+            values.setdefault(name, {})[labels] = value
+        return values, histograms
+
+    def write(self, values, histograms):
+        """
+        Writes the metrics of this process into `directory`, replacing its previous file at once.
+        :param values: see `collect`.
+        :param histograms: see `collect`.
+        :return:
+        """
+        path = os.path.join(self.directory, self.file_name)
+        with self.write_lock:
+            with open(path + '.tmp', 'wb') as f:
+                marshal.dump((values, histograms), f)
+            os.rename(path + '.tmp', path)
+
+    def merge(self):
+        """
+        Sums the metrics written into `directory` by every process (see `write`), the gauges being only kept for the
+        running processes, labelled by their pid.
+        :return: the `(values, histograms)` of every process, see `collect`.
+        """
+        files = {}  # pid -> its file names by creation time, the last one being the running process (if any)
+        file_names = [name for name in listdir(self.directory) if name.startswith('metrics-') and '.' not in name]
+        for file_name in sorted(file_names, key=lambda name: int(name.split('-')[2])):
+            files.setdefault(int(file_name.split('-')[1]), []).append(file_name)
+
+        values, histograms = {}, {}
+        for pid, file_names in files.iteritems():
+            try:
+                os.kill(pid, 0)
+                running = True
+            except OSError as e:
+                running = e.errno == errno.EPERM
+            for file_name in file_names:
+                try:
+                    with open(os.path.join(self.directory, file_name), 'rb') as f:
+                        process_values, process_histograms = marshal.load(f)
+                except (IOError, OSError, EOFError, ValueError, TypeError):
+                    continue
+                current = running and file_name == file_names[-1]
+                for name, series in process_values.iteritems():
+                    merged = values.setdefault(name, {})
+                    if self.FAMILIES.get(name, ('gauge',))[0] != 'gauge':
+                        for labels, value in series.iteritems():
+                            merged[labels] = merged.get(labels, 0) + value
+                    elif current:
+                        for labels, value in series.iteritems():
+                            merged[(('pid', pid),) + labels] = value
+                for name, series in process_histograms.iteritems():
+                    merged = histograms.setdefault(name, {})
+                    for labels, histogram in series.iteritems():
+                        total = merged.setdefault(labels, [0] * len(histogram))
+                        for i, value in enumerate(histogram):
+                            total[i] += value
+        return values, histograms
+
+    def close(self):
+        self.closed = True
+
+    @staticmethod
+    def format_value(value):
+        # the floats keep all their digits and the longs are written without their L
+        return repr(value) if isinstance(value, float) else str(value)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for label, value in labels)
+
+
+class Span(object):
+    """
+    Times a phase of a traced request, used as a context manager (see `ListDirectory.span`).
+    """
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace, self.name = trace, name
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.name, time() - self.start)
+
+
+class NullSpan(object):
+    """
+    The span of the requests which are not traced, doing nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Trace(object):
+    """
+    The spans of a request: the total duration and the number of times of each phase.
+    """
+    __slots__ = ('environ', 'start', 'spans', 'status')
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.start = time()
+        self.spans = OrderedDict()  # name -> [duration, count]
+        self.status = None
+
+    def add(self, name, duration):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [duration, 1]
+        else:
+            span[0] += duration
+            span[1] += 1
+
+    def timed(self, name, function):
+        """
+        Returns a function calling `function` and adding its duration to a span, e.g. to time a check done for each
+        entry of a listing.
+        """
+        def timed_function(*args):
+            start = time()
+            try:
+                return function(*args)
+            finally:
+                self.add(name, time() - start)
+        return timed_function
+
+    def format(self):
+        environ = self.environ
+        return '%s %s%s %s %.1fms: %s' % (
+            environ['REQUEST_METHOD'], environ['PATH_INFO'],
+            '?' + environ['QUERY_STRING'] if environ.get('QUERY_STRING') else '', (self.status or '-')[:3],
+            (time() - self.start) * 1000, ' '.join(
+                '%s=%.1fms%s' % (name, duration * 1000, '/%d' % count if count > 1 else '')
+                for name, (duration, count) in self.spans.iteritems()))
+
+
+class RequestTracer(object):
+    """
+    Traces the requests: the duration of their phases is recorded into spans (see `ListDirectory.span`), and the
+    requests slower than `slow_threshold` are logged with their spans. The body of the responses is timed while sent
+    as the `write` span, except for the files sent with `sendfile`.
+
+    The requests can also be profiled with cProfile on demand: `arm(count)` profiles the next `count` requests, each
+    profile being written into `profile_directory` (readable by `pstats`).
+    """
+    def __init__(self, slow_threshold=1.0, profile_directory=None, log=None):
+        """
+        :param slow_threshold: the duration (in seconds) from which a request is logged, 0 to not log them.
+        :param profile_directory: the directory of the profiles, None to not profile the requests.
+        :param log: the file of the slow requests log, stderr by default.
+        """
+        self.slow_threshold = slow_threshold
+        self.profile_directory = profile_directory
+        self.log = log or sys.stderr
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.profiles_left = 0
+        self.profiled = count(1)
+
+    def current(self):
+        """
+        Returns the `Trace` of the request handled by the current thread, None if none.
+        """
+        return getattr(self.local, 'trace', None)
+
+    def arm(self, requests=1):
+        """
+        Profiles the next requests.
+        :param requests: the number of requests to profile.
+        :return:
+        """
+        if self.profile_directory:
+            with self.lock:
+                self.profiles_left += requests
+
+    def take_profiler(self):
+        if not self.profiles_left:  # read without lock, as nearly always 0
+            return
+        with self.lock:
+            if self.profiles_left <= 0:
+                return
+            self.profiles_left -= 1
+        return Profile()
+
+    def trace(self, environ, start_response, application):
+        """
+        Calls a WSGI application into a new trace.
+        :param environ:
+        :param start_response:
+        :param application:
+        :return: the response body.
+        """
+        trace = self.local.trace = Trace(environ)
+        profiler = self.take_profiler()
+
+        def traced_start_response(status, headers, exc_info=None):
+            trace.status = status
+            return start_response(status, headers, exc_info)
+
+        result = None
+        if profiler:
+            profiler.enable()
+        try:
+            result = application(environ, traced_start_response)
+        finally:
+            if profiler:
+                profiler.disable()
+            self.local.trace = None
+            if result is None:  # an exception was raised
+                self.finish(trace, profiler)
+        trace.add('respond', time() - trace.start)
+
+        # the files are kept as they are, to be sent with `sendfile`
+        if hasattr(result, 'filelike'):
+            self.finish(trace, profiler)
+            return result
+        return self.iter_traced(trace, profiler, result)
+
+    def iter_traced(self, trace, profiler, chunks):
+        """
+        Yields the chunks of a response body, timed as the `write` span, then ends its trace.
+        """
+        start = time()
+        self.local.trace = trace  # e.g. the streamed pages are rendered while sent
+        if profiler:
+            profiler.enable()
+        try:
+            for data in chunks:
+                yield data
+        finally:
+            if profiler:
+                profiler.disable()
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.local.trace = None
+            trace.add('write', time() - start)
+            self.finish(trace, profiler)
+
+    def finish(self, trace, profiler=None):
+        """
+        Logs a request if slow and writes its profile.
+        """
+        if self.slow_threshold and time() - trace.start >= self.slow_threshold:
+            self.log.write('Slow request: %s\n' % trace.format())
+            self.log.flush()
+        if profiler:
+            path = os.path.join(self.profile_directory, '%s-%d-%d.prof' % (
+                strftime('%Y%m%d-%H%M%S', gmtime()), os.getpid(), next(self.profiled)))
+            try:
+                profiler.dump_stats(path)
+            except (IOError, OSError):
+                traceback.print_exc()
+            else:
+                self.log.write('Profile of %s written into %s\n' % (trace.format(), path))
+                self.log.flush()
+
+
+class CompiledTemplate(object):
+    """
+    The HTML body parsed once into static chunks and placeholders.
+
+    The `{{ if error }}`, `{{ if no error }}`, `{{ loop }}`, `{{ if file }}` and `{{ if not file }}` blocs are
+    resolved at compile time, so rendering a page only joins the precomputed pieces and each row of the listing is a
+    single `%` formatting of a precomputed format string.
+    """
+    error_regex = re.compile(r'{{\s*if error\s*}}(?P<CONTENT>.*?){{\s*endif\s*}}', re.S)
+    no_error_regex = re.compile(r'{{\s*if no error\s*}}(?P<CONTENT>.*?){{\s*endif\s*}}', re.S)
+    loop_regex = re.compile(r'{{\s*loop\s*}}(?P<CONTENT>.*?){{\s*endloop\s*}}', re.S)
+    if_file = re.compile(r'{{\s*if file\s*}}(?P<CONTENT>.*?){{\s*endif file\s*}}', re.S)
+    if_not_file = re.compile(r'{{\s*if not file\s*}}(?P<CONTENT>.*?){{\s*endif not file\s*}}', re.S)
+    loop_marker = re.compile('\0LOOP(\\d+)\0')
+
+    # the tokens given by each row of the listing (see `ListDirectory.list_dir`)
+    ROW_TOKENS = frozenset([
+        'FILE_NAME', 'FILE_LINK', 'FILE_MODIFICATION', 'FILE_CREATION',
+        'FILE_TYPE', 'FILE_SIZE', 'FILE_MIMETYPE', 'DASHED_FILE_MIMETYPE', 'DIR_TOTAL_SIZE', 'DIR_FILE_COUNT',
+    ])
+
+    def __init__(self, body):
+        """
+        :param body: the HTML template (e.g. `DEFAULT_BODY`).
+        """
+        # the error page: error blocs are kept and the no error blocs are removed
+        self.error_pieces = self.split(
+            self.no_error_regex.sub('', self.error_regex.sub(self.get_content, body)))
+
+        # the listing page: the no error blocs are kept, the error blocs are removed and each loop is replaced by a
+        #   marker to split the page around it.
+        loops = []
+
+        def mark_loops(obj):
+            def mark(l_obj):
+                loops.append(l_obj.group('CONTENT'))
+                return '\0LOOP%d\0' % (len(loops) - 1)
+            return self.loop_regex.sub(mark, obj.group('CONTENT'))
+        listing = self.error_regex.sub('', self.no_error_regex.sub(mark_loops, body))
+
+        # a list of static pieces lists and loops, a loop being a dict of pieces for each kind of row.
+        self.listing_segments = []
+        for i, chunk in enumerate(self.loop_marker.split(listing)):
+            if i % 2:
+                content = loops[int(chunk)]
+                dirs = self.split(self.if_file.sub('', self.if_not_file.sub(self.get_content, content)))
+                files = self.split(self.if_not_file.sub('', self.if_file.sub(self.get_content, content)))
+                self.listing_segments.append(dict(dirs=dirs, files=files))
+            elif chunk:
+                self.listing_segments.append(self.split(chunk))
+
+        # all the tokens used by the rows, useful to know what we really need to compute for each entry.
+        self.row_tokens = frozenset(
+            name for segment in self.listing_segments if isinstance(segment, dict)
+            for pieces in segment.values() for _, name in pieces if name in self.ROW_TOKENS
+        )
+
+    @staticmethod
+    def get_content(match_obj):
+        return match_obj.group('CONTENT')
+
+    @staticmethod
+    def split(text):
+        """
+        Splits a text into a list of `(text, name)` pieces following the `string.Template` syntax: `name` is None for
+        a static chunk, or the token name for a placeholder, `text` being then the placeholder as it was written (kept
+        as is if the token is unknown, like `string.Template.safe_substitute` does).
+        :param text:
+        :return:
+        """
+        pieces, position = [], 0
+        for obj in Template.pattern.finditer(text):
+            if obj.start() > position:
+                pieces.append((text[position:obj.start()], None))
+            name = obj.group('named') or obj.group('braced')
+            if name is not None:
+                pieces.append((obj.group(), name))
+            else:  # escaped ($$) or invalid
+                pieces.append(('$' if obj.group('escaped') is not None else obj.group(), None))
+            position = obj.end()
+        if position < len(text):
+            pieces.append((text[position:], None))
+        return pieces
+
+    @staticmethod
+    def join(pieces, keys):
+        return ''.join([text if name is None else keys.get(name, text) for text, name in pieces])
+
+    def row_format(self, pieces, keys):
+        """
+        Returns a `%` format string of a row where the page tokens are already substituted and the row tokens are
+        kept as `%(TOKEN)s`.
+        :param pieces: the pieces of a kind of row.
+        :param keys: the page tokens.
+        :return:
+        """
+        return ''.join([
+            '%%(%s)s' % name if name in self.ROW_TOKENS else
+            (text if name is None else keys.get(name, text)).replace('%', '%%')
+            for text, name in pieces
+        ])
+
+    def render_error(self, keys):
+        return self.join(self.error_pieces, keys)
+
+    def render_listing(self, keys, rows, parent=None):
+        """
+        :param keys: the page tokens.
+        :param rows: a list of `(kind, row_dicts)` where kind is `dirs` or `files`.
+        :param parent: the row dict of the parent directory, or None to not show it.
+        :return:
+        """
+        return ''.join(self.iter_listing(keys, rows, parent, chunk_size=None))
+
+    def iter_listing(self, keys, rows, parent=None, chunk_size=2**16):
+        """
+        Yields the listing page by chunks: the static pieces as soon as they are reached, then the rows of each loop
+        by chunks of about `chunk_size` bytes.
+        :param keys: the page tokens.
+        :param rows: a list of `(kind, row_dicts)` where kind is `dirs` or `files`, or a callable returning it for
+            each loop (e.g. `SortedEntries.rows`) when the rows can only be iterated once.
+        :param parent: the row dict of the parent directory, or None to not show it.
+        :param chunk_size: the minimal size of the yielded rows chunks, None to yield them all at once.
+        :return:
+        """
+        for segment in self.listing_segments:
+            if not isinstance(segment, dict):
+                yield self.join(segment, keys)
+                continue
+            content, size = [], 0
+            if parent:
+                parent_keys = keys.copy()
+                parent_keys.update(parent)
+                content.append(self.join(segment['dirs'], parent_keys))
+            for kind, row_dicts in rows() if callable(rows) else rows:
+                row_format = self.row_format(segment[kind], keys)
+                if chunk_size is None:
+                    content.extend([row_format % r for r in row_dicts])
+                    continue
+                for r in row_dicts:
+                    row = row_format % r
+                    content.append(row)
+                    size += len(row)
+                    if size >= chunk_size:
+                        yield ''.join(content)
+                        content, size = [], 0
+            if content:
+                yield ''.join(content)
+
+
+class HiddenMatcher(object):
+    """
+    Tells if a name matches one of the hidden patterns (case-sensitive UNIX filename patterns, the directory names
+    ending by a slash). The patterns are compiled once: the literal names are looked up in a set, the `*suffix`
+    patterns checked by a single `str.endswith` and the others by a single regex combining them.
+    """
+    magic = re.compile('[*?[]')
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.literals = set()
+        suffixes, regexes = [], []
+        for pattern in self.patterns:
+            if not self.magic.search(pattern):
+                self.literals.add(pattern)
+            elif pattern.startswith('*') and not self.magic.search(pattern[1:]):
+                suffixes.append(pattern[1:])
+            else:
+                regex = translate(pattern)
+                regexes.append(regex[:-len('\\Z(?ms)')] if regex.endswith('\\Z(?ms)') else regex)
+        self.suffixes = tuple(suffixes)
+        self.regex = re.compile('(?ms)(?:%s)\\Z' % '|'.join(regexes)).match if regexes else None
+
+    def __nonzero__(self):
+        return bool(self.patterns)
+
+    def __call__(self, name):
+        """
+        :param name: the file name, or the directory name followed by a slash.
+        :return: True if the name must be hidden.
+        """
+        return name in self.literals or name.endswith(self.suffixes) or (
+            self.regex is not None and self.regex(name) is not None)
+
+    def hides_path(self, path, is_dir):
+        """
+        Tells if a path is hidden by one of its components: its parent directories or its last name.
+        :param path: the path relative to the served directory, e.g. `/some/directory/file.txt`.
+        :param is_dir: is the last name a directory or a file.
+        :return:
+        """
+        if not self.patterns:
+            return False
+        names = [name for name in path.split('/') if name]
+        for name in names[:-1]:
+            if self(name + '/'):
+                return True
+        return bool(names) and self(names[-1] + '/' if is_dir else names[-1])
+
+
+class Entry(object):
+    """
+    A listed entry keeping the raw values of its stats. Its row tokens (see `CompiledTemplate.ROW_TOKENS`) are only
+    formatted when the template asks them, e.g. by `row_format % entry`.
+    """
+    __slots__ = ('name', 'is_dir', 'size', 'mtime', 'ctime', 'listing')
+
+    def __init__(self, name, is_dir, size, mtime, ctime, listing):
+        """
+        :param name: the file name.
+        :param is_dir:
+        :param size: the `st_size` of the entry, None if not stat (like the dates).
+        :param mtime: the `st_mtime` of the entry, as an integer (a float for the JSON rows and the search results).
+        :param ctime: the `st_ctime` of the entry, as an integer (a float for the JSON rows and the search results).
+        :param listing: the `Listing` of the entry.
+        """
+        self.name, self.is_dir, self.size, self.mtime, self.ctime, self.listing = \
+            name, is_dir, size, mtime, ctime, listing
+
+    def __getitem__(self, token):
+        return self.tokens[token](self)
+
+    def pack(self):
+        """
+        Returns the raw values of the entry, written by `SortedEntries` (see `Listing.unpack`).
+        """
+        return self.name, self.is_dir, self.size, self.mtime, self.ctime
+
+    def mimetype(self):
+        return self.listing.app.mimetypes_list.get(os.path.splitext(self.name)[1]) or 'application/octet-stream'
+
+    def file_name(self):
+        return escape(self.name)
+
+    def file_link(self):
+        # we keep the current query string on directories link
+        return quote(self.name) + '/' + self.listing.end_url if self.is_dir else quote(self.name)
+
+    def file_modification(self):
+        return self.listing.app.format_date(self.mtime) if self.mtime is not None else ''
+
+    def file_creation(self):
+        return self.listing.app.format_date(self.ctime) if self.ctime is not None else ''
+
+    def file_type(self):
+        return 'dir' if self.is_dir else 'file %s' % filter(None, self.mimetype().split('/'))[0]
+
+    def file_size(self):
+        if self.is_dir:
+            return '-'
+        return self.listing.app.convert_size(self.size) if self.size is not None else ''
+
+    def file_mimetype(self):
+        return '-' if self.is_dir else self.mimetype()
+
+    def dashed_file_mimetype(self):
+        return '-' if self.is_dir else self.listing.app.dashed_mimetype(self.mimetype())
+
+    def dir_total_size(self):
+        if not self.is_dir:
+            return ''
+        total = self.listing.app.get_directory_size(self.listing.path, self.name)
+        return self.listing.app.convert_size(total[0]) if total else '-'
+
+    def dir_file_count(self):
+        if not self.is_dir:
+            return ''
+        total = self.listing.app.get_directory_size(self.listing.path, self.name)
+        return str(total[1]) if total else '-'
+
+    tokens = dict(
+        FILE_NAME=file_name,
+        FILE_LINK=file_link,
+        FILE_MODIFICATION=file_modification,
+        FILE_CREATION=file_creation,
+        FILE_TYPE=file_type,
+        FILE_SIZE=file_size,
+        FILE_MIMETYPE=file_mimetype,
+        DASHED_FILE_MIMETYPE=dashed_file_mimetype,
+        DIR_TOTAL_SIZE=dir_total_size,
+        DIR_FILE_COUNT=dir_file_count,
+    )
+
+
+class Listing(object):
+    """
+    What the entries of a directory listing share: the application formatting them, the directory path and the query
+    string kept by the links.
+    """
+    __slots__ = ('app', 'path', 'end_url')
+
+    def __init__(self, app, path, end_url=''):
+        self.app, self.path, self.end_url = app, path, end_url
+
+    def entry(self, file_name, is_dir, stats):
+        if stats is None:
+            return Entry(file_name, is_dir, None, None, None, self)
+        return Entry(file_name, is_dir, stats[ST_SIZE], stats[ST_MTIME], stats[ST_CTIME], self)
+
+    def unpack(self, values):
+        return Entry(*values + (self,))
+
+
+class ListDirectory(object):
+    def __init__(
+            self,
+            path=getcwd(),
+            body=DEFAULT_BODY,
+            css=DEFAULT_CSS,
+            js=DEFAULT_JAVASCRIPT,
+            date_format='%Y-%m-%d %H:%M:%S',
+            binary_prefix=False,
+            allow_access_to_hidden=False,
+            hidden_files=None,
+            database=':memory:',
+            must_hash_files=True,
+            max_file_size_to_hash=2.1 * 10**8,  # 200MiB
+            keep_hashes_cache=True,
+            hide_parent=False,
+            resources_directory=None,
+            skip_unneeded_stat=True,
+            listing_cache_entries=128,
+            listing_cache_size=2**25,  # 32MiB
+            hash_algorithms=('md5', 'sha1'),
+            background_hashing=False,
+            hashing_processes=None,
+            hashing_rate_limit=0,
+            stream_listings=False,
+            sort_run_size=10000,
+            page_size=0,
+            index_cache_entries=16,
+            compression_level=6,
+            compression_min_size=1024,
+            uncompressed_mimetypes=UNCOMPRESSED_MIMETYPES,
+            watch_directories=False,
+            max_watches=4096,
+            directory_sizes=False,
+            directory_sizes_interval=60,
+            archive_max_size=2**32,  # 4GiB
+            archive_compression_level=0,
+            search_index=False,
+            search_index_interval=300,
+            metrics=False,
+            metrics_allowed_addresses=('127.0.0.1', '::1'),
+            metrics_directory=None,
+            slow_request_threshold=0,
+            profile_directory=None,
+    ):
+        self.css_invalid_chars = re.compile('[^_a-zA-Z\-]+[^_a-zA-Z0-9-]*')
+
+        self.working_path = [path + '/', path][path.endswith('/')]
+        self.body = body
+        self.template = CompiledTemplate(body)
+        self.date_format = date_format
+        self.formatted_dates = {}  # timestamp -> date (see `format_date`)
+        self.dashed_mimetypes = {}
+        self.binary_prefix = binary_prefix
+
+        self.resources_directory = resources_directory
+
+        self.hidden = hidden_files or []
+        self.allow_access_to_hidden = allow_access_to_hidden
 
         self.hide_parent = hide_parent
+        self.skip_unneeded_stat = skip_unneeded_stat
+        self.stream_listings = stream_listings
+        self.sort_run_size = sort_run_size
+        self.page_size = page_size
+        self.archive_max_size = archive_max_size
+        self.archive_compression_level = archive_compression_level
+
+        if listing_cache_entries and listing_cache_size:
+            self.listing_cache = ListingCache(listing_cache_entries, listing_cache_size)
+        else:
+            self.listing_cache = None
+        # the sorted rows of the directories, to render their pages (see `list_page`)
+        if index_cache_entries and listing_cache_size:
+            self.index_cache = ListingCache(index_cache_entries, listing_cache_size)
+        else:
+            self.index_cache = None
 
         self.must_hash, self.keep_hashes_cache = must_hash_files, keep_hashes_cache
         self.max_file_size_to_hash = max_file_size_to_hash
+        for name in hash_algorithms:
+            if name not in HASH_ALGORITHMS:
+                raise InvalidConfigurationArgument(
+                    '"%s" is not an available hash algorithm (%s).' % (name, ', '.join(HASH_ALGORITHMS)))
+        self.hash_algorithms = tuple(hash_algorithms)
 
         self.css = css
         self.js = js
 
+        # the responses are compressed if the client accepts it, unless the compression level is 0
+        self.compression_level = compression_level
+        self.compression_min_size = compression_min_size
+        self.uncompressed_mimetypes = tuple(uncompressed_mimetypes)
+        # the stylesheet and the javascript are compressed once
+        self.compressed_assets = {}
+        if self.compression_level:
+            for name, content in (('css', css), ('js', js)):
+                if content and len(content) >= self.compression_min_size:
+                    for encoding in ('gzip', 'deflate'):
+                        self.compressed_assets[name, encoding] = self.compress(content, encoding)
+
         if self.must_hash and self.keep_hashes_cache:
-            self.sqlite_connection = sqlite3.connect(database, check_same_thread=False)
-            self.sqlite_connection.text_factory = str
-            self.cursor = self.sqlite_connection.cursor()
-            self.cursor.executescript(
-                """
-                    drop table if exists files;
-                    CREATE TABLE if not exists files (
-                        path TEXT NOT NULL,
-                        st_mtime INTEGER NOT NULL,
-                        hashes VARCHAR NOT NULL,
-                        PRIMARY KEY (path)
-                    );
-                """
-            )
+            self.hash_store = HashStore(database)
+        else:
+            self.hash_store = None
+
+        self.is_hidden = HiddenMatcher(self.hidden)  # returns True if must be hidden or False if not.
+
+        # the visited directories are watched to know they are unchanged without stat them
+        if watch_directories:
+            self.watcher = make_watcher(self.working_path, max_watches, listeners=[self.invalidate])
+        else:
+            self.watcher = None
+
+        # the recursive sizes of the directories, computed in background
+        if directory_sizes:
+            self.directory_sizes = DirectorySizes(
+                self.working_path, database, directory_sizes_interval, is_hidden=self.is_hidden).start()
+        else:
+            self.directory_sizes = None
+
+        # the names of the entries of the tree, indexed in background for `?search=`
+        if search_index:
+            self.search_index = SearchIndex(
+                self.working_path, database, search_index_interval, is_hidden=self.is_hidden).start()
+        else:
+            self.search_index = None
 
-        self.is_hidden = lambda file_name: True if filter(None, [fnmatch(file_name, pat) for pat in self.hidden]) \
-            else False  # returns True if must be hidden or False if not.
+        if background_hashing:
+            if not self.hash_store:
+                raise InvalidConfigurationArgument(
+                    'The background hashing requires the hashing and the hashes cache to be enabled.')
+            self.hash_indexer = HashIndexer(
+                self.hash_store, self.working_path, self.hash_algorithms, self.max_file_size_to_hash,
+                is_hidden=self.is_hidden, processes=hashing_processes, rate_limit=hashing_rate_limit)
+            self.hash_indexer.start()
+        else:
+            self.hash_indexer = None
+
+        # the requests are counted and timed for `/?metrics`, only answered to the allowed addresses (`*` for all)
+        #   (the worker processes merge their metrics through `metrics_directory`, see `Metrics`)
+        self.metrics = Metrics(directory=metrics_directory) if metrics else None
+        self.metrics_allowed_addresses = frozenset(metrics_allowed_addresses)
+        self.metrics_server = None  # the server of the requests, for the metrics written in background
+        if self.metrics and metrics_directory:
+            self.metrics.start(lambda: self.get_metrics_samples({}))
+
+        # the phases of the requests are timed to log the slow ones, and the requests can be profiled on demand (by
+        #   `/?profile=N` or SIGUSR2)
+        if profile_directory and not os.path.isdir(profile_directory):
+            raise InvalidConfigurationArgument('"%s" is not a valid directory.' % profile_directory)
+        if slow_request_threshold or profile_directory:
+            self.tracer = RequestTracer(slow_request_threshold, profile_directory)
+        else:
+            self.tracer = None
+        if profile_directory and hasattr(signal, 'SIGUSR2'):
+            try:
+                signal.signal(signal.SIGUSR2, lambda signum, frame: self.tracer.arm(10))
+            except ValueError:  # not in the main thread
+                pass
 
         mimetypes.init()
         self.mimetypes_list = mimetypes.types_map.copy()
 
+    # the tokens which require to stat each entry of the listing
+    STAT_TOKENS = frozenset(['FILE_SIZE', 'FILE_MODIFICATION', 'FILE_CREATION'])
+    # the tokens showing the totals of the sub-directories (see `DirectorySizes`)
+    SIZE_TOKENS = frozenset(['DIR_TOTAL_SIZE', 'DIR_FILE_COUNT'])
+
     def __call__(self, environ, start_response):
+        if self.tracer:
+            return self.tracer.trace(environ, start_response, self.count_request)
+        return self.count_request(environ, start_response)
+
+    def count_request(self, environ, start_response):
+        """
+        Calls `respond`, counting and timing the request into the metrics if enabled.
+        """
+        if not self.metrics:
+            return self.respond(environ, start_response)
+        if self.metrics_server is None:
+            self.metrics_server = environ.get('directory_lister.server')
+
+        start, sent = time(), []
+
+        def counted_start_response(status, headers, exc_info=None):
+            sent[:] = [status, headers]
+            return start_response(status, headers, exc_info)
+
+        try:
+            result = self.respond(environ, counted_start_response)
+        except Exception:
+            sent[:] = ['500', ()]
+            raise
+        finally:
+            # the kind of request, set by `respond`
+            labels = (('route', environ.get('directory_lister.route', 'other')),)
+            self.metrics.count('requests_total', labels + (('code', sent[0][:3] if sent else '500'),))
+            self.metrics.observe('request_duration_seconds', labels, time() - start)
+
+        length = next((value for name, value in sent[1] if name.lower() == 'content-length'), None)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            self.metrics.count('response_bytes_total', labels, 0)
+        elif length is not None:
+            self.metrics.count('response_bytes_total', labels, int(length))
+        elif isinstance(result, list):
+            self.metrics.count('response_bytes_total', labels, sum(len(data) for data in result))
+        else:  # streamed
+            result = self.metrics.iter_counted(result, labels)
+        return result
+
+    def respond(self, environ, start_response):
         # plain text by default.
         response = PrepareResponse(
             start_response,
@@ -427,18 +3968,60 @@ class ListDirectory(object):
         if environ['PATH_INFO'] == '/':
             # /?css
             if 'css' in parsed_qs:
+                environ['directory_lister.route'] = 'asset'
                 response.add_headers(
                     {'Content-Type': 'text/css', 'Cache-Control': 'max-age=172800, proxy-revalidate'})
                 response.content = self.css
-                return response.send_response()
+                return self.send_asset(environ, response, 'css')
             # /?js
             elif 'js' in parsed_qs:
+                environ['directory_lister.route'] = 'asset'
                 response.add_headers(
                     {'Content-Type': 'text/javascript', 'Cache-Control': 'max-age=172800, proxy-revalidate'})
                 response.content = self.js
+                return self.send_asset(environ, response, 'js')
+            # /?hashing-status
+            elif 'hashing-status' in parsed_qs and self.hash_indexer:
+                environ['directory_lister.route'] = 'status'
+                response.add_headers({'Content-Type': 'application/json', 'Cache-Control': 'no-cache'})
+                response.content = json.dumps(self.hash_indexer.status())
+                return response.send_response()
+            # /?server-status
+            elif 'server-status' in parsed_qs and 'directory_lister.server' in environ:
+                environ['directory_lister.route'] = 'status'
+                response.add_headers({'Content-Type': 'application/json', 'Cache-Control': 'no-cache'})
+                response.content = json.dumps(environ['directory_lister.server'].counters())
+                return response.send_response()
+            # /?metrics
+            elif 'metrics' in parsed_qs and self.metrics:
+                environ['directory_lister.route'] = 'metrics'
+                if not self.is_address_allowed(environ):
+                    response.status_code = 403
+                    return response.send_response()
+                response.add_headers({'Content-Type': 'text/plain; version=0.0.4', 'Cache-Control': 'no-cache'})
+                response.content = self.metrics.render(self.get_metrics_samples(environ))
+                return response.send_response()
+            # /?profile=N
+            elif 'profile' in parsed_qs and self.tracer and self.tracer.profile_directory:
+                environ['directory_lister.route'] = 'status'
+                if not self.is_address_allowed(environ):
+                    response.status_code = 403
+                    return response.send_response()
+                try:
+                    requests = int(parsed_qs['profile'][0] or 1)
+                except ValueError:
+                    requests = 0
+                if requests <= 0:
+                    response.status_code = 400
+                    return response.send_response()
+                self.tracer.arm(requests)
+                response.add_headers({'Content-Type': 'application/json', 'Cache-Control': 'no-cache'})
+                response.content = json.dumps(
+                    {'profiled_requests': self.tracer.profiles_left, 'directory': self.tracer.profile_directory})
                 return response.send_response()
             # /?get
             elif 'get' in parsed_qs and self.resources_directory:
+                environ['directory_lister.route'] = 'get'
                 # %2F
                 file_name = unquote(parsed_qs['get'][0])
                 # prevent access to parent directories
@@ -446,23 +4029,21 @@ class ListDirectory(object):
                     response.status_code = 400
                     return response.send_response()
                 path = self.resources_directory + file_name
+                encoding = self.negotiate_encoding(
+                    environ, response, self.mimetypes_list.get(os.path.splitext(path)[1]) or 'application/octet-stream')
+                # a `.gz` sibling is sent as is
+                precompressed = encoding == 'gzip' and os.path.isfile(path + '.gz')
                 try:
-                    f = open(path, 'rb')
+                    f = open(path + '.gz' if precompressed else path, 'rb')
                 except IOError:
                     pass
                 else:
                     try:
-                        stats = fstat(f.fileno())
-                        response.add_headers(
-                            {
-                                "Content-Type": self.mimetypes_list.get(os.path.splitext(path)[1]) or 'application/octet-stream',
-                                "Content-Length": str(stats[ST_SIZE]),
-                                "Last-Modified": str(stats[ST_MTIME]),
-                            }
-                        )
-                        response.content = f
-                        return response.send_response()
-                    except IOError:
+                        if not precompressed and (
+                                fstat(f.fileno())[ST_SIZE] < self.compression_min_size or 'HTTP_RANGE' in environ):
+                            encoding = None
+                        return self.send_file(environ, response, path, f, encoding, precompressed)
+                    except (IOError, OSError):
                         f.close()
 
         path = self.working_path + environ['PATH_INFO'][1:]
@@ -475,6 +4056,13 @@ class ListDirectory(object):
             SORTING_CREATION='asc',
             SORTING_SIZE='asc',
             SORTING_NAME='asc',
+            SORTING_TOTAL_SIZE='asc',
+            # only known by the paginated pages
+            NEXT_PAGE='',
+            PREV_PAGE='',
+            TOTAL_ENTRIES='',
+            # only known by the search pages
+            SEARCH_QUERY='',
         )
         if cookies_allowed:
             template.update(
@@ -483,6 +4071,7 @@ class ListDirectory(object):
                     TOGGLE_SORTING_CREATION='?sort=ST_CTIME.ASC',
                     TOGGLE_SORTING_SIZE='?sort=ST_SIZE.ASC',
                     TOGGLE_SORTING_NAME='?sort=NAME.ASC',
+                    TOGGLE_SORTING_TOTAL_SIZE='?sort=TOTAL_SIZE.ASC',
                 )
             )
         else:
@@ -492,6 +4081,7 @@ class ListDirectory(object):
                     TOGGLE_SORTING_CREATION='?sort=ST_CTIME.ASC&no-cookies',
                     TOGGLE_SORTING_SIZE='?sort=ST_SIZE.ASC&no-cookies',
                     TOGGLE_SORTING_NAME='?sort=NAME.ASC&no-cookies',
+                    TOGGLE_SORTING_TOTAL_SIZE='?sort=TOTAL_SIZE.ASC&no-cookies',
                 )
             )
 
@@ -518,6 +4108,7 @@ class ListDirectory(object):
                 ST_CTIME=('TOGGLE_SORTING_CREATION', 'SORTING_CREATION'),
                 ST_SIZE=('TOGGLE_SORTING_SIZE', 'SORTING_SIZE'),
                 NAME=('TOGGLE_SORTING_NAME', 'SORTING_NAME'),
+                TOTAL_SIZE=('TOGGLE_SORTING_TOTAL_SIZE', 'SORTING_TOTAL_SIZE'),
             )
             template[_available_sorting.get(_sorting[0])[0]] = '?sort=%s.%s%s' % (
                 _sorting[0] if _sorting[0] in _available_sorting.keys() else 'NAME',
@@ -528,9 +4119,23 @@ class ListDirectory(object):
             del _available_sorting
         del _sorting
 
-        template['END_URL'] = (not cookies_allowed and ('?' + environ['QUERY_STRING']) or '')
+        # the position into the pages (and the search) is not kept by the links to the other directories
+        template['END_URL'] = (not cookies_allowed and ('?' + '&'.join(
+            q for q in environ['QUERY_STRING'].split('&')
+            if q.split('=', 1)[0] not in ('offset', 'cursor', 'search'))) or '')
 
-        if os.path.isdir(path):
+        # a watched directory is known to exist and to be unchanged since its generation, without stat it
+        generation = self.watcher.get(path) if self.watcher else None
+        path_stats = None
+        if generation is None:
+            with self.span('stat'):
+                try:
+                    path_stats = stat(path)
+                except OSError:
+                    pass
+
+        if generation is not None or path_stats and S_ISDIR(path_stats[ST_MODE]):
+            environ['directory_lister.route'] = 'listing'
             if not path.endswith('/'):
                 response.status_code = 301
                 response.add_headers(
@@ -543,33 +4148,101 @@ class ListDirectory(object):
 
             # If directory is hidden and if the direct access is not allowed,
             #   we return Forbidden but we don't show, we just say "Invalid file or directory"
-            if not self.allow_access_to_hidden:
-                f = filter(None, environ['PATH_INFO'].split('/'))
-                if f and self.is_hidden(f[-1]):
-                    response.status_code = 404
-                    response.content = Template(
-                        self.rendering_error(ERROR_MESSAGE=ERRORS['NOT_FOUND'])).safe_substitute(**template)
+            if not self.allow_access_to_hidden and self.is_hidden.hides_path(environ['PATH_INFO'], True):
+                response.status_code = 404
+                response.content = self.rendering_error(ERROR_MESSAGE=ERRORS['NOT_FOUND'], **template)
+                return response.send_response()
+
+            # ?archive=zip|tar|tar.gz
+            archive_format = parsed_qs.get('archive', [None])[0]
+            if archive_format is not None and self.archive_max_size:
+                environ['directory_lister.route'] = 'archive'
+                return self.send_archive(environ, response, path, archive_format)
+
+            # ?search=WORDS&limit=INT, as HTML or with &format=json
+            if 'search' in parsed_qs and self.search_index:
+                environ['directory_lister.route'] = 'search'
+                try:
+                    limit = int(parsed_qs['limit'][0]) if 'limit' in parsed_qs else 100
+                except ValueError:
+                    limit = 0
+                if limit <= 0:
+                    response.status_code = 400
                     return response.send_response()
-            response.content = Template(
-                self.list_dir(path=path, sorting=current_sorting, end_url=template['END_URL'])
-            ).safe_substitute(**template)
-            return response.send_response()
+                # the escaped query string is not the searched text
+                query = parse_qs(environ['QUERY_STRING'], True)['search'][0]
+                return self.send_search(
+                    environ, response, path, query, current_sorting, limit,
+                    parsed_qs.get('format', [None])[0] == 'json', **template)
+
+            # the rendered page is reused as long as the directory was not modified (or replaced)
+            cache_key = (path, current_sorting, template['END_URL'], cookies_allowed)
+            if generation is None and self.watcher:
+                generation = self.watcher.watch(path)  # None if it can't be watched
+            if generation is not None:
+                validator = ('watched', generation)
+            else:
+                validator = (path_stats.st_mtime, path_stats.st_ctime, path_stats[ST_INO])
+            # the pages showing (or sorted by) the totals of the sub-directories are outdated when one of them changes
+            if self.directory_sizes and (current_sorting.lower().startswith('total_size')
+                                         or self.template.row_tokens & self.SIZE_TOKENS):
+                validator += (self.directory_sizes.get_generation(path),)
+
+            # ?format=json or ?format=ndjson
+            output_format = parsed_qs.get('format', [None])[0]
+            if output_format in ('json', 'ndjson'):
+                return self.send_json_listing(
+                    environ, response, path, validator, current_sorting, output_format == 'ndjson')
+
+            # ?offset=INT&limit=INT or ?cursor=CURSOR&limit=INT
+            if self.page_size or 'offset' in parsed_qs or 'limit' in parsed_qs or 'cursor' in parsed_qs:
+                try:
+                    limit = int(parsed_qs['limit'][0]) if 'limit' in parsed_qs else self.page_size or 100
+                    offset = int(parsed_qs['offset'][0]) if 'offset' in parsed_qs else 0
+                except ValueError:
+                    limit = offset = -1
+                content = limit > 0 and offset >= 0 and self.list_page(
+                    path=path, validator=validator, sorting=current_sorting, offset=offset,
+                    cursor=unquote(parsed_qs['cursor'][0]) if 'cursor' in parsed_qs else None, limit=limit,
+                    page_query='' if cookies_allowed else '&sort=%s&no-cookies' % current_sorting,
+                    end_url=template['END_URL'], **template)
+                if not content:  # invalid limit, offset or cursor
+                    response.status_code = 400
+                    return response.send_response()
+                return self.send_content(environ, response, content, '"%s"' % md5(content).hexdigest())
+
+            with self.span('cache'):
+                cached = self.listing_cache.get(cache_key, validator) if self.listing_cache else None
+            if cached:
+                content, etag = cached
+            elif self.stream_listings:
+                # the page is sent while rendered, without ETag as its content is not known yet
+                content = self.iter_list_dir(
+                    path=path, sorting=current_sorting, end_url=template['END_URL'], **template)
+                if self.listing_cache and not isinstance(content, basestring):
+                    content = self.listing_cache.tee(cache_key, validator, content)
+                return self.send_content(environ, response, content)
+            else:
+                content = self.list_dir(
+                    path=path, sorting=current_sorting, end_url=template['END_URL'], **template)
+                with self.span('etag'):
+                    etag = '"%s"' % md5(content).hexdigest()
+                if self.listing_cache:
+                    self.listing_cache.set(cache_key, validator, content, etag)
+            return self.send_content(environ, response, content, etag, cache_key, validator)
 
+        environ['directory_lister.route'] = 'hashes' if 'hashes' in parsed_qs else 'file'
         # If file is hidden and if the direct access is not allowed,
         #   we return Forbidden but we don't show, we just say "Invalid file or directory"
-        if not self.allow_access_to_hidden:
-            _path = os.path.split(path)
-            if _path and self.is_hidden(_path[-1]):
-                response.status_code = 404
-                response.content = Template(
-                    self.rendering_error(ERROR_MESSAGE=ERRORS['NOT_FOUND'])).safe_substitute(**template)
-                return response.send_response()
+        if not self.allow_access_to_hidden and self.is_hidden.hides_path(environ['PATH_INFO'], False):
+            response.status_code = 404
+            response.content = self.rendering_error(ERROR_MESSAGE=ERRORS['NOT_FOUND'], **template)
+            return response.send_response()
         try:
             f = open(path, 'rb')
         except IOError:
             response.status_code = 404
-            response.content = Template(
-                self.rendering_error(ERROR_MESSAGE=ERRORS['NOT_FOUND'])).safe_substitute(**template)
+            response.content = self.rendering_error(ERROR_MESSAGE=ERRORS['NOT_FOUND'], **template)
             return response.send_response()
 
         if 'hashes' in parsed_qs:
@@ -579,34 +4252,455 @@ class ListDirectory(object):
             #       - {'message': 'File is too large.', 'code': 1}
             #    - a 404 if the file is not found (returned in the above code)
             #    - a 200 with a JSON content if the file exists and if hashing is authorized
+            #    - a 202 with a Retry-After header if the file is not hashed yet by the background hashing:
+            #       - {'message': 'The file is being hashed, retry later.', 'code': 2}
             response.add_headers({'Content-Type': 'application/json'})
             if not self.must_hash:
                 response.status_code = 403
                 response.content = '{"message": "%s",  "code": 0}' % ERRORS['HASHING_DISABLED']
                 return response.send_response()
 
-            content = self.hash_file(path, f)
-            if not content:
+            try:
+                content = self.hash_file(path, f, compute=not self.hash_indexer)
+            finally:
+                f.close()
+            if content is False:
+                response.status_code = 202
+                response.add_headers({'Retry-After': str(self.hash_indexer.request(path))})
+                response.content = '{"message": "%s",  "code": 2}' % ERRORS['HASHING_PENDING']
+            elif not content:
                 response.status_code = 403
                 response.content = '{"message": "%s",  "code": 1}' % ERRORS['FILE_TOO_LARGE']
             else:
                 response.content = content
             return response.send_response()
         try:
-            stats = fstat(f.fileno())
-            response.add_headers(
-                {
-                    "Content-Type": self.mimetypes_list.get(os.path.splitext(path)[1]) or 'application/octet-stream',
-                    "Content-Length": str(stats[ST_SIZE]),
-                    "Last-Modified": str(stats[ST_MTIME]),
-                }
-            )
-            response.content = f
+            return self.send_file(environ, response, path, f)
         except:
             f.close()
             raise
+
+    def send_archive(self, environ, response, path, archive_format):
+        """
+        Sends a directory as an archive built while sent, answering by a 400 if the format is unknown or by a 413 if
+        its files are larger than `archive_max_size`.
+        :param environ:
+        :param response: the `PrepareResponse` to send.
+        :param path: the directory path, ending by a slash.
+        :param archive_format: `zip`, `tar` or `tar.gz`.
+        :return:
+        """
+        response.add_headers({'Content-Type': 'text/plain'})
+        if archive_format not in DirectoryArchive.FORMATS:
+            response.status_code = 400
+            return response.send_response()
+        # the served directory is named after its own name
+        name = os.path.basename(path.rstrip('/')) or 'root'
+        archive = DirectoryArchive(
+            path, name, self.is_hidden if self.is_hidden else None, self.archive_max_size,
+            self.archive_compression_level)
+        if archive.size() > self.archive_max_size:
+            response.status_code = 413
+            return response.send_response()
+
+        content_type, extension = DirectoryArchive.FORMATS[archive_format]
+        response.add_headers({
+            'Content-Type': content_type,
+            # the plain file name is a fallback for the clients not knowing the RFC 5987 syntax
+            'Content-Disposition': 'attachment; filename="%s"; filename*=UTF-8\'\'%s' % (
+                re.sub(r'[^\w.\- ]', '_', name + extension), quote(name + extension)),
+            'Cache-Control': 'no-cache',
+        })
+        response.content = archive.iter_archive(archive_format) if environ['REQUEST_METHOD'] != 'HEAD' else iter(())
+        return response.send_response()
+
+    def send_search(self, environ, response, path, query, sorting, limit=100, as_json=False, **keys):
+        """
+        Sends the indexed entries under a directory matching a search (see `SearchIndex`), directories first then
+        sorted like the listings, their names being their path from the directory.
+        :param environ:
+        :param response: the `PrepareResponse` to send.
+        :param path: the searched directory, ending by a slash.
+        :param query: the searched words.
+        :param sorting: e.g. `ST_MTIME.ASC`.
+        :param limit: the maximal number of entries, up to `SearchIndex.MAX_RESULTS`.
+        :param as_json: if True, sends `{"directory": ..., "search": ..., "total": ..., "entries": [...]}`.
+        :param keys: the page tokens.
+        :return:
+        """
+        sorting = sorting.lower().split('.', 2)
+        listing = Listing(self, path, keys['END_URL'])
+        entries = [listing.unpack(values) for values in
+                   self.search_index.search(path, query, min(limit, SearchIndex.MAX_RESULTS))]
+        if sorting[0] in ('st_mtime', 'st_ctime', 'st_size'):
+            key = attrgetter(sorting[0][3:], 'name')
+        elif sorting[0] == 'total_size':
+            key = lambda e: ((self.get_directory_size(path, e.name) or (0,))[0] if e.is_dir else e.size, e.name)
+        else:
+            key = attrgetter('name')
+        directory_content = {'dirs': [], 'files': []}
+        for entry in entries:
+            directory_content['dirs' if entry.is_dir else 'files'].append((key(entry), entry))
+        descending = len(sorting) > 1 and sorting[1] == 'desc'
+
+        if as_json:
+            response.add_headers({'Content-Type': 'application/json'})
+            rows = []
+            for kind in ('dirs', 'files'):
+                directory_content[kind].sort(key=itemgetter(0), reverse=descending)
+                rows.extend(self.make_json_entry(entry) for _, entry in directory_content[kind])
+            content = '{"directory":%s,"search":%s,"indexing":%s,"total":%d,"entries":[%s]}' % (
+                json.dumps(environ['PATH_INFO'].decode('utf-8', 'replace')),
+                json.dumps(query.decode('utf-8', 'replace')), json.dumps(self.search_index.walking), len(rows),
+                ','.join(rows))
+        else:
+            keys['SEARCH_QUERY'] = escape(query, True)
+            keys['TOTAL_ENTRIES'] = str(len(entries))
+            content = self.rendering_no_error(directory_content, descending, keys['END_URL'], **keys)
+        return self.send_content(environ, response, content, '"%s"' % md5(content).hexdigest())
+
+    def send_content(self, environ, response, content, etag=None, cache_key=None, validator=None):
+        """
+        Sends a page, compressed with the content coding accepted by the client (the compressed pages are kept into
+        the listing cache under `cache_key`), answering `If-None-Match` by a 304 if the page has an ETag.
+        :param environ:
+        :param response: the `PrepareResponse` to send.
+        :param content: the page, or an iterable of its chunks sent while produced.
+        :param etag: the ETag of the uncompressed page.
+        :param cache_key: the listing cache key of the uncompressed page.
+        :param validator: its validator (see `ListingCache`).
+        :return:
+        """
+        encoding = self.negotiate_encoding(environ, response)
+        if isinstance(content, basestring) and len(content) < self.compression_min_size:
+            encoding = None
+        if etag:
+            etag = etag[:-1] + '-%s"' % encoding if encoding else etag
+            response.add_headers({'ETag': etag})
+            if self.etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+                response.status_code = 304
+                return response.send_response()
+
+        if encoding:
+            response.add_headers({'Content-Encoding': encoding})
+            if not isinstance(content, basestring):
+                content = self.iter_compress(content, encoding)
+            else:
+                cached = self.listing_cache.get(cache_key + (encoding,), validator) \
+                    if cache_key and self.listing_cache else None
+                if cached:
+                    content = cached[0]
+                else:
+                    content = self.compress(content, encoding)
+                    if cache_key and self.listing_cache:
+                        self.listing_cache.set(cache_key + (encoding,), validator, content, etag)
+        response.content = content
+        return response.send_response()
+
+    def send_asset(self, environ, response, name):
+        """
+        Sends the stylesheet or the javascript, compressed at startup.
+        :param name: `css` or `js`.
+        :return:
+        """
+        encoding = self.negotiate_encoding(environ, response)
+        if (name, encoding) in self.compressed_assets:
+            response.add_headers({'Content-Encoding': encoding})
+            response.content = self.compressed_assets[name, encoding]
         return response.send_response()
 
+    def negotiate_encoding(self, environ, response, content_type=None):
+        """
+        Returns the content coding to use (`gzip` or `deflate`) according to the `Accept-Encoding` header, or None if
+        the response must not be compressed. Adds the `Vary` header to the compressible responses.
+        :param environ:
+        :param response: the `PrepareResponse` to send.
+        :param content_type: the content type of the response, its `Content-Type` header by default.
+        :return:
+        """
+        if not self.compression_level:
+            return
+        content_type = (content_type or response.headers.get('Content-Type', '')).split(';', 1)[0].strip().lower()
+        for excluded in self.uncompressed_mimetypes:
+            if content_type == excluded or excluded.endswith('/') and content_type.startswith(excluded):
+                return
+        response.add_headers({'Vary': 'Accept-Encoding'})
+        return self.parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+
+    @staticmethod
+    def parse_accept_encoding(header):
+        """
+        Returns the preferred content coding among `gzip` and `deflate` in an `Accept-Encoding` header value, None
+        if none is accepted.
+        :param header: the header value, None if not given.
+        :return:
+        """
+        if not header:
+            return
+        accepted = {}
+        for coding in header.split(','):
+            coding, _, params = coding.partition(';')
+            q = 1.0
+            for param in params.split(';'):
+                name, _, value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0
+            accepted[coding.strip().lower()] = q
+        best, best_q = None, 0
+        for coding in ('gzip', 'deflate'):  # gzip is preferred on equal weights
+            q = accepted.get(coding, accepted.get('x-gzip') if coding == 'gzip' else None)
+            if q is None:
+                q = accepted.get('*', 0)
+            if q > best_q:
+                best, best_q = coding, q
+        return best
+
+    def compressor(self, encoding):
+        # a gzip header and trailer are written around the deflate stream when wbits is greater than 16
+        return zlib.compressobj(
+            self.compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+
+    def compress(self, content, encoding):
+        compressor = self.compressor(encoding)
+        return compressor.compress(content) + compressor.flush()
+
+    def iter_compress(self, chunks, encoding):
+        """
+        Compresses an iterable of strings while iterated, each chunk being flushed to be sent right away.
+        :param chunks: the iterable, closed at the end.
+        :param encoding: `gzip` or `deflate`.
+        :return:
+        """
+        compressor = self.compressor(encoding)
+        try:
+            for data in chunks:
+                if data:
+                    yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def send_json_listing(self, environ, response, path, validator, sorting, ndjson=False):
+        """
+        Sends a directory listing as JSON (or as a stream of NDJSON lines), kept into the listing cache.
+        :param environ:
+        :param response: the `PrepareResponse` to send.
+        :param path: the directory path.
+        :param validator: the validator of the directory (see `ListingCache`).
+        :param sorting: e.g. `ST_MTIME.ASC`.
+        :param ndjson:
+        :return:
+        """
+        response.add_headers({'Content-Type': 'application/x-ndjson' if ndjson else 'application/json'})
+        cache_key = (path, sorting, 'ndjson' if ndjson else 'json')
+        cached = self.listing_cache.get(cache_key, validator) if self.listing_cache else None
+        if cached:
+            content, etag = cached
+        else:
+            content = self.list_json(path, sorting, ndjson, environ['PATH_INFO'])
+            if content is None:
+                response.status_code = 404
+                response.content = json.dumps({'message': ERRORS['NOT_FOUND']})
+                return response.send_response()
+            if ndjson:  # sent while sorted, without ETag
+                content = self.listing_cache.tee(cache_key, validator, content) if self.listing_cache else content
+                return self.send_content(environ, response, content)
+            etag = '"%s"' % md5(content).hexdigest()
+            if self.listing_cache:
+                self.listing_cache.set(cache_key, validator, content, etag)
+        return self.send_content(environ, response, content, etag, cache_key, validator)
+
+    def send_file(self, environ, response, path, f, encoding=None, precompressed=False):
+        """
+        Sends an opened file, answering the conditional requests (`If-None-Match`, `If-Modified-Since`) by a 304 and
+        the `Range` requests (single or multiple byte ranges, `If-Range`) by a 206 or a 416.
+        :param environ:
+        :param response: the `PrepareResponse` to send.
+        :param path: the file path.
+        :param f: the file opened in binary mode, closed once sent.
+        :param encoding: the content coding of the response (`gzip` or `deflate`), None to send the file as is.
+        :param precompressed: is the opened file already compressed with `encoding` (e.g. a `.gz` sibling) or must it
+            be compressed on the fly, without ranges.
+        :return:
+        """
+        stats = fstat(f.fileno())
+        size = stats[ST_SIZE]
+        etag = '"%x-%x-%x"' % (stats[ST_INO], size, stats[ST_MTIME])
+        last_modified = formatdate(stats[ST_MTIME], usegmt=True)
+        content_type = self.mimetypes_list.get(os.path.splitext(path)[1]) or 'application/octet-stream'
+        response.add_headers(
+            {
+                "Content-Type": content_type,
+                "Content-Length": str(size),
+                "Last-Modified": last_modified,
+                "ETag": etag,
+                "Accept-Ranges": "bytes",
+            }
+        )
+        if encoding:
+            response.add_headers({'Content-Encoding': encoding})
+            if not precompressed:  # the length and the ranges of the compressed file are not known
+                etag = etag[:-1] + '-%s"' % encoding
+                response.add_headers({'ETag': etag})
+                response.remove_headers('Content-Length', 'Accept-Ranges')
+
+        # If-Modified-Since is ignored when If-None-Match is given
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            not_modified = self.etag_matches(if_none_match, etag)
+        else:
+            since = self.parse_http_date(environ.get('HTTP_IF_MODIFIED_SINCE'))
+            not_modified = since is not None and stats[ST_MTIME] <= since
+        if not_modified:
+            f.close()
+            response.status_code = 304
+            return response.send_response()
+
+        if encoding and not precompressed:
+            response.content = self.iter_compress(FileWrapper(f, FILE_BLOCK_SIZE), encoding)
+            return response.send_response()
+
+        ranges = self.parse_range(environ.get('HTTP_RANGE'), size)
+        if ranges is not None:
+            # the ranges are ignored if the representation has changed since the given validator
+            if_range = environ.get('HTTP_IF_RANGE')
+            if if_range and (if_range != etag if if_range.startswith('"') else if_range != last_modified):
+                ranges = None
+        if ranges is None:
+            response.content = environ.get('wsgi.file_wrapper', FileWrapper)(f, FILE_BLOCK_SIZE)
+            return response.send_response()
+
+        if not ranges:
+            f.close()
+            response.status_code = 416
+            response.add_headers({'Content-Type': 'text/plain', 'Content-Range': 'bytes */%d' % size})
+            response.headers.pop('Content-Length')
+            return response.send_response()
+
+        response.status_code = 206
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            response.add_headers(
+                {'Content-Range': 'bytes %d-%d/%d' % (start, end, size), 'Content-Length': str(end - start + 1)})
+            response.content = FileRange(f, FILE_BLOCK_SIZE, start, end - start + 1)
+            return response.send_response()
+
+        boundary = uuid4().hex
+        parts = [
+            ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                boundary, content_type, start, end, size), start, end)
+            for start, end in ranges
+        ]
+        closing = '\r\n--%s--\r\n' % boundary
+        response.add_headers(
+            {
+                'Content-Type': 'multipart/byteranges; boundary=%s' % boundary,
+                'Content-Length': str(
+                    sum(len(head) + end - start + 1 for head, start, end in parts) + 2 * (len(parts) - 1) + len(closing)
+                ),
+            }
+        )
+        response.content = self.iter_ranges(f, parts, closing)
+        return response.send_response()
+
+    @staticmethod
+    def iter_ranges(f, parts, closing):
+        """
+        Yields the body of a `multipart/byteranges` response.
+        :param f: the opened file, closed at the end.
+        :param parts: a list of `(part_headers, first_byte, last_byte)`.
+        :param closing: the closing boundary.
+        :return:
+        """
+        try:
+            for i, (head, start, end) in enumerate(parts):
+                yield '\r\n' + head if i else head
+                for data in FileRange(f, FILE_BLOCK_SIZE, start, end - start + 1):
+                    yield data
+            yield closing
+        finally:
+            f.close()
+
+    @staticmethod
+    def parse_range(header, size):
+        """
+        Parses a `Range` header value. Returns None if there is no valid byte ranges header, else a list of the
+        satisfiable `(first_byte, last_byte)` ranges, the overlapping ones being merged (empty if none is satisfiable).
+        :param header: the header value.
+        :param size: the file size.
+        :return:
+        """
+        if not header or not header.strip().lower().startswith('bytes='):
+            return
+        ranges = []
+        for spec in header.strip()[6:].split(','):
+            spec = spec.strip()
+            if not spec:
+                continue
+            first, sep, last = spec.partition('-')
+            try:
+                if not sep:
+                    return
+                elif not first:  # suffix: the last N bytes
+                    length = int(last)
+                    if length > 0 and size:
+                        ranges.append((max(0, size - length), size - 1))
+                    continue
+                first, last = int(first), int(last) if last.strip() else None
+            except ValueError:
+                return
+            if first < 0 or last is not None and first > last:
+                return
+            if first < size:
+                ranges.append((first, size - 1 if last is None else min(last, size - 1)))
+
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        # the ranges are kept in the requested order unless they overlap
+        return merged if len(merged) != len(ranges) else ranges
+
+    @staticmethod
+    def parse_http_date(value):
+        """
+        Returns the timestamp of an HTTP-date, or None if invalid.
+        :param value:
+        :return:
+        """
+        if not value:
+            return
+        parsed = parsedate_tz(value.split(';', 1)[0])  # old browsers append e.g. `; length=42`
+        return mktime_tz(parsed) if parsed else None
+
+    @staticmethod
+    def etag_matches(header, etag):
+        """
+        Returns True if the given `If-None-Match` header value matches the entity tag (using the weak comparison).
+        :param header: the header value, None if not given.
+        :param etag: the quoted entity tag.
+        :return:
+        """
+        if not header:
+            return False
+        if header.strip() == '*':
+            return True
+        etag = etag[2:] if etag.startswith('W/') else etag
+        for tag in header.split(','):
+            tag = tag.strip()
+            if (tag[2:] if tag.startswith('W/') else tag) == etag:
+                return True
+        return False
+
+    BINARY_UNITS = (1024, log(1024), ('B', 'kiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB', 'ZiB', 'YiB'))
+    DECIMAL_UNITS = (1000, log(1000), ('B', 'kB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB'))
+
     def convert_size(self, n_bytes):
         """
         Converts bytes into human readable using the binary or decimal prefix. It returns a result with the following
@@ -619,83 +4713,352 @@ class ListDirectory(object):
         if not n_bytes:
             return '0B'
         # using the binary prefix or the decimal one
-        prefix, units = (1024, ['B', 'kiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB', 'ZiB', 'YiB']) \
-            if self.binary_prefix else (1000, ['B', 'kB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB'])
-        exponent = min(floor(log(n_bytes) / log(prefix)), len(units) - 1)
+        prefix, log_prefix, units = self.BINARY_UNITS if self.binary_prefix else self.DECIMAL_UNITS
+        exponent = min(floor(log(n_bytes) / log_prefix), len(units) - 1)
         return '%.2f%s' % ((n_bytes / prefix ** exponent), units[int(exponent)])
 
-    def hash_file(self, path, opened_file):
+    def hash_file(self, path, opened_file, compute=True):
+        """
+        Returns the hashes of a file as JSON, None if the file is too large or False if the hashes are not known yet
+        and must not be computed.
+        :param path:
+        :param opened_file:
+        :param compute: must compute the hashes if they are not stored or not.
+        :return:
+        """
         stats = fstat(opened_file.fileno())
         if stats[ST_SIZE] > self.max_file_size_to_hash:
             return
 
-        st_mtime = stats[ST_MTIME]
-        del stats
-
-        if self.keep_hashes_cache:
-            r = self.cursor.execute("SELECT hashes FROM files WHERE path=? AND st_mtime=?", (path, st_mtime)).fetchone()
-            # we already hashed it! Then we just return the old results
-            if r:
-                return r[0]
-
-        hashes = dict(md5=self.get_hash(opened_file, md5), sha1=self.get_hash(opened_file, sha1))
-        if self.keep_hashes_cache:
-            # We insert the hashes or we update them if the path already exists (if the modification time has changed)
-            self.cursor.execute(
-                "INSERT or REPLACE INTO files(path, st_mtime, hashes) VALUES"
-                "(?, ?, ?)", (path, st_mtime, json.dumps(hashes)))
+        with self.span('hash_store'):
+            stored = self.hash_store.get(path, stats) if self.hash_store else None
+        # we already hashed it! Then we just return the old results
+        hit = stored and all(name in stored for name in self.hash_algorithms)
+        if self.metrics and self.hash_store:
+            self.metrics.count('cache_requests_total', (('cache', 'hashes'), ('result', 'hit' if hit else 'miss')))
+        if hit:
+            return json.dumps(dict((name, stored[name]) for name in self.hash_algorithms))
+        if not compute:
+            return False
+
+        start = time()
+        with self.span('hash'):
+            hashes = self.get_hashes(opened_file, self.hash_algorithms)
+        if self.metrics:
+            labels = (('mode', 'request'),)
+            self.metrics.count('hashing_files_total', labels)
+            self.metrics.count('hashing_bytes_total', labels, stats[ST_SIZE])
+            self.metrics.count('hashing_seconds_total', labels, time() - start)
+        if self.hash_store:
+            # keeping the digests of the other algorithms previously stored
+            stored = stored or {}
+            stored.update(hashes)
+            self.hash_store.set(path, stats, stored)
         return json.dumps(hashes)
 
+    def invalidate(self, path, name):
+        """
+        Drops the cached pages of a changed directory and the stored hashes of a changed file, called by the watcher.
+        :param path: the directory path.
+        :param name: the name of the changed entry, None if the directory itself changed.
+        :return:
+        """
+        for cache in (self.listing_cache, self.index_cache):
+            if cache:
+                cache.invalidate(path)
+        if name and self.hash_store:
+            self.hash_store.invalidate(path + name)
+        if self.search_index:
+            self.search_index.changed(path)
+
+    def span(self, name):
+        """
+        Returns a context manager timing a phase of the current request into its trace, doing nothing if the request
+        is not traced (see `RequestTracer`).
+        :param name: the phase, e.g. `scan`.
+        :return:
+        """
+        trace = self.tracer.current() if self.tracer else None
+        return Span(trace, name) if trace else NULL_SPAN
+
+    def is_address_allowed(self, environ):
+        """
+        Returns True if the client may read `/?metrics` and ask `/?profile` (see `metrics_allowed_addresses`).
+        """
+        # the IPv4 clients of an IPv6 socket are given as ::ffff:x.x.x.x
+        address = environ.get('REMOTE_ADDR', '')
+        address = address[7:] if address.startswith('::ffff:') else address
+        return address in self.metrics_allowed_addresses or '*' in self.metrics_allowed_addresses
+
+    def get_metrics_samples(self, environ):
+        """
+        Returns the metrics which are not counted by the requests (see `Metrics.render`): the lookups and the size of
+        the caches, the counters of the server and the progress of the background hashing.
+        :param environ:
+        :return:
+        """
+        samples = []
+        for name, cache in (('listing', self.listing_cache), ('index', self.index_cache)):
+            if cache:
+                labels = (('cache', name),)
+                samples.extend([
+                    ('cache_requests_total', labels + (('result', 'hit'),), cache.hits),
+                    ('cache_requests_total', labels + (('result', 'miss'),), cache.misses),
+                    ('cache_entries', labels, len(cache.entries)),
+                    ('cache_bytes', labels, cache.size),
+                ])
+        server = environ.get('directory_lister.server') or self.metrics_server
+        if server:
+            for name, value in server.counters().iteritems():
+                if name in ('handled', 'rejected', 'dropped'):
+                    name += '_total'
+                samples.append(('server_' + name, (), value))
+        if self.hash_indexer:
+            status = self.hash_indexer.status()
+            background = (('mode', 'background'),)
+            samples.extend([
+                ('hashing_queued', (), status['queue_depth']),
+                ('hashing_in_progress', (), status['in_progress']),
+                ('hashing_files_total', background, status['hashed_files']),
+                ('hashing_bytes_total', background, status['hashed_bytes']),
+                ('hashing_failures_total', (), status['failed']),
+                ('hashing_throughput_bytes', (), status['throughput']),
+            ])
+        return samples
+
+    def close(self):
+        """
+        Stops the directory watcher, the directory sizes, the search index and the background hashing and writes the
+        pending hashes into the database.
+        :return:
+        """
+        if self.watcher:
+            self.watcher.close()
+        if self.metrics:
+            self.metrics.close()
+        if self.directory_sizes:
+            self.directory_sizes.close()
+        if self.search_index:
+            self.search_index.close()
+        if self.hash_indexer:
+            self.hash_indexer.close()
+        if self.hash_store:
+            self.hash_store.close()
+
     @staticmethod
-    def get_hash(fd, algorithm_function):
-        h = algorithm_function()
+    def get_hashes(fd, algorithms, block_size=HASH_BLOCK_SIZE, rate_limit=0):
+        """
+        Reads the file once, by large blocks into a single buffer, and feeds every digest with each block.
+        :param fd: the opened file.
+        :param algorithms: the `hashlib` algorithms names (e.g. ['md5', 'sha1']).
+        :param block_size: the size of the blocks to read.
+        :param rate_limit: the maximal number of bytes to read per second (0 for no limit).
+        :return: a dict of the hexadecimal digests by algorithm name.
+        """
+        hashes = [(name, new_hash(name)) for name in algorithms]
+        buf = bytearray(min(block_size, rate_limit) if rate_limit else block_size)
+        view = memoryview(buf)
         fd.seek(0)
+        started, read = time(), 0
         while 1:
-            data = fd.read(2**9)
-            if not data:
+            n = fd.readinto(buf)
+            if not n:
                 break
-            h.update(data)
-        return h.hexdigest()
+            data = view[:n]
+            for _, h in hashes:
+                h.update(data)
+            if rate_limit:
+                read += n
+                delay = started + float(read) / rate_limit - time()
+                if delay > 0:
+                    sleep(delay)
+        return dict((name, h.hexdigest()) for name, h in hashes)
 
     def rendering_error(self, **keys):
-        def r(obj):
-            return Template(obj.group('CONTENT')).safe_substitute(**keys)
-        # replacing error blocs by substituted and removing the no error blocs
-        return re.sub(self.no_error_regex, '', re.sub(self.error_regex, r, self.body))
+        return self.template.render_error(keys)
 
     def rendering_no_error(self, directory_content, descending, end_url, **keys):
-        def r(obj):
-            def loop(l_obj):
-                def get_content_match(match_obj):
-                    return match_obj.group('CONTENT')
-                content_template = l_obj.group('CONTENT')
-                if not self.hide_parent:
-                    _t = Template(content_template).safe_substitute(
-                        FILE_NAME='..', FILE_LINK='../' + end_url,
-                        FILE_MODIFICATION='', FILE_CREATION='', FILE_TYPE='parent', FILE_SIZE='', FILE_MIMETYPE='')
-                    _t = re.sub(self.if_not_file, get_content_match, _t)
-                    _t = re.sub(self.if_file, '', _t)
-                    formatted_content = _t
-                else:
-                    formatted_content = ''
-                for key in directory_content:  # for each key into `directory_content`
-                    # for each item sorted...
-                    for i in sorted(directory_content[key], key=itemgetter(0), reverse=descending):
-                        # getting the dict in previously loop created as `r` to format the `list_dir_bloc` template
-                        _t = Template(content_template).safe_substitute(**i[1])
-                        # replacing the blocs if file.../ if not file...
-                        if key == 'dirs':
-                            _t = re.sub(self.if_not_file, get_content_match, _t)
-                            _t = re.sub(self.if_file, '', _t)
-                        else:
-                            _t = re.sub(self.if_file, get_content_match, _t)
-                            _t = re.sub(self.if_not_file, '', _t)
-                        formatted_content += _t
-                return formatted_content
-            return Template(re.sub(self.loop_regex, loop, obj.group('CONTENT'))).safe_substitute(**keys)
-        return re.sub(self.error_regex, '', re.sub(self.no_error_regex, r, self.body))
-
-    def list_dir(self, path, sorting='ST_MTIME.ASC', end_url=''):
+        # directories are always kept on top of the files
+        rows = []
+        with self.span('sort'):
+            for kind in ('dirs', 'files'):
+                directory_content[kind].sort(key=itemgetter(0), reverse=descending)
+                rows.append((kind, [row for _, row in directory_content[kind]]))
+        with self.span('render'):
+            return self.template.render_listing(keys, rows, self.parent_row(end_url))
+
+    def parent_row(self, end_url):
+        """
+        Returns the row of the parent directory, None if hidden.
+        :param end_url:
+        :return:
+        """
+        if self.hide_parent:
+            return
+        return dict(
+            FILE_NAME='..', FILE_LINK='../' + end_url,
+            FILE_MODIFICATION='', FILE_CREATION='', FILE_TYPE='parent', FILE_SIZE='', FILE_MIMETYPE='',
+            DIR_TOTAL_SIZE='', DIR_FILE_COUNT='')
+
+    def scan_entries(self, path, sorting, end_url='', make_row=None, listing=None):
+        """
+        Yields a `(kind, sorting_key, row)` tuple for each visible entry of a directory, kind being `dirs` or `files`
+        and row an `Entry` (or what `make_row` returns).
+        :param path:
+        :param sorting: the sorting as split by `list_dir`, e.g. ['st_mtime', 'asc'].
+        :param end_url:
+        :param make_row: a `make_row(file_name, is_dir, stats, end_url, path)` callable building the rows, the entries
+            being then always stat.
+        :param listing: the `Listing` of the entries, a new one by default.
+        :return:
+        """
+        # the stats are only needed to sort by them or to show them
+        with_stats = make_row is not None or not self.skip_unneeded_stat \
+            or sorting[0] in ('st_mtime', 'st_ctime', 'st_size', 'total_size') \
+            or bool(self.template.row_tokens & self.STAT_TOKENS)
+        if make_row is None:
+            make_entry = (listing or Listing(self, path, end_url)).entry
+            make_row = lambda file_name, is_dir, stats, end_url, path: make_entry(file_name, is_dir, stats)
+
+        is_hidden = self.is_hidden if self.is_hidden else None
+        entries = scan_dir(path, with_stats)
+        if self.metrics:
+            entries = self.metrics.iter_observed(entries, 'listing_entries', ())
+        # the checks and the rows are timed apart from the scan (listdir and stat) in the traced requests
+        trace = self.tracer.current() if self.tracer else None
+        if trace:
+            is_hidden = is_hidden and trace.timed('is_hidden', is_hidden)
+            make_row = trace.timed('make_row', make_row)
+        for file_name, is_dir, stats in entries:
+            # If is a directory we add a "/" at the end of the filename before check if hidden
+            #   (to separate dirs of the files/ links).
+            if is_hidden is not None and is_hidden(file_name + '/' if is_dir else file_name):
+                continue
+            # if sorting[0] is in ['st_mtime', 'st_ctime', 'st_size'] we get the attribute `sorting[0]`
+            # of the `stat_result` object, then the name to always give the same order to the equal values,
+            # else it gets by name (default).
+            # the total size sorts the directories by their recursive size (unknown as 0) and the files by their size.
+            if sorting[0] in ['st_mtime', 'st_ctime', 'st_size']:
+                key = (stats.__getattribute__(sorting[0]), file_name)
+            elif sorting[0] == 'total_size':
+                key = ((self.get_directory_size(path, file_name) or (0,))[0] if is_dir else stats[ST_SIZE], file_name)
+            else:
+                key = file_name
+            yield 'dirs' if is_dir else 'files', key, make_row(file_name, is_dir, stats, end_url, path)
+
+    def get_directory_size(self, path, file_name):
+        """
+        Returns the `(total_size, file_count)` of a sub-directory, None if unknown.
+        :param path: the parent directory path, ending by a slash.
+        :param file_name: the sub-directory name.
+        :return:
+        """
+        return self.directory_sizes.get(path + file_name + '/') if self.directory_sizes else None
+
+    def format_date(self, timestamp):
+        """
+        Formats a timestamp with the date format, the dates being memoized by second.
+        :param timestamp: an integer timestamp.
+        :return:
+        """
+        date = self.formatted_dates.get(timestamp)
+        if date is None:
+            if len(self.formatted_dates) >= 2**16:
+                self.formatted_dates.clear()
+            date = self.formatted_dates[timestamp] = strftime(self.date_format, gmtime(timestamp))
+        return date
+
+    def dashed_mimetype(self, mimetype):
+        """
+        Replaces the special chars of a mimetype (excluding the dash) by a dash. Useful for the CSS class selector.
+        """
+        dashed = self.dashed_mimetypes.get(mimetype)
+        if dashed is None:
+            dashed = self.dashed_mimetypes[mimetype] = re.sub(self.css_invalid_chars, '-', mimetype)
+        return dashed
+
+    def make_json_row(self, file_name, is_dir, stats, end_url='', path=''):
+        """
+        Returns an entry as a JSON object: its name, link, type (`dir` or `file`), size in bytes (null for the
+        directories), modification and creation timestamps and mimetype (null for the directories).
+        :param file_name:
+        :param is_dir:
+        :param stats: the stats of the entry.
+        :param end_url: not used, the links of the directories don't keep the query string.
+        :param path: not used.
+        :return:
+        """
+        return self.make_json_entry(Entry(file_name, is_dir, stats[ST_SIZE], stats.st_mtime, stats.st_ctime, None))
+
+    def make_json_entry(self, entry):
+        """
+        Returns an `Entry` as a JSON object (see `make_json_row`), its dates being kept as they are (the listings
+        and the search index keep their fractional part).
+        :param entry: an `Entry`, its `listing` being not used.
+        :return:
+        """
+        name = entry.name
+        return json.dumps(OrderedDict([
+            # the names are not always UTF-8
+            ('name', name.decode('utf-8', 'replace') if isinstance(name, str) else name),
+            ('link', quote(name) + ('/' if entry.is_dir else '')),
+            ('type', 'dir' if entry.is_dir else 'file'),
+            ('size', None if entry.is_dir else entry.size),
+            ('mtime', entry.mtime),
+            ('ctime', entry.ctime),
+            ('mimetype', None if entry.is_dir else
+                self.mimetypes_list.get(os.path.splitext(name)[1]) or 'application/octet-stream'),
+        ]), separators=(',', ':'))
+
+    def list_json(self, path, sorting='ST_MTIME.ASC', ndjson=False, directory=''):
+        """
+        Returns a directory listing as a JSON object (`{"directory": ..., "total": ..., "entries": [...]}`), or as a
+        generator of the NDJSON lines (one entry by line) sorted with a bounded memory by `SortedEntries`, without
+        using the template. Returns None if the directory can't be read.
+        :param path:
+        :param sorting:
+        :param ndjson:
+        :param directory: the directory as shown by the JSON object, e.g. `/path/`.
+        :return:
+        """
+        sorting = sorting.lower().split('.', 2)
+        descending = len(sorting) > 1 and sorting[1] == 'desc'
+        entries = self.scan_entries(path, sorting, make_row=self.make_json_row)
+        if not ndjson:
+            try:
+                sorted_entries = DirectoryIndex(entries, ".".join(sorting), descending)
+            except OSError:
+                return
+            return '{"directory":%s,"total":%d,"entries":[%s]}' % (
+                json.dumps(directory.decode('utf-8', 'replace')), len(sorted_entries),
+                ','.join([row for _, _, row in sorted_entries.entries]))
+
+        try:  # the errors are known before starting the response
+            first = next(entries, None)
+        except OSError:
+            return
+
+        def iter_lines():
+            sorted_entries = SortedEntries(chain([first], entries) if first else (), descending, self.sort_run_size)
+            try:
+                content, size = [], 0
+                for _, rows in sorted_entries.rows():
+                    for row in rows:
+                        content.append(row)
+                        size += len(row) + 1
+                        if size >= 2**16:
+                            content.append('')
+                            yield '\n'.join(content)
+                            content, size = [], 0
+                if content:
+                    content.append('')
+                    yield '\n'.join(content)
+            finally:
+                entries.close()
+                sorted_entries.close()
+        return iter_lines()
+
+    def list_dir(self, path, sorting='ST_MTIME.ASC', end_url='', **keys):
         """
         Returns String if error.
         Sorting possibilities ([+]`.ASC|.DESC`):
@@ -703,59 +5066,120 @@ class ListDirectory(object):
             - ST_CTIME -> sorts by creation date.
             - ST_SIZE  -> sorts by size.
             - NAME     -> sorts by name.
+            - TOTAL_SIZE -> sorts by recursive size (see `DirectorySizes`).
         :param path:
         :return:
         """
-        try:
-            dir_ = listdir(path)
-        except OSError:
-            return self.rendering_error(ERROR_MESSAGE='Invalid file or directory.')
-
-        path = [path + '/', path][path.endswith('/')]
         sorting = sorting.lower().split('.', 2)
 
         # We separate directories and files to always keep directories on top
         directory_content = {'dirs': [], 'files': []}
-        for file_name in dir_:
-            is_dir = os.path.isdir(path + file_name)
-            # If is a directory we add a "/" at the end of the filename before check if hidden
-            #   (to separate dirs of the files/ links).
-            if self.is_hidden(file_name + '/' if is_dir else ''):
-                continue
-            stats = stat(os.path.join(path, file_name))
-            r = dict(
-                FILE_NAME=escape(file_name),
-                # we keep the current query string on directories link
-                FILE_LINK='%s%s' %
-                          (quote(file_name), is_dir and ('/' + end_url) or ''),
-                FILE_MODIFICATION=strftime(self.date_format, gmtime(stats[ST_MTIME])),
-                FILE_CREATION=strftime(self.date_format, gmtime(stats[ST_CTIME])),
-            )
-            if is_dir:
-                r['FILE_TYPE'], r['FILE_SIZE'], r['FILE_MIMETYPE'], r['DASHED_FILE_MIMETYPE'] = ('dir', '-', '-', '-')
-            else:  # if file or link
-                mime = self.mimetypes_list.get(os.path.splitext(file_name)[1]) or 'application/octet-stream'
-                r['FILE_TYPE'], r['FILE_SIZE'], r['FILE_MIMETYPE'], r['DASHED_FILE_MIMETYPE'] = (
-                    'file %s' % filter(None, mime.split('/'))[0], self.convert_size(stats[ST_SIZE]),
-                    mime,
-                    # Replacing special chars (excluding the dash), by a dash. Useful for the CSS class selector.
-                    re.sub(self.css_invalid_chars, '-', mime)
-                )
-
-            # append into 'dirs' if is a directory, else we append into 'files'
-            directory_content['dirs' if is_dir else 'files'].append(
-                # if sorting[0] is in ['st_mtime', 'st_ctime', 'st_size'] we get the attribute `sorting[0]`
-                # of the `stat_result` object else it gets by name (default).
-                (stats.__getattribute__(sorting[0]), r) if sorting[0] in ['st_mtime', 'st_ctime', 'st_size']
-                else (file_name, r)
-            )
+        try:
+            with self.span('scan'):
+                for kind, key, r in self.scan_entries(path, sorting, end_url):
+                    directory_content[kind].append((key, r))
+        except OSError:
+            return self.rendering_error(ERROR_MESSAGE='Invalid file or directory.', **keys)
+        keys['TOTAL_ENTRIES'] = str(len(directory_content['dirs']) + len(directory_content['files']))
         return self.rendering_no_error(
             directory_content,
             # if sorting[1] is as descending; else, it stays as ascending.
             True if len(sorting) > 1 and sorting[1] == 'desc' else False,
             end_url=end_url,
+            **keys
         )
 
+    def get_index(self, path, validator, sorting, end_url=''):
+        """
+        Returns the `DirectoryIndex` of a directory, from the cache while the directory keeps the same validator.
+        :param path:
+        :param validator: e.g. the `(st_mtime, st_ctime, st_ino)` of the directory.
+        :param sorting: e.g. `ST_MTIME.ASC`.
+        :param end_url:
+        :return:
+        """
+        cache_key = (path, sorting, end_url)
+        cached = self.index_cache.get(cache_key, validator) if self.index_cache else None
+        if cached:
+            return cached[0]
+        split_sorting = sorting.lower().split('.', 2)
+        index = DirectoryIndex(
+            self.scan_entries(path, split_sorting, end_url), sorting,
+            len(split_sorting) > 1 and split_sorting[1] == 'desc')
+        if self.index_cache:
+            # about 256 bytes for each row (see benchmarks/listing_memory.py)
+            self.index_cache.set(cache_key, validator, index, None, size=len(index) * 256 + 1024)
+        return index
+
+    def list_page(self, path, validator, sorting, offset=0, cursor=None, limit=100, page_query='', end_url='',
+                  **keys):
+        """
+        Returns a page of a directory listing, from its cached `DirectoryIndex`.
+        :param path:
+        :param validator: the validator of the directory (see `get_index`).
+        :param sorting:
+        :param offset: the position of the first row, ignored if a cursor is given.
+        :param cursor: the cursor given by the previous or next page link.
+        :param limit: the maximal number of rows.
+        :param page_query: appended to the query string of the page links, e.g. `&no-cookies`.
+        :param end_url:
+        :return: the page, None if the cursor is invalid.
+        """
+        try:
+            index = self.get_index(path, validator, sorting, end_url)
+        except OSError:
+            return self.rendering_error(ERROR_MESSAGE='Invalid file or directory.', **keys)
+        if cursor is not None:
+            cursor = index.parse_cursor(cursor, limit)
+            if cursor is None:
+                return
+            start = index.locate(cursor)
+        else:
+            start = min(offset, len(index))
+        end = min(start + limit, len(index))
+
+        keys['TOTAL_ENTRIES'] = str(len(index))
+        keys['NEXT_PAGE'] = '?cursor=%s&limit=%d%s' % (index.cursor(end - 1, 'after'), limit, page_query) \
+            if end < len(index) else ''
+        keys['PREV_PAGE'] = '?cursor=%s&limit=%d%s' % (index.cursor(start, 'before'), limit, page_query) \
+            if start > 0 else ''
+        return self.template.render_listing(keys, index.page(start, end), self.parent_row(end_url))
+
+    def iter_list_dir(self, path, sorting='ST_MTIME.ASC', end_url='', **keys):
+        """
+        Same as `list_dir` but returns a generator of the page chunks: the head of the page is yielded right away,
+        then the rows by chunks, sorted by `SortedEntries` (keeping at most `sort_run_size` rows of each kind in
+        memory), then the tail of the page. Returns a string if the directory can't be read.
+        :param path:
+        :return:
+        """
+        sorting = sorting.lower().split('.', 2)
+        listing = Listing(self, path, end_url)
+        entries = self.scan_entries(path, sorting, end_url, listing=listing)
+        try:  # the errors are known before starting the response
+            first = next(entries, None)
+        except OSError:
+            return self.rendering_error(ERROR_MESSAGE='Invalid file or directory.', **keys)
+
+        def iter_page():
+            sorted_entries = []
+
+            def rows():
+                if not sorted_entries:  # sorted when the first loop is reached, after the head is sent
+                    sorted_entries.append(SortedEntries(
+                        chain([first], entries) if first else (), len(sorting) > 1 and sorting[1] == 'desc',
+                        self.sort_run_size, pack=Entry.pack, unpack=listing.unpack))
+                return sorted_entries[0].rows()
+
+            try:
+                for data in self.template.iter_listing(keys, rows, self.parent_row(end_url)):
+                    yield data
+            finally:
+                entries.close()
+                if sorted_entries:
+                    sorted_entries[0].close()
+        return iter_page()
+
 
 def parse_arguments():
     parser = ArgumentParser(prog='directoryLister')
@@ -793,6 +5217,22 @@ def parse_arguments():
     # --max-hash-size=INT
     parser.add_argument('--max-hash-size', dest='max_file_size_to_hash', type=int, default=int(2.5 * 10**8),
                         help='The maximal file size allowed to hash (in bytes).')
+    # --hash-algorithm=NAME
+    parser.add_argument('--hash-algorithm', dest='hash_algorithms', action='append', choices=HASH_ALGORITHMS,
+                        metavar='NAME',
+                        help='A digest to provide on demand, among %s (md5 and sha1 by default, this argument can be '
+                             'given as much you want).' % ', '.join(HASH_ALGORITHMS))
+    # --background-hashing
+    parser.add_argument('--background-hashing', dest='background_hashing', action='store_true', default=False,
+                        help='Hashes the files ahead of time into the hashes cache, the files not hashed yet are '
+                             'answered by a 202 (requires --store-hashes).')
+    # --hashing-processes=INT
+    parser.add_argument('--hashing-processes', dest='hashing_processes', metavar='INT', type=int,
+                        help='The number of processes of the background hashing (the number of CPUs by default).')
+    # --hashing-rate-limit=BYTES
+    parser.add_argument('--hashing-rate-limit', dest='hashing_rate_limit', metavar='BYTES', type=int, default=0,
+                        help='The maximal number of bytes read per second by the background hashing (no limit by '
+                             'default).')
     # --store-hashes=True/ False
     parser.add_argument('--store-hashes', dest='keep_hashes_cache', action='store_true', default=False,
                         help='Must keep the hashes in cache into a database or not.')
@@ -805,7 +5245,10 @@ def parse_arguments():
                              '(this argument can be given as much you want).')
     # --database=PATH
     parser.add_argument('--database', metavar='PATH', dest='database', default=':memory:',
-                        help='A path to a new sqlite database (in memory by default).')
+                        help='A path to a sqlite database (in memory by default).')
+    # --prune-hashes
+    parser.add_argument('--prune-hashes', dest='prune_hashes', action='store_true', default=False,
+                        help='Removes the hashes of the deleted or modified files from the database, then exits.')
     # --single-thread
     parser.add_argument('--single-thread', dest='single_thread', action='store_true', default=False,
                         help='If we should only use a single thread server or not and then process to requests '
@@ -813,13 +5256,122 @@ def parse_arguments():
     # --thread-count
     parser.add_argument('--thread-count', dest='thread_count', default=10, type=int,
                         help='Sets the limit of threads.')
+    # --event-loop
+    parser.add_argument('--event-loop', dest='event_loop', action='store_true', default=False,
+                        help='Multiplexes the connections on an event loop, the requests being handled by '
+                             '--thread-count threads while the files are streamed by the loop.')
+    # --queue-size
+    parser.add_argument('--queue-size', dest='queue_size', default=64, type=int, metavar='INT',
+                        help='The maximal number of requests waiting for a thread.')
+    # --overload-policy
+    parser.add_argument('--overload-policy', dest='overload_policy', default='block',
+                        choices=ThreadPoolWSGIServer.OVERLOAD_POLICIES,
+                        help='What to do when the requests queue is full: stop accepting the connections (block), '
+                             'answer the new request by a 503 (reject) or the oldest queued one (drop-oldest).')
+    # --retry-after
+    parser.add_argument('--retry-after', dest='retry_after', default=1, type=int, metavar='SECONDS',
+                        help='The Retry-After header value of the requests rejected by the overload policy.')
+    # --keep-alive
+    parser.add_argument('--keep-alive', dest='keep_alive', default=0, type=int, metavar='SECONDS',
+                        help='Keeps the HTTP/1.1 connections open for their next requests until idle for SECONDS '
+                             '(disabled by default).')
+    # --max-keep-alive-requests
+    parser.add_argument('--max-keep-alive-requests', dest='max_keep_alive_requests', default=100, type=int,
+                        metavar='INT', help='The maximal number of requests handled by a kept alive connection.')
+    # --workers
+    parser.add_argument('--workers', dest='workers', default=0, type=int, metavar='INT',
+                        help='The number of processes serving the requests, each one with its own threads '
+                             '(a single process by default).')
+    # --reuse-port
+    parser.add_argument('--reuse-port', dest='reuse_port', action='store_true', default=False,
+                        help='Each worker process binds its own socket with SO_REUSEPORT instead of sharing one.')
     # --hide-parent
     parser.add_argument('--hide-parent', dest='hide_parent', action='store_true', default=False,
                         help='Must hide the parent double dots (..) or not.')
+    # --always-stat
+    parser.add_argument('--always-stat', dest='skip_unneeded_stat', action='store_false', default=True,
+                        help='Always stat the listed entries, even if neither the template nor the sorting use the '
+                             'size or the dates.')
+    # --listing-cache-entries
+    parser.add_argument('--listing-cache-entries', dest='listing_cache_entries', metavar='INT', type=int, default=128,
+                        help='The maximal number of rendered directory pages to keep in cache (0 to disable).')
+    # --listing-cache-size
+    parser.add_argument('--listing-cache-size', dest='listing_cache_size', metavar='BYTES', type=int, default=2**25,
+                        help='The maximal size of the rendered directory pages to keep in cache (in bytes).')
+    # --stream-listings
+    parser.add_argument('--stream-listings', dest='stream_listings', action='store_true', default=False,
+                        help='Sends the directory pages while they are rendered instead of once complete.')
+    # --sort-run-size
+    parser.add_argument('--sort-run-size', dest='sort_run_size', metavar='INT', type=int, default=10000,
+                        help='The maximal number of entries sorted in memory by a streamed directory page, the larger '
+                             'directories being sorted through temporary files.')
+    # --page-size
+    parser.add_argument('--page-size', dest='page_size', metavar='INT', type=int, default=0,
+                        help='Splits the directory pages into pages of INT entries (not paginated by default, '
+                             '?offset=, ?limit= and ?cursor= are always available).')
+    # --index-cache-entries
+    parser.add_argument('--index-cache-entries', dest='index_cache_entries', metavar='INT', type=int, default=16,
+                        help='The maximal number of sorted directories kept in cache for the pagination.')
+    # --compression-level
+    parser.add_argument('--compression-level', dest='compression_level', metavar='INT', type=int, default=6,
+                        choices=range(10),
+                        help='The gzip/deflate compression level of the responses, from 1 (fastest) to 9 (smallest), '
+                             '0 to disable the compression.')
+    # --compression-min-size
+    parser.add_argument('--compression-min-size', dest='compression_min_size', metavar='BYTES', type=int,
+                        default=1024, help='The minimal size of the compressed responses.')
+    # --uncompressed-mimetype
+    parser.add_argument('--uncompressed-mimetype', dest='uncompressed_mimetypes', metavar='TYPE', action='append',
+                        help='A mimetype never compressed, e.g. image/ for every image (this argument can be given as '
+                             'much you want, replacing the default ones: %s).' % ', '.join(UNCOMPRESSED_MIMETYPES))
+    # --watch-directories
+    parser.add_argument('--watch-directories', dest='watch_directories', action='store_true', default=False,
+                        help='Watch the visited directories (with inotify on Linux, by polling them otherwise) to '
+                             'serve their cached pages without checking them.')
+    # --max-watches
+    parser.add_argument('--max-watches', dest='max_watches', metavar='INT', type=int, default=4096,
+                        help='The maximal number of watched directories.')
+    # --directory-sizes
+    parser.add_argument('--directory-sizes', dest='directory_sizes', action='store_true', default=False,
+                        help='Compute the recursive size and number of files of the directories in background.')
+    # --directory-sizes-interval
+    parser.add_argument('--directory-sizes-interval', dest='directory_sizes_interval', metavar='SECONDS', type=int,
+                        default=60, help='The number of seconds between the updates of the directory sizes.')
+    # --archive-max-size
+    parser.add_argument('--archive-max-size', dest='archive_max_size', metavar='BYTES', type=int, default=2**32,
+                        help='The maximal size of the files of a directory downloaded as an archive (?archive=zip, '
+                             'tar or tar.gz), 0 to disable the archives.')
+    # --archive-compression-level
+    parser.add_argument('--archive-compression-level', dest='archive_compression_level', metavar='INT', type=int,
+                        default=0, choices=range(10),
+                        help='The deflate level of the zip archives entries, 0 (stored) by default, also used by the '
+                             'tar.gz archives (6 if 0).')
+    # --search-index
+    parser.add_argument('--search-index', dest='search_index', action='store_true', default=False,
+                        help='Index the names of the files in background into the database to find them by '
+                             '?search=WORDS.')
+    # --search-index-interval
+    parser.add_argument('--search-index-interval', dest='search_index_interval', metavar='SECONDS', type=int,
+                        default=300, help='The number of seconds between the updates of the search index.')
+    # --metrics
+    parser.add_argument('--metrics', dest='metrics', action='store_true', default=False,
+                        help='Count and time the requests, exposed in the Prometheus format by /?metrics.')
+    # --metrics-allow
+    parser.add_argument('--metrics-allow', dest='metrics_allowed_addresses', metavar='ADDRESS', action='append',
+                        help='A client address allowed to read /?metrics, * for all (this argument can be given as '
+                             'much you want, replacing the default ones: 127.0.0.1, ::1).')
+    # --slow-request-threshold
+    parser.add_argument('--slow-request-threshold', dest='slow_request_threshold', metavar='SECONDS', type=float,
+                        default=0, help='Log the requests slower than SECONDS with the time spent in each phase.')
+    # --profile-directory
+    parser.add_argument('--profile-directory', dest='profile_directory', metavar='DIRECTORY',
+                        help='Profile the next requests into DIRECTORY when asked by /?profile=N or SIGUSR2.')
     # --resources-directory
     parser.add_argument('--resources-directory', dest='resources_directory', metavar='DIRECTORY',
                         help='The resources directory. Useful to add resources on pages by using `?get=filename`.')
     args_ = parser.parse_args()
+    if args_.queue_size < 1:
+        parser.error('--queue-size must be at least 1.')
 
     # reading content of path and replacing the attribute with the output
     for a in ('body', 'css', 'js'):
@@ -827,6 +5379,12 @@ def parse_arguments():
             setattr(args_, a, getattr(args_, a).read())
         else:
             delattr(args_, a)
+    if not args_.hash_algorithms:
+        del args_.hash_algorithms  # keeping the default digests
+    if not args_.uncompressed_mimetypes:
+        del args_.uncompressed_mimetypes
+    if not args_.metrics_allowed_addresses:
+        del args_.metrics_allowed_addresses
 
     if args_.configuration_file:
         conf_path = os.path.split(args_.configuration_file.name)[0]
@@ -857,12 +5415,60 @@ def parse_arguments():
     return args_
 
 
-def main(host='0.0.0.0', port=8000, single_thread=False, thread_count=10, **kwargs):
+def main(host='0.0.0.0', port=8000, single_thread=False, thread_count=10, queue_size=64, overload_policy='block',
+         retry_after=1, prune_hashes=False, workers=0, reuse_port=False, event_loop=False, keep_alive=0,
+         max_keep_alive_requests=100, reload_arguments=None, **kwargs):
+    if prune_hashes:
+        store = HashStore(kwargs.get('database', ':memory:'))
+        print('%d outdated hashes removed.' % store.prune())
+        store.close()
+        return
+
+    # the arguments of the thread pool servers
+    server_kwargs = dict(
+        queue_size=queue_size, overload_policy=overload_policy, retry_after=retry_after,
+        handler_class=KeepAliveRequestHandler if keep_alive else SendfileRequestHandler,
+        keep_alive_timeout=keep_alive, max_keep_alive_requests=max_keep_alive_requests)
+
+    if workers:
+        # the workers merge their metrics through files, the totals of the exited workers being kept (see `Metrics`)
+        metrics_directory = None
+        if kwargs.get('metrics') and not kwargs.get('metrics_directory'):
+            metrics_directory = kwargs['metrics_directory'] = mkdtemp(prefix='directory-lister-metrics-')
+
+        def app_factory():
+            # SIGHUP: the arguments and the configuration file are read again for the new workers
+            app_kwargs = kwargs
+            if reload_arguments and prefork_server.generation:
+                app_kwargs = dict((k, v) for k, v in reload_arguments().__dict__.items() if k in kwargs)
+                app_kwargs['metrics_directory'] = kwargs.get('metrics_directory')
+            return ListDirectory(**app_kwargs)
+
+        def server_factory():
+            if event_loop:
+                return make_event_loop_server(
+                    thread_count=thread_count, host=host, port=port, app=None, reuse_port=reuse_port)
+            return make_multithread_server(
+                thread_count=1 if single_thread else thread_count, host=host, port=port, app=None,
+                reuse_port=reuse_port, **server_kwargs)
+
+        prefork_server = PreforkServer(server_factory, app_factory, workers=workers, reuse_port=reuse_port)
+        print('Starting the server at http://%s:%d with %d workers' % (host, port, workers))
+        try:
+            prefork_server.serve_forever()
+        finally:
+            if metrics_directory:
+                shutil.rmtree(metrics_directory, ignore_errors=True)
+        return
+
     # if the configuration file have an invalid item -> exception (we don't check)
-    if single_thread:
-        s = make_server(host=host, port=port, app=ListDirectory(**kwargs))
+    app = ListDirectory(**kwargs)
+    if event_loop:
+        s = make_event_loop_server(thread_count=thread_count, host=host, port=port, app=app)
+    elif single_thread:
+        s = make_server(host=host, port=port, app=app, handler_class=SendfileRequestHandler)
     else:
-        s = make_multithread_server(thread_count=thread_count, host=host, port=port, app=ListDirectory(**kwargs))
+        s = make_multithread_server(thread_count=thread_count, host=host, port=port, app=app, **server_kwargs)
 
     try:
         print('Starting the server at http://%s:%d' % (host, port))
@@ -870,7 +5476,8 @@ def main(host='0.0.0.0', port=8000, single_thread=False, thread_count=10, **kwar
     except KeyboardInterrupt:
         print('Closing the server...')
         s.server_close()
+        app.close()
 
 
 if __name__ == '__main__':
-    main(**parse_arguments().__dict__)
+    main(reload_arguments=parse_arguments, **parse_arguments().__dict__)
@@ -0,0 +1,44 @@
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from directoryLister.directory_lister import PollingWatcher
+
+
+class DirectoryWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.root = mkdtemp() + '/'
+        for name in ('a/x', 'b', 'c', 'd'):
+            os.makedirs(self.root + name)
+        self.forgotten = []
+        # not started: the directories are only watched, not polled
+        self.watcher = PollingWatcher(
+            self.root, max_watches=5, listeners=[lambda path, name: self.forgotten.append(path)])
+
+    def tearDown(self):
+        self.watcher.closed = True
+        shutil.rmtree(self.root)
+
+    def test_used_directory_keeps_its_parents(self):
+        root = self.root
+        self.assertIsNotNone(self.watcher.watch(root + 'a/x/'))
+        self.assertIsNotNone(self.watcher.watch(root + 'b/'))
+        for _ in range(3):
+            self.assertIsNotNone(self.watcher.get(root + 'a/x/'))
+        self.watcher.watch(root + 'c/')
+        self.watcher.watch(root + 'd/')
+
+        # the cold directory is forgotten, not the used one with its parent
+        self.assertEqual(self.forgotten, [root + 'b/'])
+        self.assertIsNotNone(self.watcher.get(root + 'a/x/'))
+        self.assertIsNotNone(self.watcher.get(root + 'a/'))
+        self.assertIsNone(self.watcher.get(root + 'b/'))
+
+    def test_unwatched_directory(self):
+        self.assertIsNone(self.watcher.get(self.root + 'a/'))
+        self.assertEqual(list(self.watcher.watches), [])
+
+
+if __name__ == '__main__':
+    unittest.main()